@@ -0,0 +1,54 @@
+"""
+Throughput of the vectorized design efficiency scoring, in candidate orders per second
+
+    $ python benchmarks/efficiency_benchmark.py --trials 200 --categories 4
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from stim_randomizer.core import ExPrerands
+from stim_randomizer.efficiency import design_efficiency, trial_onsets
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--trials', type=int, default=200, help='trials per candidate order')
+    parser.add_argument('--categories', type=int, default=4, help='number of categories')
+    parser.add_argument('--batch-size', type=int, default=250, help='candidates scored together')
+    parser.add_argument('--batches', type=int, default=8, help='number of batches to time')
+    parser.add_argument('--tr', type=float, default=2.0, help='repetition time, in seconds')
+    parser.add_argument('--soa', type=float, nargs='+', default=[3.0, 4.0, 5.0],
+                        help='time between trials, in seconds. Several values give jittered schedules')
+
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    elements = args.trials // args.categories
+    batches = [(ExPrerands._blocked_label_matrix(args.categories, elements, args.batch_size, 1, rng),
+                trial_onsets(args.soa, args.batch_size, args.categories * elements, rng))
+               for _ in range(args.batches)]
+
+    # Warm up the FFT plans
+    design_efficiency(*batches[0], args.categories, args.tr)
+
+    start = time.perf_counter()
+
+    for label_matrix, onsets in batches:
+        design_efficiency(label_matrix, onsets, args.categories, args.tr)
+
+    elapsed = time.perf_counter() - start
+    scored = args.batches * args.batch_size
+
+    print('{0} candidates of {1} trials in {2:.2f} s: {3:.0f} candidates/s'.format(scored, args.categories * elements,
+                                                                                  elapsed, scored / elapsed))
+
+
+if __name__ == '__main__':
+    main()
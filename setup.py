@@ -0,0 +1,15 @@
+from setuptools import setup, find_packages
+
+setup(
+    name='stim_randomizer',
+    version='0.1.0',
+    description='Divide experimental stimuli into subsets and constrained prerandomizations',
+    author='Juan Jesus Torre Tresols',
+    author_email='juanjesustorre@gmail.com',
+    packages=find_packages(exclude=['tests']),
+    install_requires=['numpy', 'pandas'],
+    extras_require={'toml': ['tomli; python_version < "3.11"']},
+    entry_points={
+        'console_scripts': ['stim-randomizer=stim_randomizer.cli:main'],
+    },
+)
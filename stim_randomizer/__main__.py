@@ -0,0 +1,5 @@
+import sys
+
+from stim_randomizer.cli import main
+
+sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Batch processing of many stimulus banks across a pool of worker processes
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import os
+import random
+import time
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from stim_randomizer.core import ExpStim
+
+
+def bank_seed(seed: int, index: int) -> int:
+    """
+    Derive the seed of one bank of a batch from the seed of the whole batch
+
+    Parameters
+    ----------
+
+    seed: int
+          seed of the batch
+
+    index: int
+           position of the bank in the batch
+
+    Returns
+    -------
+
+    bank_seed: int
+               seed of the bank. It only depends on seed and index, so it does not change with the number of
+               workers or the order in which the banks finish
+    """
+
+    return int(np.random.SeedSequence([seed, index]).generate_state(1)[0])
+
+
+def run_bank(bank: dict) -> dict:
+    """
+    Create the subsets and prerands requested for a single bank
+
+    If the bank has a 'seed', it seeds the subset shuffling and is used as the prerand seed, unless the
+    'prerands' table has its own
+
+    Parameters
+    ----------
+
+    bank: dict
+          one of the entries of the job 'banks' list
+
+    Returns
+    -------
+
+    result: dict
+            'path' of the bank, 'status' ('ok' or 'failed'), 'error' message if it failed, 'seed' and 'elapsed'
+            seconds
+    """
+
+    start = time.perf_counter()
+    dir_type = bank.get('dir_type', 'parent')
+    seed = bank.get('seed')
+
+    try:
+        experiment = ExpStim(bank['path'], bank.get('categories'))
+
+        if seed is not None:
+            random.seed(seed)
+
+        if 'subsets' in bank:
+            subsets = dict(bank['subsets'])
+            set_number = subsets.pop('set_number')
+
+            experiment.request_subsets(set_number, dir_type, **subsets)
+
+        if 'prerands' in bank:
+            prerands = dict(bank['prerands'])
+            prerand_number = prerands.pop('prerand_number')
+
+            if seed is not None:
+                prerands.setdefault('seed', seed)
+
+            experiment.request_prerands(prerand_number, dir_type=dir_type, **prerands)
+
+    except Exception as err:
+        status, error = 'failed', '{0}: {1}'.format(type(err).__name__, err)
+    else:
+        status, error = 'ok', None
+
+    return {'path': bank['path'], 'status': status, 'error': error, 'seed': seed,
+            'elapsed': time.perf_counter() - start}
+
+
+def run_batch(banks: list, workers: int or None = None, seed: int or None = None) -> dict:
+    """
+    Process many stimulus banks at once, one bank per worker process. A bank that fails is reported in the results
+    and does not stop the others
+
+    Parameters
+    ----------
+
+    banks: list
+           each element is either a bank dict, as in the job files of the command line, or a (path, parameters)
+           tuple where parameters is a dict with the rest of the bank entries
+
+    workers: int or None, default: None
+             number of worker processes. Defaults to the number of CPUs
+
+    seed: int or None, default: None
+          seed of the batch. Each bank without a 'seed' of its own gets one derived from this seed and its
+          position in banks, so the whole batch can be reproduced
+
+    Returns
+    -------
+
+    report: dict
+            'banks' with the result of each bank as returned by run_bank, in the order of banks, the number of
+            banks that were 'ok' and 'failed', the summed 'elapsed' seconds of every bank and the 'wall_time' of
+            the whole batch
+    """
+
+    start = time.perf_counter()
+    jobs = []
+
+    for index, bank in enumerate(banks):
+        if not isinstance(bank, dict):
+            path, parameters = bank
+            bank = dict(parameters, path=path)
+        else:
+            bank = dict(bank)
+
+        if seed is not None and bank.get('seed') is None:
+            bank['seed'] = bank_seed(seed, index)
+
+        jobs.append(bank)
+
+    workers = min(workers or os.cpu_count(), len(jobs)) or 1
+    results = []
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_bank, bank) for bank in jobs]
+
+        for bank, future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception as err:
+                # The worker process itself died, e.g. killed by the OS
+                results.append({'path': bank['path'], 'status': 'failed', 'seed': bank.get('seed'),
+                                'error': '{0}: {1}'.format(type(err).__name__, err), 'elapsed': 0.0})
+
+    failed = sum(result['status'] != 'ok' for result in results)
+
+    return {'banks': results,
+            'ok': len(results) - failed,
+            'failed': failed,
+            'elapsed': sum(result['elapsed'] for result in results),
+            'wall_time': time.perf_counter() - start}
@@ -0,0 +1,138 @@
+"""
+Command line entry point to process many stimulus banks from a single job file
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from stim_randomizer.batch import run_batch
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+
+def load_job(job_path: str) -> dict:
+    """
+    Read a job file in JSON or TOML format. The format is chosen from the file extension
+
+    The job holds a 'banks' list, where each bank is a table with a 'path' to the stimuli and, optionally,
+    'categories', 'dir_type', a 'subsets' table with the arguments of ExpStim.request_subsets and a 'prerands'
+    table with the arguments of ExpStim.request_prerands, and a 'seed'. Relative bank paths are taken from the
+    directory of the job file. An optional top-level 'workers' sets the size of the worker pool, and a top-level
+    'seed' gives every bank without its own seed a reproducible one
+
+    Parameters
+    ----------
+
+    job_path: str
+              path to the .json or .toml job file
+
+    Returns
+    -------
+
+    job: dict
+         parsed job, with absolute bank paths
+    """
+
+    if job_path.endswith('.toml'):
+        if tomllib is None:
+            raise ImportError('Reading TOML job files requires Python >= 3.11 or the "tomli" package')
+
+        with open(job_path, 'rb') as job_file:
+            job = tomllib.load(job_file)
+
+    else:
+        with open(job_path) as job_file:
+            job = json.load(job_file)
+
+    if not job.get('banks'):
+        raise ValueError("The job file '{0}' does not list any banks".format(job_path))
+
+    job_dir = os.path.dirname(os.path.abspath(job_path))
+
+    for bank in job['banks']:
+        if 'path' not in bank:
+            raise ValueError("Every bank in the job file needs a 'path'")
+
+        bank['path'] = os.path.join(job_dir, bank['path'])
+
+    return job
+
+
+def run_job(job: dict, workers: int or None = None) -> list:
+    """
+    Run every bank of a job, sharing a pool of worker processes
+
+    Parameters
+    ----------
+
+    job: dict
+         job as returned by load_job
+
+    workers: int or None, default: None
+             size of the worker pool. Defaults to the job's 'workers' entry, or to the number of CPUs
+
+    Returns
+    -------
+
+    results: list of dict
+             one result per bank, as returned by run_bank, in the order of the job file
+    """
+
+    workers = workers or job.get('workers')
+
+    return run_batch(job['banks'], workers, job.get('seed'))['banks']
+
+
+def main(argv: list or None = None) -> int:
+    """
+    Entry point of the stim-randomizer command
+
+    Parameters
+    ----------
+
+    argv: list or None, default: None
+          command line arguments. sys.argv is used if None
+
+    Returns
+    -------
+
+    exit_code: int
+               0 if every bank succeeded, 1 otherwise
+    """
+
+    parser = argparse.ArgumentParser(prog='stim-randomizer',
+                                     description='Create subsets and prerandomizations for the stimulus banks '
+                                                 'listed in a JSON or TOML job file')
+    parser.add_argument('job', help='path to the .json or .toml job file')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of banks processed concurrently')
+
+    args = parser.parse_args(argv)
+
+    results = run_job(load_job(args.job), args.workers)
+
+    for result in results:
+        line = '{0:<7}{1:8.2f}s  {2}'.format(result['status'], result['elapsed'], result['path'])
+
+        if result['error']:
+            line += '  ({0})'.format(result['error'])
+
+        print(line)
+
+    return int(any(result['status'] != 'ok' for result in results))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,12 +8,26 @@ Mail: juanjesustorre@gmail.com
 
 import csv
 import glob
+import hashlib
+import heapq
+import json
 import os
+import shutil
 
 import numpy as np
 import pandas as pd
 
-from random import shuffle, choices
+from collections import deque
+from functools import partial
+from random import shuffle
+
+from stim_randomizer.efficiency import design_efficiency, trial_onsets
+from stim_randomizer.hashing import hash_files, load_cache, save_cache
+from stim_randomizer.metadata import StimMetadata, load_metadata, stratum_codes
+from stim_randomizer.progress import ProgressTracker
+from stim_randomizer.results import PrerandResult, SessionSchedule, SubsetResult
+from stim_randomizer.sources import DirectorySource, as_source
+from stim_randomizer.store import ResultStore
 
 
 class ExpStim:
@@ -24,17 +38,30 @@ class ExpStim:
     Parameters
     ----------
 
-    path: str
-          assign directory attribute
+    path: str, list or StimSource
+          directory with the stim files, a zip/tar archive of them, a list of stim names to work in memory only,
+          or any StimSource
 
     categories: list of str, default: None
                 list with the names of the categories in the stim. It defaults to None
 
+    metadata: str or dict, default: None
+              optional metadata table (csv, tsv or parquet sidecar, or columns in memory) with one row per stim file
+
+    metadata_key: str, default: 'filename'
+                  column of the metadata table with the stim filenames
+
+    store: str, ResultStore or None, default: None
+           SQLite store, or the path of one, where subsets, prerands and session plans are also saved
+
     Attributes
     ----------
 
-    path: str
-          absolute path containing the stimuli
+    path: str or None
+          absolute path containing the stimuli. None for in-memory stim
+
+    source: StimSource
+            where the stim are listed from and where the results are written to
 
     categories: list
                 names of the categories of the files. The object will look for category names on the given path
@@ -46,24 +73,60 @@ class ExpStim:
     prerands: ExpRands object
               wrapper for subset information. It is initialized as None until creation is requested
 
+    metadata: StimMetadata or None
+              columnar metadata of the stim files, joined on their filenames. None if no metadata was given
+
+    hashes: dict or None
+            BLAKE2b digest of each stim file, embedded in the subset and prerand files. None until compute_hashes
+            is called
+
+    store: ResultStore or None
+           SQLite store where subsets, prerands and session plans are also saved
+
 
     """
 
-    def __init__(self, path: str, categories: list or None = None) -> None:
+    def __init__(self, path: str, categories: list or None = None, metadata: str or dict or None = None,
+                 metadata_key: str = 'filename', store: str or ResultStore or None = None) -> None:
 
         self.subsets = None
         self.prerands = None
-        self.path = path
+        self.source = as_source(path)
+        self.path = self.source.path
 
         if categories:
             self.categories = sorted(categories)
         else:
             self.categories = self._scan_categories()
 
+        if metadata is not None:
+            self.metadata = StimMetadata(metadata, self._stim_files(), metadata_key)
+        else:
+            self.metadata = None
+
+        self.store = ResultStore(store) if isinstance(store, str) else store
+
+        self.hashes = None
+        self._hash_cache = {}
+        self._hash_cache_path = None
+
+    def _stim_files(self) -> list:
+        """
+        List the stim files of the source, leaving out any directory (such as 'child' output directories)
+
+        Returns
+        -------
+
+        stim_files: list of str
+                    sorted names of the stim files
+        """
+
+        return self.source.names()
+
     def _scan_categories(self) -> list or None:
         """
-        Looks for categories in self.path and returns a list with the categories found, or None if it does not find
-        any
+        Looks for categories in the stim filenames and returns a list with the categories found, or None if it does not
+        find any
 
         Returns
         -------
@@ -73,7 +136,7 @@ class ExpStim:
                     "[category]_[number]" fashion
         """
 
-        all_files = os.listdir(self.path)
+        all_files = self._stim_files()
 
         categories = list(set([file.split("_")[0] for file in all_files]))
 
@@ -82,9 +145,85 @@ class ExpStim:
 
         return categories
 
-    def request_subsets(self, set_number: int, dir_type: str = 'parent') -> None:
+    def compute_hashes(self, workers: int or None = None, cache_path: str or None = None) -> dict:
+        """
+        Hash the content of every stim file with BLAKE2b, using a pool of threads. Digests are cached by file size
+        and modification time, so only new or modified files are read again on later calls. Once computed, the
+        digests are written next to the filenames in the subset and prerand files
+
+        Parameters
+        ----------
+
+        workers: int or None, default: None
+                 number of threads hashing files
+
+        cache_path: str or None, default: None
+                    json file to keep the cache in between sessions. If None, the cache only lives in this object
+
+        Returns
+        -------
+
+        hashes: dict
+                filenames as keys and hexadecimal digests as values
+        """
+
+        if not isinstance(self.source, DirectorySource):
+            raise ValueError('Only stim files in a directory can be hashed')
+
+        if cache_path is not None:
+            self._hash_cache = load_cache(cache_path)
+            self._hash_cache_path = cache_path
+
+        stim_files = self._stim_files()
+        hash_files(self.path, stim_files, self._hash_cache, workers)
+
+        if self._hash_cache_path is not None:
+            save_cache(self._hash_cache_path, self._hash_cache)
+
+        self.hashes = {file: self._hash_cache[file][2] for file in stim_files}
+
+        return self.hashes
+
+    def verify(self, workers: int or None = None) -> list:
+        """
+        Check that the stim files still have the content hashed by compute_hashes. Only files whose size or
+        modification time changed since they were last hashed are read again
+
+        Parameters
+        ----------
+
+        workers: int or None, default: None
+                 number of threads hashing files
+
+        Returns
+        -------
+
+        changed: list of str
+                 sorted names of the hashed files that were modified or removed
+        """
+
+        if self.hashes is None:
+            raise ValueError('There are no hashes to verify against. Call compute_hashes first')
+
+        stim_files = set(self._stim_files())
+        present = [file for file in self.hashes if file in stim_files]
+        missing = [file for file in self.hashes if file not in stim_files]
+
+        rehashed = hash_files(self.path, present, self._hash_cache, workers)
+
+        if rehashed and self._hash_cache_path is not None:
+            save_cache(self._hash_cache_path, self._hash_cache)
+
+        changed = [file for file in rehashed if self._hash_cache[file][2] != self.hashes[file]]
+
+        return sorted(missing + changed)
+
+    def request_subsets(self, set_number: int, dir_type: str = 'parent', strata: list or None = None,
+                        bins: dict or None = None, write: bool = True, progress: 'callable' = None,
+                        cancel: 'threading.Event' = None) -> None:
         """
-        Create an ExpSets() object and then calls create_subsets
+        Create an ExpSets() object and then calls create_subsets, or create_stratified_subsets if strata are
+        given
 
         Parameters
         ----------
@@ -95,18 +234,44 @@ class ExpStim:
         dir_type: {'parent', 'child'}, default: parent
                   required parameter for the ExpSets class
 
+        strata: list of str or None, default: None
+                metadata columns to balance the subsets on. Requires the object to have metadata
+
+        bins: dict or None, default: None
+              number of quantile bins for each numerical column in strata
+
+        write: bool, default: True
+               whether to write the subset files. If False, the subsets are only kept in self.subsets.result
+
+        progress: callable or None, default: None
+                  progress callback, passed to create_subsets
+
+        cancel: threading.Event or None, default: None
+                cancellation token, passed to create_subsets
+
         Returns
         -------
 
         None
         """
 
-        self.subsets = ExpSets(self.path, dir_type)
-        self.subsets.create_subsets(set_number, self.categories)
+        self.subsets = ExpSets(self.source, dir_type, self.hashes, self.store, write)
 
-    def request_prerands(self, prerand_number: int, method: str = 'pseudo_con', dir_type: str = 'parent') -> None:
+        if strata:
+            if self.metadata is None:
+                raise ValueError('Stratified subsets need the ExpStim object to be created with metadata')
+
+            self.subsets.create_stratified_subsets(set_number, self.metadata, strata, bins, progress=progress,
+                                                   cancel=cancel)
+        else:
+            self.subsets.create_subsets(set_number, self.categories, progress=progress, cancel=cancel)
+
+    def request_prerands(self, prerand_number: int, method: str = 'pseudo_con', dir_type: str = 'parent',
+                         seed: int or None = None, chunk_size: int or None = None, write: bool = True,
+                         **method_options) -> None:
         """
-        Create an ExPrerands() object and call create_prerands
+        Create an ExPrerands() object and call create_prerands. If subsets were requested before, they are handed
+        over in memory, so the subset files are never read back
 
         Parameters
         ----------
@@ -114,12 +279,25 @@ class ExpStim:
         prerand_number: int
                         desired number of prerands
 
-        method: {'unconstrained', 'pseudo_con', 'pure_con'}
+        method: {'unconstrained', 'pseudo_con', 'pure_con', 'blocked', 'repeated', 'transition_balanced'}
                 required parameter for the ExPrerands class
 
         dir_type: {'parent', 'child'}, default: parent
                   required parameter for the ExpSets class
 
+        seed: int or None, default: None
+              seed for the prerandomizations, passed to create_prerands
+
+        chunk_size: int or None, default: None
+                    number of prerands per checkpointed chunk, passed to create_prerands
+
+        write: bool, default: True
+               whether to write the prerand files. If False, the prerands are only kept in self.prerands.results
+
+        method_options: dict
+                        extra arguments passed to create_prerands, e.g. block_length for 'blocked', or the progress
+                        callback and cancel token
+
         Returns
         -------
 
@@ -127,11 +305,113 @@ class ExpStim:
         """
 
         if self.subsets:
-            self.prerands = ExPrerands(self.path, self.subsets.out_dir, dir_type)
+            self.prerands = ExPrerands(self.source, self.subsets.result, dir_type, self.hashes, self.store, write)
+        else:
+            self.prerands = ExPrerands(self.source, None, dir_type, self.hashes, self.store, write)
+
+        self.prerands.create_prerands(prerand_number, self.categories, method, seed=seed, chunk_size=chunk_size,
+                                      **method_options)
+
+    def plan_sessions(self, participants: int, sessions: int, method: str = 'pseudo_con', dir_type: str = 'parent',
+                      seed: int or None = None, out_path: str or None = None) -> SessionSchedule:
+        """
+        Plan a multi-session study where no participant sees the same stim twice.
+
+        The stim of each category are shuffled and dealt in equal parts to one subset per session. The subsets are
+        only kept in the schedule: self.subsets is left as is and no subset files are written. Each participant
+        goes through
+        every subset once, in an order that rotates across participants, so that every subset is used equally
+        often in every session. The trial orders of all participants and sessions are then drawn together: the
+        category sequences and the within-category orders of the whole (participants, sessions) batch are array
+        operations (see ExPrerands._blocked_label_matrix, with blocks of a single trial, and
+        ExPrerands._within_category_random_matrix).
+
+        Parameters
+        ----------
+
+        participants: int
+                      number of participants
+
+        sessions: int
+                  number of sessions per participant
+
+        method: {'unconstrained', 'pseudo_con', 'pure_con'}, default: 'pseudo_con'
+                constraint of the trial orders, as in ExPrerands.create_prerands
+
+        dir_type: {'parent', 'child'}, default: parent
+                  not used anymore, as no subset files are written. Kept so that the arguments after it keep their
+                  positions
+
+        seed: int or None, default: None
+              seed for the random generator. The same seed gives the same schedule
+
+        out_path: str or None, default: None
+                  if given, the schedule is also saved in this .npz file. It is always saved in the store, if the
+                  object has one
+
+        Returns
+        -------
+
+        schedule: SessionSchedule
+                  (participants, sessions, trials) tensor of stim, with the subset of each session
+        """
+
+        rng = np.random.default_rng(seed)
+
+        names = np.array(self.source.names())
+        cat_list = self.categories
+        stim_labels = ExPrerands._category_labels(cat_list, names)
+        counts = np.bincount(stim_labels, minlength=len(cat_list))
+
+        if (counts % sessions).any():
+            raise ValueError("It is not possible to equally divide the stim of every category into '{0}' "
+                             "sessions".format(sessions))
+
+        # Stim of each subset, grouped by category as the label mappers number them. Each category is shuffled
+        # and split in one equal part per session
+        by_category = np.lexsort((rng.random(len(names)), stim_labels))
+        members = np.concatenate([block.reshape(sessions, -1)
+                                  for block in np.split(by_category, np.cumsum(counts)[:-1])], axis=1)
+
+        subset_order = rng.permutation(sessions)
+        subsets = subset_order[(np.arange(sessions)[None, :] + np.arange(participants)[:, None]) % sessions]
+
+        batch = participants * sessions
+        trials = members.shape[1]
+        labels = len(cat_list)
+
+        if method == 'unconstrained':
+            positions = np.argsort(rng.random((batch, trials)), axis=1)
+
         else:
-            self.prerands = ExPrerands(self.path, self.subsets, dir_type)
+            if method == 'pseudo_con':
+                label_matrix = ExPrerands._blocked_label_matrix(labels, trials // labels, batch, 1, rng)
+            elif method == 'pure_con':
+                # Same weighted draws as _pure_label_mapper, without the need for an ExPrerands object
+                label_matrix = np.array([ExPrerands._constrained_label_sampler([trials // labels] * labels, rng)
+                                         for _ in range(batch)])
+            else:
+                raise ValueError("method argument must be 'unconstrained', 'pseudo_con' or 'pure_con'")
+
+            positions = ExPrerands._within_category_random_matrix(label_matrix, rng)
 
-        self.prerands.create_prerands(prerand_number, self.categories, method)
+        positions = positions.reshape(participants, sessions, trials)
+        indices = members[subsets[:, :, None], positions]
+
+        schedule = SessionSchedule(names, indices, subsets)
+
+        if out_path is not None:
+            schedule.save(out_path)
+
+        if self.store is not None:
+            run = self.store.start_run('schedule', {'participants': participants,
+                                                    'sessions': sessions,
+                                                    'method': method,
+                                                    'seed': seed,
+                                                    'stim': ExPrerands._subset_digest(names)})
+            self.store.write_schedule(run, schedule)
+
+        return schedule
 
 
 class ExpSets:
@@ -143,32 +423,61 @@ class ExpSets:
     Parameters
     ----------
 
-    root_path: str
-               absolute path to the directory that contains the stim files
+    root_path: str, list or StimSource
+               absolute path to the directory that contains the stim files, or any other stim source accepted by
+               ExpStim
 
     dir_type: {'parent', 'child'}
               handles where to create the output directory with the helper
               method _get_dir
 
+    hashes: dict or None, default: None
+            content digest of each stim file. If given, it is written in a second column next to each filename
+
+    store: str, ResultStore or None, default: None
+           SQLite store, or the path of one, where the results are also saved
+
+    write: bool, default: True
+           whether to write the results to disk. If False, there is no out_dir and the results are only kept in
+           memory (and in the store)
+
     Attributes
     ----------
 
-    root_path: str
-               absolute path to the stim files
+    root_path: str or None
+               absolute path to the stim files. None for in-memory stim
+
+    source: StimSource
+            where the stim are listed from and where the results are written to
 
     dir_type: {'parent', 'child'}
               type of out_dir generation
 
-    out_dir: str
-             absolute path to the files containing the subset info
+    hashes: dict or None
+            content digest of each stim file, written next to the filenames
+
+    store: ResultStore or None
+           SQLite store where the results are also saved
+
+    out_dir: str or None
+             absolute path to the files containing the subset info. None if the results are only kept in memory
+
+    result: SubsetResult or None
+            the last subsets created, kept in memory as indices into the stim filenames. None until subsets are
+            created
     """
 
-    def __init__(self, root_path: str, dir_type: str) -> None:
-        self.root_path = root_path
+    def __init__(self, root_path: str, dir_type: str, hashes: dict or None = None,
+                 store: str or ResultStore or None = None, write: bool = True) -> None:
+        self.source = as_source(root_path)
+        self.root_path = self.source.path
         self.dir_type = dir_type
-        self.out_dir = self._get_dir(self.dir_type)
+        self.hashes = hashes
+        self.store = ResultStore(store) if isinstance(store, str) else store
+        self.out_dir = self._get_dir(self.dir_type, write)
+        self.result = None
 
-    def _get_dir(self, dir_type: str) -> str:
+    def _get_dir(self, dir_type: str, write: bool = True) -> str or None:
         """
         Check desired dir_type and create out_dir where requested
 
@@ -179,28 +488,31 @@ class ExpSets:
                   'parent' creates the 'subsets' folder in the parent dir
                   of the root dir, and 'child' creates it inside the root dir
 
+        write: bool, default: True
+               whether results are written to disk at all
+
         Returns
         -------
 
-        out_dir: str
-                 absolute path of the output directory
+        out_dir: str or None
+                 absolute path of the output directory, or None if results are only kept in memory
         """
 
-        if dir_type == 'parent':
-            out_dir = os.path.join(self.root_path,
-                                   '../subsets')
-        elif dir_type == 'child':
-            out_dir = os.path.join(self.root_path,
-                                   'subsets')
-        else:
+        if dir_type not in ('parent', 'child'):
             raise ValueError('dir_type must be either "parent" or "child"')
 
-        if not os.path.exists(out_dir):
+        if not write:
+            return None
+
+        out_dir = self.source.output_dir(dir_type, 'subsets')
+
+        if out_dir is not None and not os.path.exists(out_dir):
             os.mkdir(out_dir)
 
         return out_dir
 
-    def create_subsets(self, set_num: int, categories: list or None) -> None:
+    def create_subsets(self, set_num: int, categories: list or None, progress: 'callable' = None,
+                       cancel: 'threading.Event' = None) -> None:
         """
         Method to create subsets. The subsets will be csv files containing
         names of the files from self.root_path. Each subset will contain the
@@ -218,13 +530,23 @@ class ExpSets:
                     names of the categories passed from the ExpStim class,
                     if any
 
+        progress: callable or None, default: None
+                  called with a progress report after each subset is made, see ProgressTracker.advance
+
+        cancel: threading.Event or None, default: None
+                cancellation token, checked before each subset is made. Once set, the method raises
+                GenerationCancelled, and out_dir, result and the store keep the subsets of the previous run
+
         Returns
         -------
 
         None
         """
 
-        total_stim = sorted([file for file in os.listdir(self.root_path) if 'subsets' not in file])
+        tracker = ProgressTracker(set_num, progress, cancel)
+        tracker.check()
+
+        total_stim = self.source.names()
 
         if len(total_stim) % set_num != 0:
             remaining_stim = len(total_stim) % set_num
@@ -270,17 +592,166 @@ class ExpSets:
             for i, subset in enumerate(subsets.keys()):
                 subsets[subset].extend(cat_chunks[i])
 
-            # Save the subsets in files
+        # Save the subsets in files
+        self._write_subsets(subsets, SubsetResult.from_lists(np.array(total_stim), list(subsets.values())), tracker)
+
+    def _write_subsets(self, subsets: dict, result: SubsetResult, tracker: ProgressTracker = None) -> None:
+        """
+        Save each subset in a tsv file inside out_dir, one filename per row, and in the store if there is one.
+        Nothing is written to disk if there is no out_dir. Every file is written to a temporary file first, and
+        they are only renamed once all of them are done, so out_dir either keeps the subsets of the previous run
+        or gets the whole new ones. Subset files left by a previous run with more subsets are removed
+
+        Parameters
+        ----------
+
+        subsets: dict
+                 subset names as keys and lists of filenames as values
+
+        result: SubsetResult
+                the same subsets, kept in result once they are saved
+
+        tracker: ProgressTracker, default: None
+                 progress of the request, checked for cancellation before each subset
+
+        Returns
+        -------
+
+        None
+        """
+
+        staged = []
+
+        try:
             for subset in subsets.keys():
 
-                subsets_path = os.path.join(self.out_dir, subset + '.tsv')
+                if tracker is not None:
+                    tracker.check()
+
+                if self.out_dir is not None:
+                    subsets_path = os.path.join(self.out_dir, subset + '.tsv')
+                    staged.append(subsets_path)
+
+                    with open(subsets_path + '.part', 'w') as csvfile:
+
+                        subsetwriter = csv.writer(csvfile, delimiter='\t')
+
+                        for stim in subsets[subset]:
+                            if self.hashes:
+                                subsetwriter.writerow([stim, self.hashes[stim]])
+                            else:
+                                subsetwriter.writerow([stim])
+
+                if tracker is not None:
+                    tracker.advance(1)
+
+        except BaseException:
+            for subsets_path in staged:
+                if os.path.exists(subsets_path + '.part'):
+                    os.remove(subsets_path + '.part')
+
+            raise
+
+        for subsets_path in staged:
+            os.replace(subsets_path + '.part', subsets_path)
+
+        if self.out_dir is not None:
+            for subsets_path in glob.glob(os.path.join(glob.escape(self.out_dir), 'subset_*.tsv')):
+                if os.path.basename(subsets_path)[:-len('.tsv')] not in subsets:
+                    os.remove(subsets_path)
+
+        self.result = result
+
+        if self.store is not None:
+            run = self.store.start_run('subsets', {'subsets': [ExPrerands._subset_digest(result.to_names(subset))
+                                                               for subset in range(len(result))]})
+            self.store.write_subsets(run, self.result)
+
+    def create_stratified_subsets(self, set_num: int, metadata: str or dict, strata: list,
+                                  bins: dict or None = None, key: str = 'filename', seed: int or None = None,
+                                  progress: 'callable' = None, cancel: 'threading.Event' = None) -> None:
+        """
+        Method to create subsets balanced on several stimulus attributes at once, taken from a metadata table.
+
+        The attributes in strata are combined into strata (numerical ones are first cut into quantile bins).
+        The stimuli are then sorted by stratum, shuffled within each stratum, and dealt to the subsets in turns,
+        carrying on from one stratum to the next. This way every stratum is split as evenly as possible, and
+        the subset sizes never differ by more than one file, even when the strata do not divide evenly.
+
+        If 'category' is in strata but not in the metadata, it is taken from the "[category]_[number]" filenames.
+
+        Parameters
+        ----------
+
+        set_num: int
+                 desired number of sets
+
+        metadata: str or dict
+                  path to a csv/tsv/parquet metadata table, or the table already loaded with
+                  stim_randomizer.metadata.load_metadata
+
+        strata: list of str
+                metadata columns to balance the subsets on
+
+        bins: dict or None, default: None
+              number of quantile bins for each numerical column in strata
+
+        key: str, default: 'filename'
+             metadata column with the stimulus filenames
+
+        seed: int or None, default: None
+              seed for the random generator
+
+        progress: callable or None, default: None
+                  called with a progress report after each subset is made, see ProgressTracker.advance
+
+        cancel: threading.Event or None, default: None
+                cancellation token, checked before each subset is made, as in create_subsets
+
+        Returns
+        -------
+
+        None
+        """
+
+        tracker = ProgressTracker(set_num, progress, cancel)
+        tracker.check()
+
+        columns = load_metadata(metadata, key)
+
+        total_stim = np.array(self.source.names())
+
+        # Join the metadata rows on the stim filenames
+        rows = pd.Index(columns[key]).get_indexer(total_stim)
+
+        if (rows == -1).any():
+            missing = total_stim[rows == -1]
+            raise ValueError("'{0}' stim files have no metadata, e.g. '{1}'".format(len(missing), missing[0]))
+
+        columns = {name: values[rows] for name, values in columns.items()}
+
+        if 'category' in strata and 'category' not in columns:
+            columns['category'] = np.array([file.split('_')[0] for file in total_stim])
+
+        rng = np.random.default_rng(seed)
+
+        codes = stratum_codes(columns, strata, bins)
+
+        # Visit the strata in random order, and shuffle the stim inside each one
+        stratum_order = rng.permutation(codes.max() + 1)[codes]
+        order = np.lexsort((rng.random(len(total_stim)), stratum_order))
+
+        assignment = np.empty(len(total_stim), dtype=int)
+        assignment[order] = (np.arange(len(total_stim)) + rng.integers(set_num)) % set_num
 
-                with open(subsets_path, 'w') as csvfile:
+        by_subset = np.argsort(assignment, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=set_num))])
 
-                    subsetwriter = csv.writer(csvfile)
+        result = SubsetResult(total_stim, by_subset, offsets)
 
-                    for stim in subsets[subset]:
-                        subsetwriter.writerow([stim])
+        subsets = {"subset_" + str(i + 1): list(result.to_names(i)) for i in range(set_num)}
+
+        self._write_subsets(subsets, result, tracker)
 
 
 class ExPrerands:
@@ -292,40 +763,72 @@ class ExPrerands:
     Parameters
     ----------
 
-    root_path: str
-               absolute path to the directory that contains the stim files
+    root_path: str, list or StimSource
+               absolute path to the directory that contains the stim files, or any other stim source accepted by
+               ExpStim
 
-    subsets_path: str or None
-                  absolute path to the directory that contains the subset files
+    subsets_path: str, SubsetResult or None
+                  absolute path to the directory that contains the subset files, or the subsets themselves
 
     dir_type: {'parent', 'child'}
               handles where to create the output directory with the helper
               method _get_dir
 
+    hashes: dict or None, default: None
+            content digest of each stim file. If given, it is written in a second column next to each filename
+
+    store: str, ResultStore or None, default: None
+           SQLite store, or the path of one, where the results are also saved
+
+    write: bool, default: True
+           whether to write the results to disk. If False, there is no out_dir and the results are only kept in
+           memory (and in the store)
+
     Attributes
     ----------
 
-    root_path: str
-               absolute path to the stim files
+    root_path: str or None
+               absolute path to the stim files. None for in-memory stim
 
-    subsets_path: str or None
-                  absolute path to the directory that contains the subset files
+    source: StimSource
+            where the stim are listed from and where the results are written to
+
+    subsets_path: str, SubsetResult or None
+                  absolute path to the directory that contains the subset files, or the subsets themselves
 
     dir_type: {'parent', 'child'}
               handles where to create the output directory with the helper
               method _get_dir
 
-    out_dir: str
-             absolute path to the files containing the prerand info
+    hashes: dict or None
+            content digest of each stim file, written next to the filenames
+
+    store: ResultStore or None
+           SQLite store where the results are also saved
+
+    out_dir: str or None
+             absolute path to the files containing the prerand info. None if the results are only kept in memory
+
+    results: list of PrerandResult
+             prerands of each subset created by the last call to create_prerands, as index matrices sharing
+             one array of filenames. Empty until prerands are created
     """
 
-    def __init__(self, root_path: str, subsets_path: str or None, dir_type: str) -> None:
-        self.root_path = root_path
+    manifest_name = '.prerands_manifest.json'
+    shard_manifest_name = '.prerands_manifest.shard_{0}_of_{1}.json'
+
+    def __init__(self, root_path: str, subsets_path: str or None, dir_type: str, hashes: dict or None = None,
+                 store: str or ResultStore or None = None, write: bool = True) -> None:
+        self.source = as_source(root_path)
+        self.root_path = self.source.path
         self.subsets_path = subsets_path
         self.dir_type = dir_type
-        self.out_dir = self._get_dir(self.dir_type)
+        self.hashes = hashes
+        self.store = ResultStore(store) if isinstance(store, str) else store
+        self.out_dir = self._get_dir(self.dir_type, write)
+        self.results = []
 
-    def _get_dir(self, dir_type: str) -> str:
+    def _get_dir(self, dir_type: str, write: bool = True) -> str or None:
         """
         Check desired dir_type and create out_dir where requested
 
@@ -336,23 +839,25 @@ class ExPrerands:
                   'parent' creates the 'prerands' folder in the parent dir
                   of the root dir, and 'child' creates it inside the root dir
 
+        write: bool, default: True
+               whether results are written to disk at all
+
         Returns
         -------
 
-        out_dir: str
-                 absolute path of the output directory
+        out_dir: str or None
+                 absolute path of the output directory, or None if results are only kept in memory
         """
 
-        if dir_type == 'parent':
-            out_dir = os.path.join(self.root_path,
-                                   '../prerands')
-        elif dir_type == 'child':
-            out_dir = os.path.join(self.root_path,
-                                   'prerands')
-        else:
+        if dir_type not in ('parent', 'child'):
             raise ValueError('dir_type must be either "parent" or "child"')
 
-        if not os.path.exists(out_dir):
+        if not write:
+            return None
+
+        out_dir = self.source.output_dir(dir_type, 'prerands')
+
+        if out_dir is not None and not os.path.exists(out_dir):
             os.mkdir(out_dir)
 
         return out_dir
@@ -377,21 +882,26 @@ class ExPrerands:
 
         parsed_files = []
 
-        # subsets = sorted(os.listdir(subsets_path))
-        subsets = glob.glob(os.path.join(subsets_path, '*'))
+        # subset_N.tsv files only, in the order of N, so that subset 10 comes after subset 9 and leftover .part
+        # files of an interrupted write are ignored
+        subsets = {}
+
+        for subset_path in glob.glob(os.path.join(glob.escape(subsets_path), 'subset_*.tsv')):
+            number = os.path.basename(subset_path)[len('subset_'):-len('.tsv')]
 
-        for subset in subsets:
-            subset_path = os.path.join(subsets_path, subset)
+            if number.isdigit():
+                subsets[int(number)] = subset_path
 
-            stim_df = pd.read_csv(subset_path, header=None, sep='\t', engine='python')
-            stim_list = [stim for stim in stim_df[0]]
+        for _, subset_path in sorted(subsets.items()):
+            with open(subset_path) as csvfile:
+                stim_list = [row[0] for row in csv.reader(csvfile, delimiter='\t') if row]
 
             parsed_files.append(stim_list)
 
         return parsed_files
 
     @staticmethod
-    def _pseudo_label_mapper(labels: int, elements: int) -> 'np.array':
+    def _pseudo_label_mapper(labels: int, elements: int or list, rng: 'np.random.Generator' = None) -> 'np.array':
         """
         Creates an array of len(labels) * elements length, randomly mapped so two consecutive
         elements are never of the same category (same number).
@@ -401,15 +911,19 @@ class ExPrerands:
         same as the last element of the previous one. If this is the case, the first element of the
         current chunk will be swapped with the last one.
 
-        This function assumes that the set has the same number of elements for each category.
+        Chunks need the same number of elements for each category. When the categories have different sizes,
+        the array is drawn by _constrained_label_sampler instead.
 
         Parameters
         ----------
         labels: int
                 desired number of categories
 
-        elements: int
-                  number of stimuli per category
+        elements: int or list of int
+                  number of stimuli per category, or the number of stimuli of each category
+
+        rng: np.random.Generator, default: None
+             random generator to draw from. A fresh, unseeded one is used if not provided
 
         Returns
         -------
@@ -418,9 +932,18 @@ class ExPrerands:
                      the same value
         """
 
+        if rng is None:
+            rng = np.random.default_rng()
+
+        if np.ndim(elements):
+            if len(set(elements)) > 1:
+                return ExPrerands._constrained_label_sampler(elements, rng)
+
+            elements = elements[0]
+
         for blocks in range(0, elements):
             chunk = np.arange(labels)
-            np.random.shuffle(chunk)
+            rng.shuffle(chunk)
 
             try:
                 if chunk[0] == label_list[-1]:
@@ -482,7 +1005,8 @@ class ExPrerands:
         except ValueError:
             pass
 
-    def _pure_label_mapper(self, labels: int, elements: int) -> 'np.array':
+    def _pure_label_mapper(self, labels: int, elements: int or list,
+                           rng: 'np.random.Generator' = None) -> 'np.array':
         """Array of len(labels) * elements length, randomly mapped so two consecutive elements are never of the same
         category (same number).
 
@@ -494,13 +1018,19 @@ class ExPrerands:
         The helper function send_back will take care of cases where the only values remaining are already the same as the
         one chosen by the last iteration (i.e., the population is empty).
 
+        When the categories have different sizes, the array is drawn by _constrained_label_sampler, which picks
+        values with the same weights but never gets stuck, so no send_back is needed.
+
         Parameters
         ----------
         labels: int
                 desired number of categories
 
-        elements: int
-                  number of stimuli per category
+        elements: int or list of int
+                  number of stimuli per category, or the number of stimuli of each category
+
+        rng: np.random.Generator, default: None
+             random generator to draw from. A fresh, unseeded one is used if not provided
 
         Returns
         -------
@@ -509,6 +1039,15 @@ class ExPrerands:
                      the same value
         """
 
+        if rng is None:
+            rng = np.random.default_rng()
+
+        if np.ndim(elements):
+            if len(set(elements)) > 1:
+                return self._constrained_label_sampler(elements, rng)
+
+            elements = elements[0]
+
         population = list(range(labels))
 
         weights = [elements] * labels
@@ -522,15 +1061,17 @@ class ExPrerands:
                     old_weight = weights[population.index(prev)]
                     weights[population.index(prev)] = 0
 
-            try:
-                chosen = choices(population, weights)[0]
+            total = sum(weights)
 
-            except IndexError:
+            if total == 0:
                 # If all the weights are 0, the helper function will put the remaining values where
                 # they do not violate the repetition constrain
                 self._send_back(prev, old_weight, label_list)
                 break
 
+            pick = np.searchsorted(np.cumsum(weights), rng.random() * total, side='right')
+            chosen = population[pick]
+
             label_list.append(chosen)
             weights[population.index(chosen)] -= 1
 
@@ -546,139 +1087,1152 @@ class ExPrerands:
 
         return label_array
 
-    def _get_label_mapper(self, method: str) -> 'function':
+    @staticmethod
+    def _check_no_repeat_feasible(counts: list) -> None:
         """
-        Getter for the function to create a label array depending on the method
+        Check that a sequence with the given number of elements per category can avoid two consecutive elements
+        of the same category. This is only possible if no category holds more than half of the elements (rounded up)
 
         Parameters
         ----------
 
-        method: {'pseudo_con', 'pure_con'}
-                method for prerandomization of the categories
+        counts: list of int
+                number of elements of each category
 
         Returns
         -------
 
-        function: _pure_label_mapper or _pseudo_label_mapper
-                  function in charge of creating the label array for the randomization
+        None
         """
 
-        if method == 'pseudo_con':
-            return self._pseudo_label_mapper
+        total = int(np.sum(counts))
 
-        elif method == 'pure_con':
-            return self._pure_label_mapper
+        if total and max(counts) > (total + 1) // 2:
+            raise ValueError("Two consecutive stim of the same category cannot be avoided: a category has '{0}' of "
+                             "the '{1}' stim, and at most '{2}' are possible".format(max(counts), total,
+                                                                                      (total + 1) // 2))
 
-    def _label_mapper(self, categories: list, files: list, method: str) -> 'function':
+    @staticmethod
+    def _constrained_label_sampler(counts: list, rng: 'np.random.Generator') -> 'np.array':
         """
-        Get parameters and call the correct label mapping function
+        Creates a label array with counts[c] elements of category c where two consecutive elements are never of the
+        same category, for categories of any size.
+
+        The elements are drawn one by one, with weights proportional to the number of elements left in each category,
+        as in _pure_label_mapper, but only among the categories that keep the rest of the sequence possible. With R
+        elements left after a draw of category c, c can fill at most R // 2 of them (it cannot come next) and any
+        other category at most (R + 1) // 2. The sequence is built directly in O(len * categories), without retries.
 
         Parameters
         ----------
+        counts: list of int
+                number of elements of each category
 
-        categories: list
-                    the length of the list will be used to create the labels for the label
-                    mapper
-
-        files: list
-               the length will be used to know the necessary number for each label in the
-               label mapper
+        rng: np.random.Generator
+             random generator to draw from
 
         Returns
         -------
-
-        label_mapper : function
-                       call to the corresponding label mapping function with the correct parameters
-
+        label_array: np.array
+                     randomized array of sum(counts) category numbers where no two consecutive elements are the same
+                     value
         """
 
-        labels = len(categories)
-        elements = int(len(files) // labels)
+        ExPrerands._check_no_repeat_feasible(counts)
 
-        label_mapper = self._get_label_mapper(method)
-        return label_mapper(labels, elements)
+        counts = [int(count) for count in counts]
+        remaining = sum(counts)
+        label_list = []
+        prev = None
 
-    @staticmethod
-    def _within_category_random_map(label_array):
-        """Create array of range(len(label_array)), composed by numbers from 0 to len(label_array).
+        for _ in range(remaining):
+            remaining -= 1
 
-        The resulting list will preserve the category order of the input, but randomizing within each category.
-        For example, if label_array were to have 10 elements of value 0 and 10 elements of value 1,
-        a random permutation of numbers from 0 to 10 would be assigned where label_array == 0, and a
-        random permutation of numbers from 11 to 20 where label_array == 1
+            # Largest two counts, to know the largest count left besides each candidate
+            by_size = sorted(range(len(counts)), key=counts.__getitem__, reverse=True)
+            largest = counts[by_size[0]]
+            runner_up = counts[by_size[1]] if len(by_size) > 1 else 0
 
-        This function is intended to work with a previously randomized label_array for event designs, but it also
-        can be used on a non-randomized array to ensure different prerandomizations of blocks in blocked designs.
+            candidates = []
+            weights = []
 
-        Parameters
-        ----------
-        label_array: np.array
-                     array of numbers corresponding to different categories
+            for category, count in enumerate(counts):
+                if count == 0 or category == prev:
+                    continue
 
-        Returns
-        -------
-        output_list: list
-                     a list containing a random permutation of numbers corresponding to each value of label_array.
-        """
+                others = runner_up if category == by_size[0] else largest
 
-        # Initialize the output list.
-        output_list = np.zeros(len(label_array))
+                if count - 1 <= remaining // 2 and others <= (remaining + 1) // 2:
+                    candidates.append(category)
+                    weights.append(count)
 
-        # Find out the number of categories...
-        cat_num = len(np.unique(label_array))
+            pick = np.searchsorted(np.cumsum(weights), rng.random() * sum(weights), side='right')
+            chosen = candidates[pick]
 
-        # ...and the number of elements for each category.
-        stim_per_cat = int(len(label_array) / cat_num)
+            label_list.append(chosen)
+            counts[chosen] -= 1
+            prev = chosen
 
-        for category in range(cat_num):
-            output_list[label_array == category] = np.random.permutation(
-                range(category * stim_per_cat, (category + 1) *
-                      stim_per_cat))
+        label_array = np.array(label_list, dtype=int)
 
-        output_list = output_list.astype(int)
+        return label_array
 
-        return output_list
+    def _repeated_label_mapper(self, labels: int, elements: int or list, rng: 'np.random.Generator' = None,
+                               repeats: int = 2) -> 'np.array':
+        """
+        Creates the category sequence of a design where every stimulus is presented repeats times.
 
-    @staticmethod
-    def _file_indexer(cat_list, file_list):
-        """Create a dictionary with keys ranging from 0 to len(file_list), which contains the name
-        of the files together with their corresponding category.
+        The sequence is a _pseudo_label_mapper array with elements * repeats trials per category. Its rounds of one
+        trial per category spread the trials of each category evenly, which keeps the repeats of a stimulus far
+        apart when _lagged_within_category_map assigns the stimuli. Two consecutive trials are never of the same
+        category.
 
         Parameters
         ----------
-        cat_list: list
-                  contains keys corresponding to an integer for each category, and values
-                  with the name of said category
+        labels: int
+                desired number of categories
 
-        file_list: list
-                   names of the files in strings
+        elements: int or list of int
+                  number of stimuli per category, or the number of stimuli of each category
+
+        rng: np.random.Generator, default: None
+             random generator to draw from. A fresh, unseeded one is used if not provided
+
+        repeats: int, default: 2
+                 number of presentations of each stimulus
+
+        Returns
+        -------
+        label_array: np.array
+                     randomized array of labels * elements * repeats category numbers
+        """
+
+        return self._pseudo_label_mapper(labels, np.multiply(elements, repeats), rng)
+
+    def _get_label_mapper(self, method: str, repeats: int = 1) -> 'function':
+        """
+        Getter for the function to create a label array depending on the method
+
+        Parameters
+        ----------
+
+        method: {'pseudo_con', 'pure_con', 'repeated'}
+                method for prerandomization of the categories
+
+        repeats: int, default: 1
+                 number of presentations of each stimulus, for the 'repeated' method
+
+        Returns
+        -------
+
+        function: _pure_label_mapper, _pseudo_label_mapper or _repeated_label_mapper
+                  function in charge of creating the label array for the randomization
+        """
+
+        if method == 'pseudo_con':
+            return self._pseudo_label_mapper
+
+        elif method == 'pure_con':
+            return self._pure_label_mapper
+
+        elif method == 'repeated':
+            return partial(self._repeated_label_mapper, repeats=repeats)
+
+        else:
+            raise ValueError("method argument must be 'pseudo_con', 'pure_con' or 'repeated'")
+
+    def _label_mapper(self, categories: list, files: list, method: str,
+                      rng: 'np.random.Generator' = None, repeats: int = 1) -> 'function':
+        """
+        Get parameters and call the correct label mapping function
+
+        Parameters
+        ----------
+
+        categories: list or None
+                    the length of the list will be used to create the labels for the label
+                    mapper. Without categories, every file gets label 0
+
+        files: list
+               the number of files of each category will be used as the necessary number for each
+               label in the label mapper
+
+        method: {'pseudo_con', 'pure_con', 'repeated'}
+                method for prerandomization of the categories
+
+        rng: np.random.Generator, default: None
+             random generator handed to the label mapping function
+
+        repeats: int, default: 1
+                 number of presentations of each stimulus, for the 'repeated' method
+
+        Returns
+        -------
+
+        label_mapper : function
+                       call to the corresponding label mapping function with the correct parameters
+
+        """
+
+        if categories:
+            labels = len(categories)
+            file_labels = self._category_labels(categories, files)
+        else:
+            labels = 1
+            file_labels = np.zeros(len(files), int)
+
+        elements = list(np.bincount(file_labels, minlength=labels))
+
+        if method != 'repeated':
+            self._check_no_repeat_feasible(elements)
+
+        label_mapper = self._get_label_mapper(method, repeats)
+        return label_mapper(labels, elements, rng)
+
+    @staticmethod
+    def _lagged_within_category_map(label_array: 'np.array', repeats: int, min_lag: int,
+                                    rng: 'np.random.Generator') -> 'np.array':
+        """Counterpart of _within_category_random_map for designs where each stimulus is presented repeats times.
+
+        Each category owns a consecutive range of stimulus numbers, as in _within_category_random_map. The trials
+        of each category are visited in order, and each one gets, among the stimuli that are not in their lag
+        period, the one with the most presentations left (ties are broken at random). A stimulus enters its lag
+        period when presented, and leaves it min_lag trials later. Keeping the stimuli with the most presentations
+        left in front avoids ending up with the last repeats of a single stimulus crammed together. Each trial
+        costs a heap operation, so the whole map takes O(n log n).
+
+        Parameters
+        ----------
+        label_array: np.array
+                     array of category numbers, each one appearing repeats times its number of stimuli
+
+        repeats: int
+                 number of presentations of each stimulus
+
+        min_lag: int
+                 minimum number of trials between two presentations of the same stimulus
+
+        rng: np.random.Generator
+             random generator to draw from
+
+        Returns
+        -------
+        output_list: np.array
+                     stimulus number of each trial
+        """
+
+        output_list = np.zeros(len(label_array), dtype=int)
+        cat_sizes = np.bincount(label_array) // repeats
+        first_stim = np.concatenate([[0], np.cumsum(cat_sizes)])
+
+        for category, stim_per_cat in enumerate(cat_sizes):
+            slots = np.flatnonzero(label_array == category)
+
+            if not len(slots):
+                continue
+
+            # Every stimulus presented within a window of min_lag + 1 trials must be a different one
+            window = (np.searchsorted(slots, slots + min_lag, side='right') - np.arange(len(slots))).max()
+
+            if window > stim_per_cat:
+                raise ValueError("A lag of '{0}' trials needs at least '{1}' stim per category, but there are only "
+                                 "'{2}'".format(min_lag, window, stim_per_cat))
+
+            tiebreak = rng.permutation(stim_per_cat)
+            available = [(-repeats, tiebreak[stim], stim) for stim in range(stim_per_cat)]
+            heapq.heapify(available)
+            resting = deque()
+
+            for slot in slots:
+                while resting and resting[0][0] <= slot:
+                    heapq.heappush(available, resting.popleft()[1])
+
+                if not available:
+                    raise ValueError("Could not keep a lag of '{0}' trials between repeats".format(min_lag))
+
+                left, _, stim = heapq.heappop(available)
+                output_list[slot] = first_stim[category] + stim
+
+                if left < -1:
+                    resting.append((slot + min_lag + 1, (left + 1, rng.integers(stim_per_cat), stim)))
+
+        return output_list
+
+    @staticmethod
+    def _within_category_random_map(label_array, rng=None):
+        """Create array of range(len(label_array)), composed by numbers from 0 to len(label_array).
+
+        The resulting list will preserve the category order of the input, but randomizing within each category.
+        For example, if label_array were to have 10 elements of value 0 and 10 elements of value 1,
+        a random permutation of numbers from 0 to 10 would be assigned where label_array == 0, and a
+        random permutation of numbers from 11 to 20 where label_array == 1. Categories do not need to have the
+        same number of elements.
+
+        This function is intended to work with a previously randomized label_array for event designs, but it also
+        can be used on a non-randomized array to ensure different prerandomizations of blocks in blocked designs.
+
+        Parameters
+        ----------
+        label_array: np.array
+                     array of numbers corresponding to different categories
+
+        rng: np.random.Generator, default: None
+             random generator to draw from. A fresh, unseeded one is used if not provided
+
+        Returns
+        -------
+        output_list: list
+                     a list containing a random permutation of numbers corresponding to each value of label_array.
+        """
+
+        if rng is None:
+            rng = np.random.default_rng()
+
+        # Initialize the output list.
+        output_list = np.zeros(len(label_array))
+
+        # Find out the number of elements for each category...
+        stim_per_cat = np.bincount(label_array)
+
+        # ...and where the numbers of each category start.
+        first_stim = np.concatenate([[0], np.cumsum(stim_per_cat)])
+
+        for category in range(len(stim_per_cat)):
+            output_list[label_array == category] = rng.permutation(
+                range(first_stim[category], first_stim[category + 1]))
+
+        output_list = output_list.astype(int)
+
+        return output_list
+
+    @staticmethod
+    def _within_category_random_matrix(label_matrix: 'np.array', rng: 'np.random.Generator') -> 'np.array':
+        """Vectorized version of _within_category_random_map for a whole batch of label arrays at once.
+
+        Each row is sorted by category, with ties broken at random, and the sorted positions receive the numbers
+        0 to len(row) in turn. This gives each category the same range of numbers as _within_category_random_map,
+        randomly permuted within the category.
+
+        Parameters
+        ----------
+        label_matrix: np.array
+                      (prerands, trials) matrix of numbers corresponding to different categories
+
+        rng: np.random.Generator
+             random generator to draw from
+
+        Returns
+        -------
+        output_matrix: np.array
+                       (prerands, trials) matrix where each row is the within-category map of the same row of
+                       label_matrix
+        """
+
+        order = np.lexsort((rng.random(label_matrix.shape), label_matrix), axis=-1)
+
+        output_matrix = np.empty(label_matrix.shape, dtype=int)
+        np.put_along_axis(output_matrix, order, np.arange(label_matrix.shape[1])[None, :], axis=1)
+
+        return output_matrix
+
+    @staticmethod
+    def _blocked_label_matrix(labels: int, elements: int, prerands: int, block_length: int,
+                              rng: 'np.random.Generator', counterbalance: bool = False, no_repeat: bool = True,
+                              first_prerand: int = 0, base_rng: 'np.random.Generator' = None) -> 'np.array':
+        """
+        Creates the label arrays of a blocked design for a whole batch of prerands in one go.
+
+        Each category is split into elements // block_length blocks of block_length trials. Blocks come in
+        rounds that contain one block of each category, in random order. With no_repeat, the first block of a
+        round is swapped with the last one whenever it has the same category as the block before it, so two
+        consecutive blocks never share a category.
+
+        With counterbalance, the block order is drawn once (from base_rng) and the prerands are rotations of it:
+        prerand k adds k to every category number, modulo labels. Every category then holds every block position
+        equally often across each run of labels consecutive prerands.
+
+        Parameters
+        ----------
+        labels: int
+                desired number of categories
+
+        elements: int
+                  number of stimuli per category
+
+        prerands: int
+                  number of label arrays to create
+
+        block_length: int
+                      number of consecutive trials of the same category in a block
+
+        rng: np.random.Generator
+             random generator to draw from
+
+        counterbalance: bool, default: False
+                        whether to rotate a shared block order across prerands instead of drawing one per prerand
+
+        no_repeat: bool, default: True
+                   whether to forbid two consecutive blocks of the same category
+
+        first_prerand: int, default: 0
+                       number of the first prerand of the batch, so that rotations continue across batches
+
+        base_rng: np.random.Generator, default: None
+                  random generator for the shared block order when counterbalancing. Defaults to rng
+
+        Returns
+        -------
+        label_matrix: np.array
+                      (prerands, labels * elements) matrix with the category of each trial
+        """
+
+        if block_length < 1 or elements % block_length != 0:
+            raise ValueError("'{0}' stim per category cannot be split in blocks of '{1}'".format(elements,
+                                                                                               block_length))
+
+        if no_repeat and labels < 2:
+            raise ValueError('Blocks of different categories cannot alternate with a single category')
+
+        rounds = elements // block_length
+
+        if counterbalance:
+            base_rng = base_rng or rng
+            block_order = np.argsort(base_rng.random((1, rounds, labels)), axis=2)
+        else:
+            block_order = np.argsort(rng.random((prerands, rounds, labels)), axis=2)
+
+        if no_repeat:
+            for current in range(1, rounds):
+                clash = block_order[:, current, 0] == block_order[:, current - 1, -1]
+                block_order[clash, current, 0], block_order[clash, current, -1] = \
+                    block_order[clash, current, -1], block_order[clash, current, 0]
+
+        if counterbalance:
+            shifts = np.arange(first_prerand, first_prerand + prerands)[:, None, None]
+            block_order = (block_order + shifts) % labels
+
+        label_matrix = np.repeat(block_order.reshape(prerands, rounds * labels), block_length, axis=1)
+
+        return label_matrix
+
+    @staticmethod
+    def _transition_label_matrix(labels: int, elements: int, prerands: int, rng: 'np.random.Generator',
+                                 no_repeat: bool = True) -> 'np.array':
+        """
+        Creates label arrays in which every ordered pair of categories follows each other equally often.
+
+        Each label array is an Eulerian circuit of the transition graph: every category is a node, and each
+        allowed pair (a, b) is an edge that appears the same number of times. Walking every edge once visits each
+        category elements times, and the trials are the nodes of the walk, without the return to the start. Every
+        pair then occurs the same number of times, except the one that would close the circuit, which occurs once
+        less.
+
+        The circuits are drawn as in the BEST theorem, which makes every circuit equally likely: a random spanning
+        tree towards the first category (Wilson's algorithm) fixes the last edge each node leaves by, the other
+        edges of each node are shuffled, and the walk takes the edges of each node in that order. Only the trees
+        are drawn one prerand at a time. The shuffles and the walk run over the whole batch at once.
+
+        Parameters
+        ----------
+        labels: int
+                desired number of categories
+
+        elements: int
+                  number of stimuli per category. It must be a multiple of labels - 1 (labels with repeats)
+
+        prerands: int
+                  number of label arrays to create
+
+        rng: np.random.Generator
+             random generator to draw from
+
+        no_repeat: bool, default: True
+                   whether to leave out the pairs of a category with itself, so that a category never follows
+                   itself
+
+        Returns
+        -------
+        label_matrix: np.array
+                      (prerands, labels * elements) matrix with the category of each trial
+        """
+
+        successors = labels - 1 if no_repeat else labels
+
+        if successors < 1 or elements % successors != 0:
+            raise ValueError("'{0}' stim per category cannot be split evenly among '{1}' following "
+                             "categories".format(elements, successors))
+
+        # Targets of the edges leaving each node, each allowed pair repeated elements // successors times
+        targets = np.array([[target for target in range(labels) if not (no_repeat and target == node)]
+                            for node in range(labels)])
+        targets = np.tile(targets, elements // successors)
+
+        keys = rng.random((prerands, labels, elements))
+        roots = rng.integers(labels, size=prerands)
+
+        for prerand, root in enumerate(roots):
+            # Wilson's algorithm: loop-erased random walks until every node has a path to the root
+            parent = np.full(labels, -1)
+            in_tree = np.zeros(labels, dtype=bool)
+            in_tree[root] = True
+
+            for start in range(labels):
+                node = start
+
+                while not in_tree[node]:
+                    parent[node] = targets[node, rng.integers(elements)]
+                    node = parent[node]
+
+                node = start
+
+                while not in_tree[node]:
+                    in_tree[node] = True
+                    node = parent[node]
+
+            # The tree edge is the last one to leave each node
+            for node in range(labels):
+                if node != root:
+                    keys[prerand, node, np.argmax(targets[node] == parent[node])] = 2
+
+        exits = np.take_along_axis(np.broadcast_to(targets, keys.shape), np.argsort(keys, axis=2), axis=2)
+
+        rows = np.arange(prerands)
+        used = np.zeros((prerands, labels), dtype=int)
+        label_matrix = np.empty((prerands, labels * elements), dtype=int)
+        node = roots
+
+        for trial in range(labels * elements):
+            label_matrix[:, trial] = node
+            following = exits[rows, node, used[rows, node]]
+            used[rows, node] += 1
+            node = following
+
+        return label_matrix
+
+    @staticmethod
+    def _position_balanced_matrix(positions: 'np.array', stim_labels: 'np.array', first_prerand: int,
+                                  square_seed: list) -> 'np.array':
+        """
+        Reassign the stim of a batch of prerands within their categories, so that across the batch every stim
+        holds every rank inside its category equally often. The category of each trial is left untouched, so the
+        constraints of the prerands still hold.
+
+        The rows of each category are taken from random Latin squares: in square q, prerand r puts stim
+        sigma[(a[r] + b[s]) % k] in the s-th trial of the category, where a, b and sigma are random permutations
+        of the k stim of the category. Every stim then takes every rank once over each run of k prerands. Squares
+        are numbered from prerand 0 and drawn from their own generator, so they continue across batches.
+
+        Parameters
+        ----------
+        positions: np.array
+                   (prerands, trials) matrix of positions in the subset, as returned by _make_prerand_batch
+
+        stim_labels: np.array
+                     category of each stim of the subset. The stim must be grouped by category
+
+        first_prerand: int
+                       number of the first prerand of the batch within the whole request
+
+        square_seed: list of int
+                     entropy of the Latin squares. Category c and square q use default_rng(square_seed + [c, q])
+
+        Returns
+        -------
+        positions: np.array
+                   (prerands, trials) matrix with the same category in every trial as the input
+        """
+
+        prerands, trials = positions.shape
+        counts = np.bincount(stim_labels)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        # Trials of each row sorted by category, then by time: the j-th one gets rank j - offsets[c] in category c
+        order = np.argsort(stim_labels[positions], axis=1, kind='stable')
+        ranked = np.empty(positions.shape, dtype=int)
+        numbers = np.arange(first_prerand, first_prerand + prerands)
+
+        for category, size in enumerate(counts):
+            if size == 0:
+                continue
+
+            squares, square_index = np.unique(numbers // size, return_inverse=True)
+            generators = [np.random.default_rng(list(square_seed) + [category, int(square)]) for square in squares]
+            a, b, sigma = (np.array([generator.permutation(size) for generator in generators]) for _ in range(3))
+
+            rows = a[square_index, numbers % size][:, None]
+            ranked[:, offsets[category]:offsets[category + 1]] = \
+                offsets[category] + sigma[square_index[:, None], (rows + b[square_index]) % size]
+
+        balanced = np.empty(positions.shape, dtype=int)
+        np.put_along_axis(balanced, order, ranked, axis=1)
+
+        return balanced
+
+    @staticmethod
+    def _flatten_positions(positions: 'np.array', stim_labels: 'np.array', rng: 'np.random.Generator',
+                           counts: 'np.array', max_iterations: int = 2000, patience: int = 50) -> 'np.array':
+        """
+        Local search that evens out how often each stim falls in each part of the prerands, by swapping stim of
+        the same category within a prerand.
+
+        Each iteration proposes one random swap in every prerand at once. A swap moves two stim between position
+        bins, and it is kept if it lowers the sum of the squared counts of the (stim, bin) pairs. Among the
+        improving swaps of an iteration, each stim takes part in at most one, so that their gains add up exactly.
+        The search stops after patience iterations without any improving swap.
+
+        Parameters
+        ----------
+        positions: np.array
+                   (prerands, trials) matrix of positions in the subset
+
+        stim_labels: np.array
+                     category of each stim of the subset. The stim must be grouped by category
+
+        rng: np.random.Generator
+             random generator to draw from
+
+        counts: np.array
+                (stim, bins) matrix with the number of times each stim falls in each bin in earlier prerands. The
+                trials are split into bins of (almost) equal length. It is updated in place with this batch
+
+        max_iterations: int, default: 2000
+                        maximum number of iterations
+
+        patience: int, default: 50
+                  number of iterations without improvement before stopping
+
+        Returns
+        -------
+        positions: np.array
+                   (prerands, trials) matrix with the same category in every trial as the input
+        """
+
+        positions = positions.copy()
+        prerands, trials = positions.shape
+        rows = np.arange(prerands)
+        sizes = np.bincount(stim_labels)
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+
+        trial_bins = np.arange(trials) * counts.shape[1] // trials
+        np.add.at(counts, (positions.ravel(), np.tile(trial_bins, prerands)), 1)
+
+        order = np.argsort(stim_labels[positions], axis=1, kind='stable')
+        idle = 0
+
+        for _ in range(max_iterations):
+            if idle == patience:
+                break
+
+            # Two trials of the same category in each row
+            first = rng.integers(trials, size=prerands)
+            second = offsets[stim_labels[first]] + rng.integers(sizes[stim_labels[first]])
+            first, second = order[rows, first], order[rows, second]
+
+            bin_1, bin_2 = trial_bins[first], trial_bins[second]
+            stim_1, stim_2 = positions[rows, first], positions[rows, second]
+
+            # Half the change of the sum of squared counts
+            change = counts[stim_1, bin_2] - counts[stim_1, bin_1] + counts[stim_2, bin_1] - counts[stim_2, bin_2] + 2
+            swaps = rng.permutation(np.flatnonzero((change < 0) & (bin_1 != bin_2)))
+
+            # Keep a single swap per stim
+            swaps = swaps[np.sort(np.unique(stim_1[swaps], return_index=True)[1])]
+            swaps = swaps[np.sort(np.unique(stim_2[swaps], return_index=True)[1])]
+            swaps = swaps[~np.isin(stim_2[swaps], stim_1[swaps])]
+
+            if len(swaps) == 0:
+                idle += 1
+                continue
+
+            idle = 0
+            moved_1, moved_2 = stim_1[swaps], stim_2[swaps]
+
+            np.add.at(counts, (moved_1, bin_1[swaps]), -1)
+            np.add.at(counts, (moved_1, bin_2[swaps]), 1)
+            np.add.at(counts, (moved_2, bin_2[swaps]), -1)
+            np.add.at(counts, (moved_2, bin_1[swaps]), 1)
+
+            positions[swaps, first[swaps]] = moved_2
+            positions[swaps, second[swaps]] = moved_1
+
+        return positions
+
+    @staticmethod
+    def _category_labels(categories: list, files: list) -> 'np.array':
+        """
+        Find the category number of each file, from its "[category]_[number]" name
+
+        Parameters
+        ----------
+        categories: list
+                    names of the categories. The number of a category is its position in the list
+
+        files: list
+               names of the files
+
+        Returns
+        -------
+        file_labels: np.array
+                     category number of each file
+        """
+
+        numbers = {category: number for number, category in enumerate(categories)}
+
+        try:
+            file_labels = np.array([numbers[str(file).split('_')[0]] for file in files], dtype=int)
+        except KeyError as err:
+            raise ValueError("The file category {0} is not one of {1}".format(err, categories)) from err
+
+        return file_labels
+
+    def _write_prerand(self, prerand_path: str, final_list: list, staged: list or None = None) -> None:
+        """
+        Write a prerand to disk atomically. The rows go to a temporary file next to the destination, which is
+        then renamed over it, so an interrupted run never leaves a half-written prerand behind
+
+        Parameters
+        ----------
+
+        prerand_path: str
+                      destination of the prerand file
+
+        final_list: list
+                    filenames of the prerand, in order
+
+        staged: list or None, default: None
+                if given, the temporary file is not renamed yet, and prerand_path is appended to staged
+
+        Returns
+        -------
+
+        None
+        """
+
+        tmp_path = prerand_path + '.part'
+
+        with open(tmp_path, 'w') as csvfile:
+            prerandwriter = csv.writer(csvfile, delimiter='\t')
+
+            if self.hashes:
+                prerandwriter.writerows([stim, self.hashes[stim]] for stim in final_list)
+            else:
+                prerandwriter.writerows([stim] for stim in final_list)
+
+        if staged is not None:
+            staged.append(prerand_path)
+        else:
+            os.replace(tmp_path, prerand_path)
+
+    def _manifest_path(self, shard: list or None = None) -> str:
+        """Path of the progress manifest in out_dir, or of the manifest of one shard, given as [index, shards]"""
+
+        if shard is None:
+            return os.path.join(self.out_dir, self.manifest_name)
+
+        return os.path.join(self.out_dir, self.shard_manifest_name.format(*shard))
+
+    def _load_manifest(self, request: dict, shard: list or None = None) -> dict:
+        """
+        Read the progress manifest from out_dir and check it belongs to the given request. A manifest left by a
+        different request is discarded, so that generation starts over
+
+        Parameters
+        ----------
+
+        request: dict
+                 parameters of the current create_prerands call. If its 'seed' is None, the seed recorded in a
+                 matching manifest is reused while the manifest has unfinished chunks. A finished unseeded
+                 request is not resumed, so that a new call draws new prerands
+
+        shard: list or None, default: None
+               [shard_index, num_shards] of a sharded run, which keeps a manifest of its own
+
+        Returns
+        -------
+
+        manifest: dict
+                  'request' holds the parameters of the run and 'completed' the [subset, first prerand] pairs
+                  of the chunks that are already on disk. Manifests of sharded runs also have the 'shard'
+        """
+
+        manifest_path = self._manifest_path(shard)
+
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (FileNotFoundError, ValueError):
+            manifest = None
+
+        if manifest is not None:
+            recorded = dict(manifest['request'])
+
+            finished = len(manifest['completed']) >= len(request['subsets']) * -(-request['prerand_num'] //
+                                                                                 request['chunk_size'])
+
+            if request['seed'] is None:
+                recorded['seed'] = None
+
+            if recorded == request and manifest.get('shard') == shard and not (request['seed'] is None and finished):
+                return manifest
+
+        manifest = {'request': request, 'completed': []}
+
+        if shard is not None:
+            manifest['shard'] = list(shard)
+
+        return manifest
+
+    def _save_manifest(self, manifest: dict) -> None:
+        """
+        Atomically replace the progress manifest in out_dir, or the one of its shard
+
+        Parameters
+        ----------
+
+        manifest: dict
+                  manifest as returned by _load_manifest
+
+        Returns
+        -------
+
+        None
+        """
+
+        manifest_path = self._manifest_path(manifest.get('shard'))
+        tmp_path = manifest_path + '.part'
+
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        os.replace(tmp_path, manifest_path)
+
+    def _prerand_path(self, subset_num: int, prerand: int) -> str:
+        """
+        Build the output path of a prerand
+
+        Parameters
+        ----------
+
+        subset_num: int
+                    index of the subset the prerand belongs to, starting from 0
+
+        prerand: int
+                 index of the prerand within the subset, starting from 0
+
+        Returns
+        -------
+
+        prerand_path: str
+                      absolute path of the prerand file
+        """
+
+        if self.subsets_path:
+            prerand_path = os.path.join(self.out_dir,
+                                        'set_' + str(subset_num + 1) + 'prerand_' +
+                                        str(prerand + 1) + '.tsv')
+        else:
+            prerand_path = os.path.join(self.out_dir,
+                                        'prerand_' + str(prerand + 1) + '.tsv')
+
+        return prerand_path
+
+    @staticmethod
+    def _chunk_shard(subset_num: int, start: int, prerand_num: int, chunk_size: int, num_shards: int) -> int:
+        """
+        Shard that makes a chunk of a sharded request. The chunks are numbered subset after subset and dealt to the
+        shards in turn, so every shard gets about the same number of prerands even with a single subset
+
+        Parameters
+        ----------
+
+        subset_num: int
+                    index of the subset of the chunk, starting from 0
+
+        start: int
+               index of the first prerand of the chunk
+
+        prerand_num: int
+                     number of prerands per subset of the request
+
+        chunk_size: int
+                    number of prerands per chunk
+
+        num_shards: int
+                    number of shards of the request
+
+        Returns
+        -------
+
+        shard_index: int
+                     index of the shard the chunk belongs to
+        """
+
+        chunks_per_subset = -(-prerand_num // chunk_size)
+
+        return (subset_num * chunks_per_subset + start // chunk_size) % num_shards
+
+    def _stim_lists(self) -> list:
+        """
+        Get the filenames to randomize: one list per subset, or a single list with every stim if there are no
+        subsets
+
+        Returns
+        -------
+
+        all_stim: list
+                  each element is a list with the filenames of one subset
+        """
+
+        if isinstance(self.subsets_path, SubsetResult):
+            return [self.subsets_path.to_names(i).tolist() for i in range(len(self.subsets_path))]
+        elif self.subsets_path:
+            return self._subset_parser(self.subsets_path)
+
+        return [self.source.names()]
+
+    def _make_prerand(self, subset: list, categories: list or None, method: str,
+                      rng: 'np.random.Generator', repeats: int = 1, min_lag: int = 0, **options) -> 'np.array':
+        """
+        Create a single prerandomization of the files in subset
+
+        Parameters
+        ----------
+
+        subset: list
+                filenames to randomize
+
+        categories: list or None
+                    names of the categories, if any
+
+        method: {'unconstrained', 'pseudo_con', 'pure_con', 'repeated'}
+                prerandomization method
+
+        rng: np.random.Generator
+             random generator to draw from
+
+        repeats: int, default: 1
+                 number of presentations of each file, for the 'repeated' method
+
+        min_lag: int, default: 0
+                 minimum number of trials between two presentations of the same file, for the 'repeated' method
+
+        options: dict
+                 arguments of other methods, ignored
+
+        Returns
+        -------
+
+        positions: np.array
+                   positions in subset of the files, in their randomized order
+        """
+
+        if method == 'repeated':
+            label_map = self._label_mapper(categories, subset, method, rng, repeats)
+            positions = self._lagged_within_category_map(label_map, repeats, min_lag, rng)
+
+        elif not categories or method == 'unconstrained':
+            positions = rng.permutation(len(subset))
+
+        else:
+            label_map = self._label_mapper(categories, subset, method, rng)
+            positions = self._within_category_random_map(label_map, rng)
+
+        return positions
+
+    @staticmethod
+    def _subset_digest(subset: list) -> str:
+        """
+        Digest of the ordered filenames of a subset. It identifies the subset in the progress manifest, so that
+        chunks made from a subset that was created again are not resumed
+
+        Parameters
+        ----------
+
+        subset: list
+                filenames of the subset, in order
+
+        Returns
+        -------
+
+        digest: str
+                hex digest of the filenames
+        """
+
+        digest = hashlib.blake2b(digest_size=16)
+
+        for stim in subset:
+            digest.update(str(stim).encode() + b'\n')
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def _read_prerand(prerand_path: str) -> list:
+        """
+        Read back the filenames of a prerand file
+
+        Parameters
+        ----------
+
+        prerand_path: str
+                      path of the prerand file
+
+        Returns
+        -------
+
+        final_list: list
+                    filenames of the prerand, in order
+        """
+
+        with open(prerand_path) as csvfile:
+            return [row[0] for row in csv.reader(csvfile, delimiter='\t')]
+
+    def _read_chunk(self, subset_num: int, prerands: range, names: 'np.array', expected: 'np.array') -> 'np.array':
+        """
+        Read back the prerand files of a finished chunk as rows of positions in names, checking that every file
+        is an order of the current subset
+
+        Parameters
+        ----------
+
+        subset_num: int
+                    index of the subset of the chunk, starting from 0
+
+        prerands: range
+                  indices of the prerands of the chunk
+
+        names: np.array
+               sorted filenames of every subset
+
+        expected: np.array
+                  sorted positions in names that every prerand of the subset holds
 
         Returns
         -------
-        file_index: dict
-                    keys are numbers ranging from 0, and values are two-element tuples containing the
-                    filename as first value and its corresponding category as second value
+
+        rows: np.array or None
+              (prerands, trials) positions of the chunk, or None if a file is missing or does not belong to the
+              subset
+        """
+
+        rows = []
+
+        for prerand in prerands:
+            try:
+                stim = np.asarray(self._read_prerand(self._prerand_path(subset_num, prerand)), dtype=str)
+            except FileNotFoundError:
+                return None
+
+            row = np.searchsorted(names, stim)
+
+            if len(row) != len(expected) or not (names[np.minimum(row, len(names) - 1)] == stim).all() \
+                    or not (np.sort(row) == expected).all():
+                return None
+
+            rows.append(row)
+
+        return np.array(rows)
+
+    def _make_prerand_batch(self, subset: list, categories: list or None, method: str, prerands: int,
+                            rng: 'np.random.Generator', first_prerand: int = 0, **options) -> 'np.array':
+        """
+        Create a batch of prerandomizations of the files in subset
+
+        Parameters
+        ----------
+
+        subset: list
+                filenames to randomize
+
+        categories: list or None
+                    names of the categories, if any
+
+        method: {'unconstrained', 'pseudo_con', 'pure_con', 'blocked', 'repeated', 'transition_balanced'}
+                prerandomization method
+
+        prerands: int
+                  number of prerandomizations in the batch
+
+        rng: np.random.Generator
+             random generator to draw from
+
+        first_prerand: int, default: 0
+                       number of the first prerand of the batch within the whole request
+
+        options: dict
+                 extra arguments of the method, e.g. block_length, counterbalance, no_repeat and base_rng for
+                 'blocked', repeats and min_lag for 'repeated', or no_repeat for 'transition_balanced'
+
+        Returns
+        -------
+
+        positions: np.array
+                   (prerands, trials) matrix with the positions in subset of the files of each prerand, in order
         """
 
-        # Determine the number of elements per category
-        num_files = len(file_list)
-        num_cat = len(cat_list)
+        if categories and method in ('blocked', 'transition_balanced'):
+            labels = len(categories)
+            counts = np.bincount(self._category_labels(categories, subset), minlength=labels)
+
+            if len(set(counts)) > 1:
+                raise ValueError('Blocked and transition balanced designs need the same number of stim in every '
+                                 'category')
 
-        stim_per_cat = int(num_files / num_cat)
+            elements = counts[0]
 
-        # Create the index
-        file_index = {key: file_list[key] for cat in range(num_cat)
-                      for key in range(cat * stim_per_cat, (cat + 1) * stim_per_cat)}
+            if method == 'blocked':
+                label_matrix = self._blocked_label_matrix(labels, elements, prerands, options['block_length'], rng,
+                                                          options.get('counterbalance', False),
+                                                          options.get('no_repeat', True), first_prerand,
+                                                          options.get('base_rng'))
+            else:
+                label_matrix = self._transition_label_matrix(labels, elements, prerands, rng,
+                                                             options.get('no_repeat', True))
 
-        return file_index
+            return self._within_category_random_matrix(label_matrix, rng)
 
-    def create_prerands(self, prerand_num: int, categories: list or None, method: str) -> None:
+        return np.array([self._make_prerand(subset, categories, method, rng, **options) for _ in range(prerands)])
+
+    def create_prerands(self, prerand_num: int, categories: list or None, method: str,
+                        seed: int or None = None, chunk_size: int or None = None, block_length: int or None = None,
+                        counterbalance: bool = False, no_repeat: bool = True, repeats: int = 1,
+                        min_lag: int = 0, balance_positions: bool = False, position_bins: int = 10,
+                        progress: 'callable' = None, cancel: 'threading.Event' = None, shard_index: int = 0,
+                        num_shards: int = 1) -> None:
         """
         Method to create prerandomizations. The subsets will be csv files containing
         names of the files from self.root_path or in self.subsets_path, depending on
         the existence of subsets. Each prerand will contain the same filenames, but
         in different randomized orders.
 
+        Prerands are generated in chunks of chunk_size prerands per subset, each one drawn from its own
+        random generator derived from seed. When chunk_size is given, a progress manifest is kept in out_dir
+        and updated after every chunk is on disk. Calling the method again with the same arguments and subsets
+        then skips the chunks already written, and the result is the same an uninterrupted run would produce.
+        Resumed files that no longer hold an order of their subset are made again.
+        With an in-memory source there is no out_dir: the prerands are only kept in results (and in the store).
+
+        The 'blocked' method presents the stim in blocks of block_length trials of the same category. The block
+        orders of a whole chunk are created in a single array operation, see _blocked_label_matrix.
+
+        The 'repeated' method presents each stim repeats times, with at least min_lag trials between two
+        presentations of the same stim and never two consecutive trials of the same category.
+
+        The 'transition_balanced' method makes every ordered pair of categories follow each other equally often,
+        for carry-over designs. The category sequences are Eulerian circuits of the transition graph, see
+        _transition_label_matrix. With no_repeat, a category never follows itself. Otherwise the pairs of a
+        category with itself are balanced too.
+
+        With balance_positions, the prerands of each subset are made jointly, so that every stim falls in every
+        part of the prerands about equally often across the whole request. The category sequences are drawn as
+        usual, and only which stim of a category goes in each of its trials changes, so the constraints of the
+        method still hold. The stim are first assigned from Latin squares (see _position_balanced_matrix) and
+        then swapped by a local search until their counts per position bin are flat (see _flatten_positions).
+
+        A request can be split across machines with num_shards. Every machine calls the method with the same
+        arguments and seed and its own shard_index, and only makes the chunks of its shard (see _chunk_shard),
+        keeping a manifest of its own. As each chunk only depends on the seed, the subset and its first prerand,
+        merge_shards then gathers the shard outputs into the same batch a single machine would have made.
+
         Parameters
         ----------
 
@@ -688,49 +2242,450 @@ class ExPrerands:
         categories: list or None
                     names of the categories passed from the ExpStim class, if any
 
-        method: {'unconstrained', 'pseudo_con', 'pure_con'}
+        method: {'unconstrained', 'pseudo_con', 'pure_con', 'blocked', 'repeated', 'transition_balanced'}
                 prerandomization method
 
+        seed: int or None, default: None
+              seed for the random generators. If None, a random one is drawn (or taken from the manifest
+              of an interrupted run with the same arguments)
+
+        chunk_size: int or None, default: None
+                    number of prerands per checkpointed chunk. If None, all the prerands of a subset are
+                    generated as a single chunk and no manifest is written
+
+        block_length: int or None, default: None
+                      number of consecutive trials per block. Required by the 'blocked' method
+
+        counterbalance: bool, default: False
+                        'blocked' only. Rotate a single block order across the prerands, so that each category
+                        appears equally often at each block position
+
+        no_repeat: bool, default: True
+                   'blocked' and 'transition_balanced' only. Forbid two consecutive blocks (or trials) of the same
+                   category
+
+        repeats: int, default: 1
+                 'repeated' only. Number of presentations of each stim
+
+        min_lag: int, default: 0
+                 'repeated' only. Minimum number of trials between two presentations of the same stim
+
+        balance_positions: bool, default: False
+                           balance the positions of each stim across the prerands. Not available for 'repeated'
+
+        position_bins: int, default: 10
+                       number of parts the prerands are split into when balancing positions, e.g. 10 balances
+                       how often each stim falls in each tenth of the trials
+
+        progress: callable or None, default: None
+                  called with a progress report, counted in prerands, after each chunk. See
+                  ProgressTracker.advance
+
+        cancel: threading.Event or None, default: None
+                cancellation token, checked before each chunk is made. Once set, the method raises
+                GenerationCancelled. With chunk_size, out_dir then holds the finished chunks and their
+                manifest, so calling the method again resumes the request. Without it, out_dir keeps the
+                prerands of the previous run
+
+        shard_index: int, default: 0
+                     shard made by this call, from 0 to num_shards - 1
+
+        num_shards: int, default: 1
+                    number of shards the request is split into. Sharded runs need a seed, a chunk_size and an
+                    out_dir, and cannot balance positions, which depends on every earlier chunk. Their results
+                    only hold the prerands of the shard, in order
+
         Returns
         -------
 
         None
         """
 
-        if self.subsets_path:
-            all_stim = self._subset_parser(self.subsets_path)
+        all_stim = self._stim_lists()
+
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError('chunk_size must be a positive integer')
+
+        if method == 'blocked' and block_length is None:
+            raise ValueError("The 'blocked' method needs a block_length")
+
+        if repeats < 1 or min_lag < 0:
+            raise ValueError('repeats must be positive and min_lag cannot be negative')
+
+        if balance_positions and (method == 'repeated' or position_bins < 1):
+            raise ValueError("Positions can only be balanced with a positive number of bins, and not for 'repeated'")
+
+        if not 0 <= shard_index < num_shards:
+            raise ValueError('shard_index must be between 0 and num_shards - 1')
+
+        if num_shards > 1 and (seed is None or chunk_size is None or self.out_dir is None or balance_positions):
+            raise ValueError('Sharded runs need a seed, a chunk_size and an out_dir, and cannot balance positions')
+
+        options = {'block_length': block_length,
+                   'counterbalance': counterbalance,
+                   'no_repeat': no_repeat,
+                   'repeats': repeats,
+                   'min_lag': min_lag,
+                   'balance_positions': balance_positions,
+                   'position_bins': position_bins}
+
+        request = {'prerand_num': prerand_num,
+                   'categories': categories,
+                   'method': method,
+                   'seed': seed,
+                   'chunk_size': chunk_size,
+                   'options': dict(options),
+                   'subsets': [self._subset_digest(subset) for subset in all_stim]}
+
+        # In-memory sources have nowhere to keep a manifest
+        checkpoint = chunk_size is not None and self.out_dir is not None
+        shard = [shard_index, num_shards] if num_shards > 1 else None
+
+        if not checkpoint:
+            manifest = {'request': request, 'completed': []}
+            chunk_size = chunk_size or max(prerand_num, 1)
         else:
-            all_stim = [sorted(os.listdir(self.root_path))]
+            manifest = self._load_manifest(request, shard)
+
+        if manifest['request']['seed'] is None:
+            manifest['request']['seed'] = int(np.random.SeedSequence().entropy)
+
+        seed = manifest['request']['seed']
+        completed = {tuple(chunk) for chunk in manifest['completed']}
+        run = self.store.start_run('prerands', manifest['request']) if self.store is not None else None
+
+        if shard is not None:
+            # Written even if the shard gets no chunks, so that merge_shards finds every shard
+            self._save_manifest(manifest)
+
+        chunks = [(subset_num, start) for subset_num in range(len(all_stim))
+                  for start in range(0, prerand_num, chunk_size)
+                  if self._chunk_shard(subset_num, start, prerand_num, chunk_size, num_shards) == shard_index]
+
+        names = np.array(sorted(set().union(*all_stim)), dtype=str)
+        tracker = ProgressTracker(sum(min(chunk_size, prerand_num - start) for _, start in chunks), progress, cancel)
+        results = []
+
+        # Without a manifest an interrupted run cannot be resumed, so its files are only renamed into place once
+        # every prerand is made, and a cancelled run leaves the prerands of the previous one untouched
+        staged = None if checkpoint else []
+
+        try:
+            for subset_num, subset in enumerate(all_stim):
+                if categories and method != 'unconstrained':
+                    # Group the files by category, in the order of categories, as the label mappers number them
+                    file_order = np.argsort(self._category_labels(categories, subset), kind='stable')
+                    subset = [subset[number] for number in file_order]
+
+                subset_ids = np.searchsorted(names, np.asarray(subset, dtype=str))
+                expected = np.sort(np.tile(subset_ids, repeats if method == 'repeated' else 1))
+                matrix = []
+
+                if balance_positions:
+                    grouped = categories and method != 'unconstrained'
+                    stim_labels = self._category_labels(categories, subset) if grouped else np.zeros(len(subset), int)
+                    position_counts = np.zeros((len(subset), min(position_bins, max(len(subset), 1))), dtype=int)
+                    subset_positions = np.zeros(len(names), dtype=int)
+                    subset_positions[subset_ids] = np.arange(len(subset))
+
+                for start in [start for chunk_subset, start in chunks if chunk_subset == subset_num]:
+                    stop = min(start + chunk_size, prerand_num)
+
+                    rows = None
+
+                    if (subset_num, start) in completed:
+                        # Already on disk from an interrupted run, only bring it back into memory
+                        rows = self._read_chunk(subset_num, range(start, stop), names, expected)
+
+                        if rows is None:
+                            # The files were changed or removed since, so the chunk is made again
+                            completed.discard((subset_num, start))
+                            manifest['completed'].remove([subset_num, start])
+
+                    if rows is not None:
+                        if balance_positions:
+                            # Later chunks are balanced against this one too
+                            trial_bins = np.arange(len(subset)) * position_counts.shape[1] // len(subset)
+                            np.add.at(position_counts, (subset_positions[rows], trial_bins), 1)
+
+                    else:
+                        tracker.check()
+                        rng = np.random.default_rng([seed, subset_num, start])
+
+                        if counterbalance:
+                            # Shared by every chunk. prerand_num is never the start of a chunk, so this generator
+                            # cannot coincide with a chunk one
+                            options['base_rng'] = np.random.default_rng([seed, subset_num, prerand_num])
+
+                        batch = self._make_prerand_batch(subset, categories, method, stop - start, rng, start,
+                                                         **options)
+
+                        if balance_positions:
+                            batch = self._position_balanced_matrix(batch, stim_labels, start,
+                                                                   [seed, subset_num, prerand_num, 1])
+                            batch = self._flatten_positions(batch, stim_labels, rng, position_counts)
+
+                        rows = subset_ids[batch]
+
+                        if self.out_dir is not None:
+                            # The subset is already grouped by category, so the positions of the whole chunk index
+                            # the names at once. Strings are only made here, for the prerand files
+                            for prerand, final_list in zip(range(start, stop), np.take(names, rows).tolist()):
+                                self._write_prerand(self._prerand_path(subset_num, prerand), final_list, staged)
+
+                        if self.store is not None and checkpoint:
+                            self.store.write_prerands(run, subset_num + 1, start + 1, names, rows)
+
+                    matrix.extend(rows)
+
+                    if checkpoint and (subset_num, start) not in completed:
+                        manifest['completed'].append([subset_num, start])
+                        self._save_manifest(manifest)
+
+                    tracker.advance(stop - start, resumed=(subset_num, start) in completed)
+
+                matrix = np.array(matrix, dtype=np.int32) if matrix else np.empty((0, len(subset)), dtype=np.int32)
+
+                results.append(PrerandResult(names, matrix))
+
+        except BaseException:
+            for prerand_path in staged or []:
+                if os.path.exists(prerand_path + '.part'):
+                    os.remove(prerand_path + '.part')
+
+            raise
+
+        for prerand_path in staged or []:
+            os.replace(prerand_path + '.part', prerand_path)
+
+        if self.store is not None and not checkpoint:
+            for subset_num, result in enumerate(results):
+                self.store.write_prerands(run, subset_num + 1, 1, names, result.indices)
+
+        self.results = results
+
+    def merge_shards(self, shard_dirs: list) -> None:
+        """
+        Gather the outputs of a request made in shards by create_prerands into out_dir, as if a single machine had
+        made it. The shard manifests found in shard_dirs are checked to belong to the same request and to cover
+        every chunk, the prerand files are copied into out_dir (unless they are already there, e.g. on a shared
+        filesystem) and the manifest of the whole request is written. The request is then resumed from disk, which
+        fills results.
+
+        Parameters
+        ----------
+
+        shard_dirs: list of str
+                    output directories of the shards. A directory can hold several shards, and out_dir may be
+                    one of them
+
+        Returns
+        -------
+
+        None
+        """
+
+        if self.out_dir is None:
+            raise ValueError('Shards can only be merged into an out_dir')
+
+        shards = {}
+        shard_pattern = self.shard_manifest_name.format('*', '*')
+
+        for shard_dir in sorted({os.path.realpath(shard_dir) for shard_dir in shard_dirs}):
+            for manifest_path in sorted(glob.glob(os.path.join(glob.escape(shard_dir), shard_pattern))):
+                with open(manifest_path) as manifest_file:
+                    manifest = json.load(manifest_file)
+
+                shard_index, num_shards = manifest['shard']
+
+                if shard_index in shards:
+                    raise ValueError('Shard {0} was found more than once'.format(shard_index))
+
+                shards[shard_index] = (shard_dir, manifest)
+
+        if not shards:
+            raise ValueError('There are no shard manifests in {0}'.format(shard_dirs))
+
+        request = shards[min(shards)][1]['request']
+        num_shards = shards[min(shards)][1]['shard'][1]
+
+        if any(manifest['request'] != request or manifest['shard'][1] != num_shards
+               for _, manifest in shards.values()):
+            raise ValueError('The shards belong to different requests')
+
+        missing = sorted(set(range(num_shards)) - set(shards))
+
+        if missing:
+            raise ValueError('Shards {0} of {1} are missing'.format(missing, num_shards))
+
+        if request['subsets'] != [self._subset_digest(subset) for subset in self._stim_lists()]:
+            raise ValueError('The shards were made from different subsets')
+
+        prerand_num, chunk_size = request['prerand_num'], request['chunk_size']
+        chunks = [(subset_num, start) for subset_num in range(len(request['subsets']))
+                  for start in range(0, prerand_num, chunk_size)]
+
+        for shard_index, (shard_dir, manifest) in sorted(shards.items()):
+            completed = {tuple(chunk) for chunk in manifest['completed']}
+            unfinished = [chunk for chunk in chunks if chunk not in completed and
+                          self._chunk_shard(*chunk, prerand_num, chunk_size, num_shards) == shard_index]
+
+            if unfinished:
+                raise ValueError('Shard {0} has {1} unfinished chunks'.format(shard_index, len(unfinished)))
+
+            if shard_dir == os.path.realpath(self.out_dir):
+                continue
+
+            for subset_num, start in sorted(completed):
+                for prerand in range(start, min(start + chunk_size, prerand_num)):
+                    prerand_path = self._prerand_path(subset_num, prerand)
+                    tmp_path = prerand_path + '.part'
+
+                    shutil.copyfile(os.path.join(shard_dir, os.path.basename(prerand_path)), tmp_path)
+                    os.replace(tmp_path, prerand_path)
+
+        self._save_manifest({'request': request, 'completed': [list(chunk) for chunk in chunks]})
+
+        self.create_prerands(prerand_num, request['categories'], request['method'], seed=request['seed'],
+                             chunk_size=chunk_size, **request['options'])
+
+    def optimize_efficiency(self, prerand_num: int, categories: list, tr: float, soa: float or list,
+                            method: str = 'pure_con', candidates: int = 1000, contrasts: 'np.array' = None,
+                            batch_size: int = 250, seed: int or None = None, progress: 'callable' = None,
+                            cancel: 'threading.Event' = None, **method_options) -> list:
+        """
+        Create the prerands of each subset that are most efficient for an event-related fMRI/EEG design.
+
+        Candidate orders are made in batches with the given method, and each batch is scored at once with
+        stim_randomizer.efficiency.design_efficiency (HRF convolution and contrast efficiency). The prerand_num
+        best candidates of each subset are kept, from best to worst, and saved like the output of create_prerands.
+
+        Parameters
+        ----------
+
+        prerand_num: int
+                     number of prerands to keep per subset
+
+        categories: list
+                    names of the categories, which are the conditions of the design
+
+        tr: float
+            repetition time, in seconds
+
+        soa: float or list of float
+             time between the onsets of two trials, in seconds. If a list, every candidate gets its own jittered
+             schedule, drawing the time before each trial from it
+
+        method: str, default: 'pure_con'
+                method of the candidate orders, as in create_prerands
+
+        candidates: int, default: 1000
+                    number of candidate orders scored per subset
+
+        contrasts: np.array, default: None
+                   (contrasts, categories) matrix of the contrasts to estimate. Defaults to every category against
+                   the baseline
+
+        batch_size: int, default: 250
+                    number of candidates made and scored together
+
+        seed: int or None, default: None
+              seed for the random generators
+
+        progress: callable or None, default: None
+                  called with a progress report, counted in candidates, after each batch. See
+                  ProgressTracker.advance
+
+        cancel: threading.Event or None, default: None
+                cancellation token, checked before each batch. Once set, the method raises GenerationCancelled, and
+                only the prerands of the subsets that were finished are written
+
+        method_options: dict
+                        extra arguments of the method, as in create_prerands
+
+        Returns
+        -------
+
+        designs: list of dict
+                 one dict per subset, with the 'efficiency' of each kept prerand and the 'onsets' (prerands, trials)
+                 of their trials, in seconds
+        """
+
+        if not categories:
+            raise ValueError('Design efficiency needs the categories of the stim')
+
+        if method == 'repeated' or prerand_num > candidates:
+            raise ValueError("Efficient prerands need more candidates than prerands, and cannot be 'repeated'")
+
+        options = {'block_length': None, 'no_repeat': True}
+        options.update(method_options)
+
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy)
+
+        all_stim = self._stim_lists()
+        names = np.array(sorted(set().union(*all_stim)), dtype=str)
+        labels = len(categories)
+
+        if self.store is not None:
+            run = self.store.start_run('prerands', {'prerand_num': prerand_num,
+                                                    'categories': categories,
+                                                    'tr': tr,
+                                                    'soa': soa,
+                                                    'method': method,
+                                                    'candidates': candidates,
+                                                    'contrasts': None if contrasts is None else
+                                                    np.asarray(contrasts).tolist(),
+                                                    'batch_size': batch_size,
+                                                    'seed': seed,
+                                                    'options': options,
+                                                    'subsets': [self._subset_digest(subset) for subset in all_stim]})
+        tracker = ProgressTracker(candidates * len(all_stim), progress, cancel)
+
+        self.results = []
+        designs = []
 
         for subset_num, subset in enumerate(all_stim):
-            for prerand in range(prerand_num):
-                if not categories or method == 'unconstrained':
-                    shuffle(subset)
-                    final_list = subset
+            # Group the files by category, as the label mappers number them
+            file_order = np.argsort(self._category_labels(categories, subset), kind='stable')
+            subset = [subset[number] for number in file_order]
+            stim_labels = self._category_labels(categories, subset)
+
+            best = np.empty((0, len(subset)), dtype=int)
+            best_onsets = np.empty((0, len(subset)))
+            best_scores = np.empty(0)
+
+            for start in range(0, candidates, batch_size):
+                tracker.check()
+
+                stop = min(start + batch_size, candidates)
+                rng = np.random.default_rng([seed, subset_num, start])
+
+                batch = self._make_prerand_batch(subset, categories, method, stop - start, rng, start, **options)
+                onsets = trial_onsets(soa, stop - start, len(subset), rng)
+                scores = design_efficiency(stim_labels[batch], onsets, labels, tr, contrasts)
+
+                # Keep the best candidates seen so far
+                best = np.concatenate([best, batch])
+                best_onsets = np.concatenate([best_onsets, onsets])
+                best_scores = np.concatenate([best_scores, scores])
 
-                else:
-                    label_map = self._label_mapper(categories, subset, method)
+                keep = np.argsort(-best_scores, kind='stable')[:prerand_num]
+                best, best_onsets, best_scores = best[keep], best_onsets[keep], best_scores[keep]
 
-                    try:
-                        within_cat_map = self._within_category_random_map(label_map)
-                    except UnboundLocalError as err:
-                        raise ValueError("method argument must be 'pseudo_con' or 'pure_con'") from err
+                tracker.advance(stop - start)
 
-                    file_index = self._file_indexer(categories, subset)
+            subset_ids = np.searchsorted(names, np.asarray(subset, dtype=str))
 
-                    final_list = [file_index[number] for number in within_cat_map]
+            if self.out_dir is not None:
+                for prerand, positions in enumerate(best):
+                    self._write_prerand(self._prerand_path(subset_num, prerand),
+                                        [subset[number] for number in positions])
 
-                # Saving to files
-                if self.subsets_path:
-                    prerand_path = os.path.join(self.out_dir,
-                                                'set_' + str(subset_num + 1) + 'prerand_' +
-                                                str(prerand + 1) + '.tsv')
-                else:
-                    prerand_path = os.path.join(self.out_dir,
-                                                'prerand_' + str(prerand + 1) + '.tsv')
+            if self.store is not None:
+                self.store.write_prerands(run, subset_num + 1, 1, names, subset_ids[best])
 
-                with open(prerand_path, 'w') as csvfile:
-                    prerandwriter = csv.writer(csvfile)
+            self.results.append(PrerandResult(names, subset_ids[best]))
+            designs.append({'efficiency': best_scores, 'onsets': best_onsets})
 
-                    for stim in final_list:
-                        prerandwriter.writerow([stim])
+        return designs
@@ -0,0 +1,169 @@
+"""
+Design efficiency of event-related trial orders, scored many orders at a time
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import math
+
+import numpy as np
+
+
+def canonical_hrf(dt: float, length: float = 32.0) -> 'np.array':
+    """
+    Canonical double-gamma haemodynamic response function, as in SPM: gamma shapes 6 and 16 (peaks at about 5 s
+    and 15 s) for the response and the undershoot, with a 1:6 undershoot to response ratio
+
+    Parameters
+    ----------
+
+    dt: float
+        sampling interval, in seconds
+
+    length: float, default: 32.0
+            duration of the response, in seconds
+
+    Returns
+    -------
+
+    hrf: np.array
+         response sampled every dt seconds, scaled to sum 1
+    """
+
+    times = np.arange(0, length, dt)
+
+    def gamma_pdf(shape):
+        return np.exp((shape - 1) * np.log(np.maximum(times, 1e-12)) - times - math.lgamma(shape))
+
+    hrf = gamma_pdf(6) - gamma_pdf(16) / 6
+
+    return hrf / hrf.sum()
+
+
+def _fast_fft_size(minimum: int) -> int:
+    """Smallest number of the form 2^a 3^b 5^c that is at least minimum. FFTs of these sizes are the fastest"""
+
+    best = 1 << int(np.ceil(np.log2(minimum)))
+    power_5 = 1
+
+    while power_5 < best:
+        power_35 = power_5
+
+        while power_35 < best:
+            size = power_35 << max(int(np.ceil(np.log2(minimum / power_35))), 0)
+            best = min(best, size)
+            power_35 *= 3
+
+        power_5 *= 5
+
+    return best
+
+
+def design_efficiency(label_matrix: 'np.array', onsets: 'np.array', labels: int, tr: float,
+                      contrasts: 'np.array' = None, oversampling: int = 4, hrf: 'np.array' = None) -> 'np.array':
+    """
+    Score the efficiency of a batch of trial orders for estimating the given contrasts.
+
+    The trials of each order are placed on a grid of tr / oversampling seconds and convolved with the HRF, all
+    orders at once with FFTs, and the regressors are sampled once per scan, until the response to the last trial of
+    the order is over. A constant regressor is added, and the efficiency of each order is 1 / trace(C (X'X)^-1 C'),
+    with the (X'X) matrices of the batch inverted together.
+
+    Parameters
+    ----------
+
+    label_matrix: np.array
+                  (orders, trials) matrix with the category of each trial, from 0 to labels - 1
+
+    onsets: np.array
+            (orders, trials) or (trials,) onset of each trial, in seconds
+
+    labels: int
+            number of categories
+
+    tr: float
+        repetition time of the scans, in seconds
+
+    contrasts: np.array, default: None
+               (contrasts, labels) matrix with one contrast between categories per row. Defaults to every category
+               against the baseline
+
+    oversampling: int, default: 4
+                  number of time bins per scan used to place the onsets
+
+    hrf: np.array, default: None
+         response to a single trial, sampled every tr / oversampling seconds. Defaults to canonical_hrf
+
+    Returns
+    -------
+
+    efficiency: np.array
+                efficiency of each order. Higher is better
+    """
+
+    label_matrix = np.asarray(label_matrix)
+    orders, trials = label_matrix.shape
+    onsets = np.broadcast_to(onsets, label_matrix.shape)
+
+    dt = tr / oversampling
+    hrf = canonical_hrf(dt) if hrf is None else np.asarray(hrf)
+    contrasts = np.eye(labels) if contrasts is None else np.atleast_2d(contrasts)
+
+    # Stick functions of every category, then the convolution with the HRF
+    bins = np.rint(onsets / dt).astype(int)
+    scans = int(np.ceil((bins.max() + len(hrf)) / oversampling))
+    length = scans * oversampling
+
+    flat_bins = (np.arange(orders)[:, None] * labels + label_matrix) * length + bins
+    sticks = np.bincount(flat_bins.ravel(), minlength=orders * labels * length).reshape(orders, labels, length)
+
+    size = _fast_fft_size(length + len(hrf))
+    spectrum = np.fft.rfft(sticks, size, axis=2) * np.fft.rfft(hrf, size)
+    regressors = np.fft.irfft(spectrum, size, axis=2)[:, :, :length:oversampling]
+
+    # Each order is only scanned until its own response is over, whatever the other orders of the batch
+    scanned = np.arange(scans)[None, :] < np.ceil((bins.max(axis=1) + len(hrf)) / oversampling)[:, None]
+    design = np.concatenate([regressors, np.ones((orders, 1, scans))], axis=1) * scanned[:, None, :]
+    information = design @ design.transpose(0, 2, 1)
+
+    contrasts = np.concatenate([contrasts, np.zeros((len(contrasts), 1))], axis=1)
+    variance = np.einsum('ki,oij,kj->o', contrasts, np.linalg.inv(information), contrasts)
+
+    return 1 / variance
+
+
+def trial_onsets(soa: float or list, orders: int, trials: int, rng: 'np.random.Generator') -> 'np.array':
+    """
+    Onsets of the trials of a batch of orders
+
+    Parameters
+    ----------
+
+    soa: float or list of float
+         time between the onsets of two trials, in seconds. If a list, the time before each trial is drawn from it
+         at random, giving a jittered schedule
+
+    orders: int
+            number of orders
+
+    trials: int
+            number of trials per order
+
+    rng: np.random.Generator
+         random generator to draw the jitter from
+
+    Returns
+    -------
+
+    onsets: np.array
+            (orders, trials) onset of each trial, in seconds, starting at 0
+    """
+
+    if np.ndim(soa) == 0:
+        intervals = np.full((orders, trials - 1), float(soa))
+    else:
+        intervals = rng.choice(np.asarray(soa, dtype=float), size=(orders, trials - 1))
+
+    return np.concatenate([np.zeros((orders, 1)), np.cumsum(intervals, axis=1)], axis=1)
@@ -0,0 +1,141 @@
+"""
+Content hashing of stimulus files, to check that generated subsets and prerands still point at the same stimuli
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import hashlib
+import json
+import mmap
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def hash_file(path: str) -> str:
+    """
+    Compute the BLAKE2b digest of a file. The file is memory-mapped, so it is never copied into Python memory
+
+    Parameters
+    ----------
+
+    path: str
+          path of the file to hash
+
+    Returns
+    -------
+
+    digest: str
+            hexadecimal BLAKE2b digest of the file contents
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(path, 'rb') as stim_file:
+        # Empty files cannot be memory-mapped
+        if os.fstat(stim_file.fileno()).st_size:
+            with mmap.mmap(stim_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+
+    return digest.hexdigest()
+
+
+def load_cache(cache_path: str or None) -> dict:
+    """
+    Read a hash cache written by save_cache. A missing or unreadable file gives an empty cache
+
+    Parameters
+    ----------
+
+    cache_path: str or None
+                path of the json cache file
+
+    Returns
+    -------
+
+    cache: dict
+           filenames as keys and [size, mtime_ns, digest] lists as values
+    """
+
+    if cache_path is None:
+        return {}
+
+    try:
+        with open(cache_path) as cache_file:
+            return json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_cache(cache_path: str, cache: dict) -> None:
+    """
+    Atomically write a hash cache to disk
+
+    Parameters
+    ----------
+
+    cache_path: str
+                path of the json cache file
+
+    cache: dict
+           filenames as keys and [size, mtime_ns, digest] lists as values
+
+    Returns
+    -------
+
+    None
+    """
+
+    tmp_path = cache_path + '.part'
+
+    with open(tmp_path, 'w') as cache_file:
+        json.dump(cache, cache_file)
+
+    os.replace(tmp_path, cache_path)
+
+
+def hash_files(root_path: str, filenames: list, cache: dict, workers: int or None = None) -> list:
+    """
+    Hash the given files, in parallel, reusing the digests in cache for the files whose size and modification
+    time did not change. The cache is updated in place
+
+    Parameters
+    ----------
+
+    root_path: str
+               directory containing the files
+
+    filenames: list of str
+               names of the files to hash
+
+    cache: dict
+           filenames as keys and [size, mtime_ns, digest] lists as values
+
+    workers: int or None, default: None
+             number of threads hashing files. Defaults to the ThreadPoolExecutor default
+
+    Returns
+    -------
+
+    rehashed: list of str
+              names of the files that had to be hashed because they were not in the cache or changed on disk
+    """
+
+    stale = []
+
+    for filename in filenames:
+        stat = os.stat(os.path.join(root_path, filename))
+        entry = cache.get(filename)
+
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            stale.append((filename, stat))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = pool.map(hash_file, [os.path.join(root_path, filename) for filename, _ in stale])
+
+        for (filename, stat), digest in zip(stale, digests):
+            cache[filename] = [stat.st_size, stat.st_mtime_ns, digest]
+
+    return [filename for filename, _ in stale]
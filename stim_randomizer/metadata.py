@@ -0,0 +1,267 @@
+"""
+Helpers to read stimulus metadata tables into columnar arrays
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def load_metadata(source: str or dict, key: str = 'filename') -> dict:
+    """
+    Read a metadata table and return it as a dictionary of NumPy arrays, one per column
+
+    Parameters
+    ----------
+
+    source: str, dict or StimMetadata
+            path to a .csv, .tsv or .parquet file, a mapping of column names to sequences that is already
+            in memory, or a StimMetadata store. Reading parquet files requires pyarrow
+
+    key: str, default: 'filename'
+         column with the stimulus filenames
+
+    Returns
+    -------
+
+    columns: dict
+             column names as keys and np.array of the column values as values
+    """
+
+    if isinstance(source, StimMetadata):
+        columns = dict(source.columns)
+        columns[key] = source.filenames
+
+    elif isinstance(source, dict):
+        columns = {name: np.asarray(values) for name, values in source.items()}
+
+    else:
+        extension = os.path.splitext(source)[1].lower()
+
+        if extension == '.parquet':
+            table = pd.read_parquet(source)
+        elif extension == '.tsv':
+            table = pd.read_csv(source, sep='\t')
+        else:
+            table = pd.read_csv(source)
+
+        columns = {name: table[name].to_numpy() for name in table.columns}
+
+    if key not in columns:
+        raise ValueError("The metadata has no '{0}' column to match the stim filenames".format(key))
+
+    columns[key] = columns[key].astype(str)
+
+    return columns
+
+
+def stratum_codes(columns: dict, strata: list, bins: dict or None = None) -> 'np.array':
+    """
+    Combine several metadata columns into a single integer stratum code per row
+
+    Columns listed in bins are cut into that many quantile bins, the rest are treated as categorical
+
+    Parameters
+    ----------
+
+    columns: dict
+             columnar metadata, as returned by load_metadata
+
+    strata: list of str
+            names of the columns to stratify on
+
+    bins: dict or None, default: None
+          number of quantile bins for each numerical column in strata
+
+    Returns
+    -------
+
+    codes: np.array
+           stratum of each row, numbered from 0 to the number of non-empty strata
+    """
+
+    bins = bins or {}
+    codes = []
+    dims = []
+
+    for column in strata:
+        values = columns[column]
+
+        if column in bins:
+            edges = np.quantile(values.astype(float), np.linspace(0, 1, bins[column] + 1)[1:-1])
+            code = np.searchsorted(edges, values, side='left')
+            dims.append(bins[column])
+        else:
+            uniques, code = np.unique(values, return_inverse=True)
+            dims.append(len(uniques))
+
+        codes.append(code.ravel())
+
+    combined = np.ravel_multi_index(codes, dims)
+    _, codes = np.unique(combined, return_inverse=True)
+
+    return codes
+
+
+class StimMetadata:
+    """
+    Columnar store of the metadata of a set of stimuli. The metadata table is joined on the stimulus filenames,
+    so that every column is a NumPy array aligned with filenames.
+
+    Tables read from disk are cached in a binary .npz file next to them, which is reused as long as the
+    modification time and size of the table do not change.
+
+    Parameters
+    ----------
+
+    source: str or dict
+            path to a .csv, .tsv or .parquet file, or a mapping of column names to sequences
+
+    filenames: list of str
+               names of the stimulus files to join the metadata on
+
+    key: str, default: 'filename'
+         metadata column with the stimulus filenames
+
+    cache: bool, default: True
+           whether to read and write the .npz cache of a table read from disk
+
+    Attributes
+    ----------
+
+    filenames: np.array
+               names of the stimulus files, sorted
+
+    columns: dict
+             metadata column names as keys and np.array aligned with filenames as values
+
+    key: str
+         name of the filename column in the source table
+    """
+
+    cache_suffix = '.cache.npz'
+
+    def __init__(self, source: str or dict, filenames: list, key: str = 'filename', cache: bool = True) -> None:
+        self.key = key
+        self.filenames = np.array(sorted(filenames), dtype=str)
+
+        if isinstance(source, dict) or not cache:
+            table = load_metadata(source, key)
+        else:
+            table = self._load_cached(source, key)
+
+        # Join the metadata rows on the stim filenames
+        rows = pd.Index(table.pop(key)).get_indexer(self.filenames)
+
+        if (rows == -1).any():
+            missing = self.filenames[rows == -1]
+            raise ValueError("'{0}' stim files have no metadata, e.g. '{1}'".format(len(missing), missing[0]))
+
+        self.columns = {name: values[rows] for name, values in table.items()}
+
+    @classmethod
+    def _load_cached(cls, source: str, key: str) -> dict:
+        """
+        Load the table from its .npz cache if it is up to date, or parse it and refresh the cache otherwise
+
+        Parameters
+        ----------
+
+        source: str
+                path to the metadata table
+
+        key: str
+             metadata column with the stimulus filenames
+
+        Returns
+        -------
+
+        columns: dict
+                 columnar metadata, as returned by load_metadata
+        """
+
+        cache_path = source + cls.cache_suffix
+        stat = os.stat(source)
+        stamp = np.array([stat.st_mtime_ns, stat.st_size])
+
+        try:
+            with np.load(cache_path, allow_pickle=False) as cached:
+                if np.array_equal(cached['__stamp__'], stamp) and key in cached.files:
+                    return {name: cached[name] for name in cached.files if name != '__stamp__'}
+        except (OSError, ValueError, KeyError):
+            pass
+
+        columns = load_metadata(source, key)
+
+        # Object columns cannot be stored without pickling, so keep them as strings
+        columns = {name: values.astype(str) if values.dtype == object else values
+                   for name, values in columns.items()}
+
+        try:
+            np.savez(cache_path, __stamp__=stamp, **columns)
+        except OSError:
+            pass
+
+        return columns
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    def __getitem__(self, column: str) -> 'np.array':
+        return self.columns[column]
+
+    def filter(self, **conditions) -> 'np.array':
+        """
+        Select the stimuli whose metadata equals the given values
+
+        Parameters
+        ----------
+
+        conditions: dict
+                    column names as keys and the required values as values. A list or tuple of values selects any of
+                    them
+
+        Returns
+        -------
+
+        filenames: np.array
+                   names of the stimuli that meet every condition
+        """
+
+        mask = np.ones(len(self), dtype=bool)
+
+        for column, value in conditions.items():
+            if isinstance(value, (list, tuple)):
+                mask &= np.isin(self.columns[column], value)
+            else:
+                mask &= self.columns[column] == value
+
+        return self.filenames[mask]
+
+    def groups(self, column: str) -> dict:
+        """
+        Group the stimuli by the values of a column
+
+        Parameters
+        ----------
+
+        column: str
+                name of the column to group by
+
+        Returns
+        -------
+
+        groups: dict
+                each value of the column as keys and np.array of the names of the stimuli with that value as values
+        """
+
+        uniques, codes = np.unique(self.columns[column], return_inverse=True)
+        order = np.argsort(codes, kind='stable')
+        chunks = np.split(self.filenames[order], np.cumsum(np.bincount(codes, minlength=len(uniques)))[:-1])
+
+        return {value.item(): chunk for value, chunk in zip(uniques, chunks)}
@@ -0,0 +1,229 @@
+"""
+Background prefetching of stimulus files, following the order of a prerand
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import csv
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from stim_randomizer.sources import StimSource, as_source
+
+
+class StimPrefetcher:
+    """
+    The StimPrefetcher loads the stim of the upcoming trials in background threads while the experiment runs,
+    so that the files are already in memory when their trial starts. Loaded files are kept in a least recently
+    used cache with a limit on its total size.
+
+    Parameters
+    ----------
+
+    order: list of str or str
+           filenames in presentation order, or the path of a prerand file created by ExPrerands
+
+    root_path: str or StimSource
+               absolute path to the directory (or zip/tar archive) that contains the stim files, or a stim source,
+               e.g. ExpStim.source
+
+    depth: int, default: 4
+           number of upcoming stimuli loaded ahead of the current trial
+
+    max_bytes: int, default: 256 MiB
+               maximum size of the cache. Files bigger than this are loaded but never cached
+
+    workers: int, default: 2
+             number of threads loading files
+
+    Attributes
+    ----------
+
+    order: list of str
+           filenames in presentation order
+
+    source: StimSource
+            where the stim files are read from
+
+    depth: int
+           number of upcoming stimuli loaded ahead of the current trial
+
+    max_bytes: int
+               maximum size of the cache
+    """
+
+    def __init__(self, order: list or str, root_path: str or StimSource, depth: int = 4,
+                 max_bytes: int = 256 * 2 ** 20, workers: int = 2) -> None:
+
+        if isinstance(order, str):
+            with open(order) as csvfile:
+                order = [row[0] for row in csv.reader(csvfile, delimiter='\t') if row]
+
+        self.order = list(order)
+        self.source = as_source(root_path)
+        self.depth = depth
+        self.max_bytes = max_bytes
+
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._next = 0
+        self._closed = False
+
+        self._hits = 0
+        self._waits = 0
+        self._misses = 0
+        self._latencies = []
+
+    def __enter__(self) -> 'StimPrefetcher':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __iter__(self):
+        for position in range(len(self.order)):
+            yield self.get(position)
+
+    def _load(self, filename: str) -> bytes:
+        """
+        Read a stim file and store it in the cache, evicting the least recently used files if needed
+
+        Parameters
+        ----------
+
+        filename: str
+                  name of the stim file
+
+        Returns
+        -------
+
+        data: bytes
+              contents of the file
+        """
+
+        data = self.source.read(filename)
+
+        with self._lock:
+            self._pending.pop(filename, None)
+
+            if len(data) <= self.max_bytes and filename not in self._cache:
+                self._cache[filename] = data
+                self._cached_bytes += len(data)
+
+                while self._cached_bytes > self.max_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cached_bytes -= len(evicted)
+
+        return data
+
+    def _prefetch(self, position: int) -> None:
+        """
+        Schedule the loading of the stim of the trials following position
+
+        Parameters
+        ----------
+
+        position: int
+                  current trial
+
+        Returns
+        -------
+
+        None
+        """
+
+        with self._lock:
+            if self._closed:
+                return
+
+            for upcoming in self.order[position + 1:position + 1 + self.depth]:
+                if upcoming not in self._cache and upcoming not in self._pending:
+                    self._pending[upcoming] = self._pool.submit(self._load, upcoming)
+
+    def get(self, position: int or None = None) -> bytes:
+        """
+        Get the contents of the stim of a trial, and start loading the next ones
+
+        Parameters
+        ----------
+
+        position: int or None, default: None
+                  trial to get. If None, the trial after the last one requested
+
+        Returns
+        -------
+
+        data: bytes
+              contents of the stim file
+        """
+
+        if position is None:
+            position = self._next
+
+        self._next = position + 1
+        filename = self.order[position]
+        start = time.perf_counter()
+
+        with self._lock:
+            data = self._cache.get(filename)
+            future = self._pending.get(filename)
+
+            if data is not None:
+                self._cache.move_to_end(filename)
+
+        self._prefetch(position)
+
+        if data is not None:
+            self._hits += 1
+        elif future is not None:
+            # Requested while still loading
+            data = future.result()
+            self._waits += 1
+        else:
+            data = self._load(filename)
+            self._misses += 1
+
+        self._latencies.append(time.perf_counter() - start)
+
+        return data
+
+    def stats(self) -> dict:
+        """
+        Summary of the cache behaviour so far, to choose a depth for a given site
+
+        Returns
+        -------
+
+        stats: dict
+               'hits' (already in memory), 'waits' (still loading when requested), 'misses' (loaded on request),
+               'hit_rate', 'mean_latency' and 'max_latency' of get in seconds, and 'cached_bytes'
+        """
+
+        requests = len(self._latencies)
+
+        return {'hits': self._hits,
+                'waits': self._waits,
+                'misses': self._misses,
+                'hit_rate': self._hits / requests if requests else 0.0,
+                'mean_latency': sum(self._latencies) / requests if requests else 0.0,
+                'max_latency': max(self._latencies, default=0.0),
+                'cached_bytes': self._cached_bytes}
+
+    def close(self) -> None:
+        """Stop the loading threads. Stim that were already loaded can still be requested"""
+
+        with self._lock:
+            self._closed = True
+
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,95 @@
+"""
+Progress reports and cooperative cancellation for long-running generation
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import time
+
+
+class GenerationCancelled(Exception):
+    """Raised when generation stops because its cancellation token was set"""
+
+
+class ProgressTracker:
+    """
+    The ProgressTracker counts the items done by a generation method, reports them to a callback after every
+    chunk, and stops the generation between chunks when its cancellation token is set
+
+    Parameters
+    ----------
+
+    total: int
+           number of items the generation will produce
+
+    callback: callable or None, default: None
+              function called with a progress report after every chunk. See advance
+
+    cancel: threading.Event or None, default: None
+            cancellation token. Any object with an is_set method works
+
+    Attributes
+    ----------
+
+    total: int
+           number of items the generation will produce
+
+    done: int
+          number of items done so far
+    """
+
+    def __init__(self, total: int, callback: 'callable' = None, cancel: 'threading.Event' = None) -> None:
+        self.total = total
+        self.done = 0
+        self._callback = callback
+        self._cancel = cancel
+        self._made = 0
+        self._start = time.perf_counter()
+
+    def check(self) -> None:
+        """Raise GenerationCancelled if the cancellation token is set"""
+
+        if self._cancel is not None and self._cancel.is_set():
+            raise GenerationCancelled('Generation cancelled after {0} of {1} items'.format(self.done, self.total))
+
+    def advance(self, items: int, resumed: bool = False) -> None:
+        """
+        Count a finished chunk and report the progress to the callback
+
+        The report is a dict with the items 'done' so far, the 'total', the 'elapsed' seconds, the 'rate' in items
+        per second and the 'eta' in seconds (None until the rate is known). Resumed items, which were already on
+        disk, count as done but not towards the rate
+
+        Parameters
+        ----------
+
+        items: int
+               number of items in the chunk
+
+        resumed: bool, default: False
+                 whether the chunk was only read back from disk
+
+        Returns
+        -------
+
+        None
+        """
+
+        self.done += items
+
+        if not resumed:
+            self._made += items
+
+        if self._callback is None:
+            return
+
+        elapsed = time.perf_counter() - self._start
+        rate = self._made / elapsed if self._made and elapsed > 0 else None
+
+        self._callback({'done': self.done,
+                        'total': self.total,
+                        'elapsed': elapsed,
+                        'rate': rate,
+                        'eta': (self.total - self.done) / rate if rate else None})
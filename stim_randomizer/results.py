@@ -0,0 +1,300 @@
+"""
+Compact in-memory containers for the subsets and prerands created by ExpSets and ExPrerands
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import numpy as np
+
+
+class SubsetResult:
+    """
+    Subsets of a stimulus bank, stored as int32 indices into a single array of filenames. The subsets are kept
+    one after the other in a flat array, so they do not need to have the same size.
+
+    Parameters
+    ----------
+
+    names: np.array
+           filenames of the stimuli, shared by every subset
+
+    indices: np.array
+             positions in names of the stimuli of every subset, concatenated
+
+    offsets: np.array
+             start of each subset in indices, with len(indices) appended at the end
+
+    Attributes
+    ----------
+
+    names: np.array
+           filenames of the stimuli
+
+    indices: np.array of int32
+             positions in names of the stimuli of every subset, concatenated
+
+    offsets: np.array of int64
+             start of each subset in indices, followed by len(indices)
+    """
+
+    __slots__ = ('names', 'indices', 'offsets')
+
+    def __init__(self, names: 'np.array', indices: 'np.array', offsets: 'np.array') -> None:
+        self.names = np.asarray(names)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_lists(cls, names: 'np.array', subsets: list) -> 'SubsetResult':
+        """
+        Build the container from the filenames of each subset
+
+        Parameters
+        ----------
+
+        names: np.array
+               sorted filenames of all the stimuli
+
+        subsets: list
+                 each element is a list with the filenames of one subset
+
+        Returns
+        -------
+
+        result: SubsetResult
+                container holding the subsets
+        """
+
+        names = np.asarray(names)
+        sizes = [len(subset) for subset in subsets]
+        flat = np.concatenate([np.asarray(subset, dtype=names.dtype) for subset in subsets]) if subsets else []
+        indices = np.searchsorted(names, flat)
+
+        return cls(names, indices, np.concatenate([[0], np.cumsum(sizes)]))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, item: int or slice) -> 'np.array or SubsetResult':
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+
+            if step != 1:
+                return SubsetResult.from_lists(self.names, [self.to_names(i) for i in range(start, stop, step)])
+
+            offsets = self.offsets[start:stop + 1]
+
+            return SubsetResult(self.names, self.indices[offsets[0]:offsets[-1]], offsets - offsets[0])
+
+        if item < 0:
+            item += len(self)
+
+        return self.indices[self.offsets[item]:self.offsets[item + 1]]
+
+    def sizes(self) -> 'np.array':
+        """Number of stimuli in each subset"""
+
+        return np.diff(self.offsets)
+
+    def to_names(self, item: int or None = None) -> 'np.array':
+        """
+        Decode the indices of one subset, or of all of them, into filenames
+
+        Parameters
+        ----------
+
+        item: int or None, default: None
+              subset to decode. If None, the filenames of every subset are returned, concatenated
+
+        Returns
+        -------
+
+        names: np.array
+               filenames of the requested stimuli
+        """
+
+        indices = self.indices if item is None else self[item]
+
+        return np.take(self.names, indices)
+
+
+class PrerandResult:
+    """
+    Prerands of a single subset, stored as an int32 matrix of indices into an array of filenames, with one
+    prerand per row. The filename array can be shared between the prerands of several subsets.
+
+    Parameters
+    ----------
+
+    names: np.array
+           filenames of the stimuli
+
+    indices: np.array
+             (prerands, trials) matrix with the position in names of the stimulus of each trial
+
+    Attributes
+    ----------
+
+    names: np.array
+           filenames of the stimuli
+
+    indices: np.array of int32
+             (prerands, trials) matrix with the position in names of the stimulus of each trial
+    """
+
+    __slots__ = ('names', 'indices')
+
+    def __init__(self, names: 'np.array', indices: 'np.array') -> None:
+        self.names = np.asarray(names)
+        self.indices = np.asarray(indices, dtype=np.int32)
+
+        if self.indices.ndim != 2:
+            raise ValueError('indices must be a (prerands, trials) matrix')
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, item: int or slice) -> 'np.array or PrerandResult':
+        if isinstance(item, slice):
+            return PrerandResult(self.names, self.indices[item])
+
+        return self.indices[item]
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the index matrix, in bytes"""
+
+        return self.indices.nbytes
+
+    def to_names(self, item: int or None = None) -> 'np.array':
+        """
+        Decode the indices of one prerand, or of all of them, into filenames
+
+        Parameters
+        ----------
+
+        item: int or None, default: None
+              prerand to decode. If None, a (prerands, trials) matrix of filenames is returned
+
+        Returns
+        -------
+
+        names: np.array
+               filenames of the requested prerands
+        """
+
+        indices = self.indices if item is None else self[item]
+
+        return np.take(self.names, indices)
+
+
+class SessionSchedule:
+    """
+    Trial orders of a multi-session study, as an int32 (participants, sessions, trials) tensor of indices into a
+    single array of filenames. Every session of a participant uses a different subset of the stimuli.
+
+    Parameters
+    ----------
+
+    names: np.array
+           filenames of the stimuli
+
+    indices: np.array
+             (participants, sessions, trials) tensor with the position in names of the stimulus of each trial
+
+    subsets: np.array
+             (participants, sessions) matrix with the subset used by each participant in each session
+
+    Attributes
+    ----------
+
+    names: np.array
+           filenames of the stimuli
+
+    indices: np.array of int32
+             (participants, sessions, trials) tensor with the position in names of the stimulus of each trial
+
+    subsets: np.array of int32
+             (participants, sessions) matrix with the subset used by each participant in each session
+    """
+
+    __slots__ = ('names', 'indices', 'subsets')
+
+    def __init__(self, names: 'np.array', indices: 'np.array', subsets: 'np.array') -> None:
+        self.names = np.asarray(names)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.subsets = np.asarray(subsets, dtype=np.int32)
+
+        if self.indices.ndim != 3 or self.indices.shape[:2] != self.subsets.shape:
+            raise ValueError('indices must be a (participants, sessions, trials) tensor matching subsets')
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, item: int or tuple) -> 'np.array':
+        return self.indices[item]
+
+    def to_names(self, participant: int, session: int or None = None) -> 'np.array':
+        """
+        Decode the trials of a participant, for one session or for all of them, into filenames
+
+        Parameters
+        ----------
+
+        participant: int
+                     participant to decode
+
+        session: int or None, default: None
+                 session to decode. If None, a (sessions, trials) matrix of filenames is returned
+
+        Returns
+        -------
+
+        names: np.array
+               filenames of the requested trials
+        """
+
+        indices = self.indices[participant] if session is None else self.indices[participant, session]
+
+        return np.take(self.names, indices)
+
+    def save(self, path: str) -> None:
+        """
+        Store the whole schedule in a single .npz file
+
+        Parameters
+        ----------
+
+        path: str
+              destination of the file
+
+        Returns
+        -------
+
+        None
+        """
+
+        np.savez(path, names=self.names, indices=self.indices, subsets=self.subsets)
+
+    @classmethod
+    def load(cls, path: str) -> 'SessionSchedule':
+        """
+        Read a schedule written by save
+
+        Parameters
+        ----------
+
+        path: str
+              path of the .npz file
+
+        Returns
+        -------
+
+        schedule: SessionSchedule
+                  the stored schedule
+        """
+
+        with np.load(path, allow_pickle=False) as stored:
+            return cls(stored['names'], stored['indices'], stored['subsets'])
@@ -0,0 +1,205 @@
+"""
+Stimulus sources: where the stim filenames are listed from and where the results are written to
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import os
+import tarfile
+import threading
+import zipfile
+
+from abc import ABC, abstractmethod
+
+
+class StimSource(ABC):
+    """
+    Base class of the stimulus sources. A source lists the names of the stim files, reads their contents and
+    decides where the subset and prerand files go. ExpStim, ExpSets, ExPrerands and StimPrefetcher accept a source
+    wherever they take the path to the stim files. Subclasses must implement names and read
+
+    Attributes
+    ----------
+
+    path: str or None
+          path of the directory or archive holding the stim files, or None for in-memory sources
+    """
+
+    path = None
+
+    @abstractmethod
+    def names(self) -> list:
+        """Sorted names of the stim files"""
+
+    @abstractmethod
+    def read(self, name: str) -> bytes:
+        """Contents of a stim file"""
+
+    def output_dir(self, dir_type: str, name: str) -> str or None:
+        """
+        Path of an output directory of the source
+
+        Parameters
+        ----------
+
+        dir_type: {'parent', 'child'}
+                  'parent' puts the directory next to the stim, and 'child' inside their directory
+
+        name: str
+              name of the output directory, e.g. 'subsets'
+
+        Returns
+        -------
+
+        out_dir: str or None
+                 path of the output directory, or None if the results of this source are only kept in memory
+        """
+
+        return None
+
+
+class DirectorySource(StimSource):
+    """
+    Stim files inside a local directory. Sub-directories, such as 'child' output directories, are not stim
+
+    Parameters
+    ----------
+
+    path: str
+          path to the directory that contains the stim files
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = os.fspath(path)
+
+    def names(self) -> list:
+        return sorted(file for file in os.listdir(self.path) if os.path.isfile(os.path.join(self.path, file)))
+
+    def read(self, name: str) -> bytes:
+        with open(os.path.join(self.path, name), 'rb') as stim_file:
+            return stim_file.read()
+
+    def output_dir(self, dir_type: str, name: str) -> str:
+        if dir_type == 'parent':
+            return os.path.join(self.path, '../' + name)
+
+        return os.path.join(self.path, name)
+
+
+class MemorySource(StimSource):
+    """
+    Stim that only exist as a list of names, e.g. to plan an experiment or benchmark without touching the
+    filesystem. Nothing is written to disk: subsets and prerands are only kept in memory (and in the store, if
+    there is one)
+
+    Parameters
+    ----------
+
+    names: list of str
+           names of the stim files
+
+    contents: dict or None, default: None
+              names as keys and the contents of each stim as bytes values, for the stim that can be read
+    """
+
+    def __init__(self, names: list, contents: dict or None = None) -> None:
+        self._names = sorted(str(name) for name in names)
+        self.contents = contents or {}
+
+    def names(self) -> list:
+        return list(self._names)
+
+    def read(self, name: str) -> bytes:
+        try:
+            return self.contents[name]
+        except KeyError:
+            raise ValueError("There are no contents for the in-memory stim '{0}'".format(name)) from None
+
+
+class ArchiveSource(StimSource):
+    """
+    Stim files inside a zip or tar archive, which is never extracted. Zip listings come from the central directory
+    at the end of the archive, and tar listings from the member headers, so listing does not read the stim
+    themselves. Subsets and prerands are written next to the archive
+
+    Parameters
+    ----------
+
+    path: str
+          path to the .zip or .tar (optionally compressed) archive
+
+    member_dir: str, default: ''
+                directory inside the archive that contains the stim files. Files in other directories are ignored
+    """
+
+    def __init__(self, path: str, member_dir: str = '') -> None:
+        self.path = os.fspath(path)
+        self.member_dir = member_dir.strip('/')
+
+        if zipfile.is_zipfile(self.path):
+            self._archive = zipfile.ZipFile(self.path)
+            members = [(info.filename, info) for info in self._archive.infolist() if not info.is_dir()]
+        elif tarfile.is_tarfile(self.path):
+            self._archive = tarfile.open(self.path)
+            members = [(info.name, info) for info in self._archive.getmembers() if info.isfile()]
+        else:
+            raise ValueError("'{0}' is not a zip or tar archive".format(self.path))
+
+        self._members = {os.path.basename(name): info for name, info in members
+                         if os.path.dirname(name).strip('/') == self.member_dir}
+        # Archive readers keep a single file position, so reads from several threads take turns
+        self._lock = threading.Lock()
+
+    def names(self) -> list:
+        return sorted(self._members)
+
+    def read(self, name: str) -> bytes:
+        member = self._members[name]
+
+        with self._lock:
+            if isinstance(self._archive, zipfile.ZipFile):
+                return self._archive.read(member)
+
+            return self._archive.extractfile(member).read()
+
+    def output_dir(self, dir_type: str, name: str) -> str:
+        if dir_type == 'child':
+            raise ValueError("Output directories cannot be created inside an archive, use dir_type 'parent'")
+
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)), name)
+
+    def close(self) -> None:
+        """Close the archive file"""
+
+        self._archive.close()
+
+
+def as_source(source: 'str or list or StimSource') -> StimSource:
+    """
+    Turn the stim location given to the randomizer classes into a StimSource
+
+    Parameters
+    ----------
+
+    source: str, list or StimSource
+            path to a directory or to a zip/tar archive, a list of stim names, or a source that is returned as is
+
+    Returns
+    -------
+
+    source: StimSource
+            the matching source
+    """
+
+    if isinstance(source, StimSource):
+        return source
+
+    if isinstance(source, (str, os.PathLike)):
+        if os.path.isfile(source) and (zipfile.is_zipfile(source) or tarfile.is_tarfile(source)):
+            return ArchiveSource(source)
+
+        return DirectorySource(source)
+
+    return MemorySource(source)
@@ -0,0 +1,424 @@
+"""
+SQLite store for subsets, prerands and participant assignments, to query them without reading every tsv file
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+
+"""
+
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stimuli (
+    stimulus INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS runs (
+    run INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    touched INTEGER NOT NULL,
+    UNIQUE (kind, key)
+);
+CREATE TABLE IF NOT EXISTS subsets (
+    run INTEGER NOT NULL REFERENCES runs,
+    subset INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    stimulus INTEGER NOT NULL REFERENCES stimuli,
+    PRIMARY KEY (run, subset, position)
+);
+CREATE TABLE IF NOT EXISTS prerands (
+    run INTEGER NOT NULL REFERENCES runs,
+    subset INTEGER NOT NULL,
+    prerand INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    stimulus INTEGER NOT NULL REFERENCES stimuli,
+    PRIMARY KEY (run, subset, prerand, position)
+);
+CREATE TABLE IF NOT EXISTS assignments (
+    run INTEGER NOT NULL REFERENCES runs,
+    participant INTEGER NOT NULL,
+    session INTEGER NOT NULL,
+    subset INTEGER NOT NULL,
+    prerand INTEGER,
+    PRIMARY KEY (run, participant, session)
+);
+CREATE TABLE IF NOT EXISTS session_trials (
+    run INTEGER NOT NULL REFERENCES runs,
+    participant INTEGER NOT NULL,
+    session INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    stimulus INTEGER NOT NULL REFERENCES stimuli,
+    PRIMARY KEY (run, participant, session, position)
+);
+CREATE INDEX IF NOT EXISTS subsets_stimulus ON subsets (run, stimulus);
+CREATE INDEX IF NOT EXISTS prerands_stimulus ON prerands (run, stimulus, position);
+CREATE INDEX IF NOT EXISTS assignments_subset ON assignments (run, subset, prerand);
+CREATE INDEX IF NOT EXISTS session_trials_stimulus ON session_trials (run, stimulus, position);
+"""
+
+
+class ResultStore:
+    """
+    The ResultStore keeps subsets, prerands and participant assignments in an indexed SQLite database. Rows are
+    inserted in bulk, one transaction per call, and the tables are indexed both by (subset, prerand, position)
+    and by stimulus, so questions like "which prerands have this stimulus first" need no file scanning.
+
+    Subsets, prerands, sessions and positions are numbered from 1, like the subset and prerand files.
+
+    Every request of subsets, prerands or sessions is a run of its own, started with start_run, so that runs cannot
+    overwrite each other's rows. A request that is resumed, or made again with the same parameters, gets its
+    previous run back and replaces its rows. Queries read the run that was started last, unless one is given.
+
+    Parameters
+    ----------
+
+    path: str
+          path of the database file. It is created if it does not exist
+
+    Attributes
+    ----------
+
+    path: str
+          path of the database file
+
+    connection: sqlite3.Connection
+                open connection to the database
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        for table in ['subsets', 'prerands', 'assignments', 'session_trials']:
+            columns = [column[1] for column in self.connection.execute('PRAGMA table_info({0})'.format(table))]
+
+            if columns and 'run' not in columns:
+                self.connection.close()
+                raise ValueError("'{0}' was created without runs by an older version, use a new store".format(path))
+
+        self.connection.executescript(SCHEMA)
+        self._known = dict(self.connection.execute('SELECT name, stimulus FROM stimuli'))
+
+    def __enter__(self) -> 'ResultStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the connection to the database"""
+
+        self.connection.close()
+
+    def _stimulus_ids(self, names: 'np.array') -> 'np.array':
+        """
+        Register the given filenames and get their stimulus ids
+
+        Parameters
+        ----------
+
+        names: np.array
+               filenames of the stimuli
+
+        Returns
+        -------
+
+        ids: np.array
+             stimulus id of each filename
+        """
+
+        names = [str(name) for name in names]
+        missing = [(name,) for name in names if name not in self._known]
+
+        if missing:
+            self.connection.executemany('INSERT OR IGNORE INTO stimuli (name) VALUES (?)', missing)
+            self._known.update(self.connection.execute('SELECT name, stimulus FROM stimuli'))
+
+        return np.array([self._known[name] for name in names], dtype=np.int64)
+
+    def start_run(self, kind: str, request: dict) -> int:
+        """
+        Get the run of a request, creating it if the request is new, and make it the latest run of its kind
+
+        Parameters
+        ----------
+
+        kind: {'subsets', 'prerands', 'schedule'}
+              what the run stores
+
+        request: dict
+                 parameters that identify the request, e.g. the manifest request of create_prerands. They are
+                 turned into a digest, so they must be JSON serializable
+
+        Returns
+        -------
+
+        run: int
+             id of the run, to pass to the write methods
+        """
+
+        key = hashlib.blake2b(json.dumps(request, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO runs (kind, key, touched) VALUES (?, ?, 0)', (kind, key))
+            self.connection.execute('UPDATE runs SET touched = (SELECT MAX(touched) + 1 FROM runs) '
+                                    'WHERE kind = ? AND key = ?', (kind, key))
+            run, = self.connection.execute('SELECT run FROM runs WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+
+        return run
+
+    def latest_run(self, kind: str) -> int or None:
+        """Id of the run of the given kind that was started last, or None if there is none"""
+
+        row = self.connection.execute('SELECT run FROM runs WHERE kind = ? ORDER BY touched DESC LIMIT 1',
+                                      (kind,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def write_subsets(self, run: int, result: 'SubsetResult') -> None:
+        """
+        Store the subsets of a run, replacing every previous row of the run
+
+        Parameters
+        ----------
+
+        run: int
+             run of the subsets, as returned by start_run
+
+        result: SubsetResult
+                subsets as created by ExpSets
+
+        Returns
+        -------
+
+        None
+        """
+
+        with self.connection:
+            ids = self._stimulus_ids(result.names)
+            subset_numbers = np.repeat(np.arange(1, len(result) + 1), result.sizes())
+            positions = np.arange(len(result.indices)) - np.repeat(result.offsets[:-1], result.sizes()) + 1
+
+            self.connection.execute('DELETE FROM subsets WHERE run = ?', (run,))
+            self.connection.executemany('INSERT INTO subsets VALUES (?, ?, ?, ?)',
+                                        zip([run] * len(result.indices), subset_numbers.tolist(),
+                                            positions.tolist(), ids[result.indices].tolist()))
+
+    def write_prerands(self, run: int, subset: int, first_prerand: int, names: 'np.array',
+                       indices: 'np.array') -> None:
+        """
+        Store a batch of prerands of one subset, replacing every previous row of the same prerands of the run
+
+        Parameters
+        ----------
+
+        run: int
+             run of the prerands, as returned by start_run
+
+        subset: int
+                number of the subset, from 1
+
+        first_prerand: int
+                       number of the first prerand of the batch, from 1
+
+        names: np.array
+               filenames of the stimuli
+
+        indices: np.array
+                 (prerands, trials) matrix of positions in names, as in PrerandResult
+
+        Returns
+        -------
+
+        None
+        """
+
+        indices = np.asarray(indices)
+        prerands, trials = indices.shape
+
+        with self.connection:
+            ids = self._stimulus_ids(names)
+            prerand_numbers = np.repeat(np.arange(first_prerand, first_prerand + prerands), trials)
+            positions = np.tile(np.arange(1, trials + 1), prerands)
+
+            self.connection.execute('DELETE FROM prerands WHERE run = ? AND subset = ? AND prerand BETWEEN ? AND ?',
+                                    (run, subset, first_prerand, first_prerand + prerands - 1))
+            self.connection.executemany('INSERT INTO prerands VALUES (?, ?, ?, ?, ?)',
+                                        zip([run] * (prerands * trials), [subset] * (prerands * trials),
+                                            prerand_numbers.tolist(), positions.tolist(),
+                                            ids[indices.ravel()].tolist()))
+
+    def write_assignments(self, run: int, assignments: list) -> None:
+        """
+        Store which subset and prerand each participant got in each session, replacing the previous assignment of
+        the same participant and session of the run
+
+        Parameters
+        ----------
+
+        run: int
+             run of the assignments, as returned by start_run('schedule', ...)
+
+        assignments: list of tuple
+                     (participant, session, subset, prerand) rows. prerand can be None
+
+        Returns
+        -------
+
+        None
+        """
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO assignments VALUES (?, ?, ?, ?, ?)',
+                                        ((run,) + tuple(assignment) for assignment in assignments))
+
+    def write_schedule(self, run: int, schedule: 'SessionSchedule') -> None:
+        """
+        Store a multi-session schedule: the subset of each participant and session as assignments, and every
+        trial in session_trials. Every previous row of the run is replaced
+
+        Parameters
+        ----------
+
+        run: int
+             run of the schedule, as returned by start_run('schedule', ...)
+
+        schedule: SessionSchedule
+                  schedule as created by ExpStim.plan_sessions
+
+        Returns
+        -------
+
+        None
+        """
+
+        participants, sessions, trials = schedule.indices.shape
+        grid = np.indices((participants, sessions, trials)).reshape(3, -1) + 1
+
+        with self.connection:
+            ids = self._stimulus_ids(schedule.names)
+
+            self.connection.execute('DELETE FROM assignments WHERE run = ?', (run,))
+            self.connection.execute('DELETE FROM session_trials WHERE run = ?', (run,))
+            self.connection.executemany('INSERT INTO assignments VALUES (?, ?, ?, ?, NULL)',
+                                        zip([run] * (participants * sessions), grid[0, ::trials].tolist(),
+                                            grid[1, ::trials].tolist(), (schedule.subsets.ravel() + 1).tolist()))
+            self.connection.executemany('INSERT INTO session_trials VALUES (?, ?, ?, ?, ?)',
+                                        zip([run] * len(grid[0]), grid[0].tolist(), grid[1].tolist(),
+                                            grid[2].tolist(), ids[schedule.indices.ravel()].tolist()))
+
+    def subset(self, subset: int, run: int or None = None) -> list:
+        """Filenames of a subset, in order, from the given run or from the latest subsets run"""
+
+        run = self.latest_run('subsets') if run is None else run
+        rows = self.connection.execute('SELECT name FROM subsets JOIN stimuli USING (stimulus) '
+                                       'WHERE run = ? AND subset = ? ORDER BY position', (run, subset))
+
+        return [name for name, in rows]
+
+    def prerand(self, subset: int, prerand: int, run: int or None = None) -> list:
+        """Filenames of a prerand, in order, from the given run or from the latest prerands run"""
+
+        run = self.latest_run('prerands') if run is None else run
+        rows = self.connection.execute('SELECT name FROM prerands JOIN stimuli USING (stimulus) '
+                                       'WHERE run = ? AND subset = ? AND prerand = ? ORDER BY position',
+                                       (run, subset, prerand))
+
+        return [name for name, in rows]
+
+    def prerands_with(self, name: str, position: int or None = None, run: int or None = None) -> list:
+        """
+        Find the prerands that contain a stimulus, optionally at a given position
+
+        Parameters
+        ----------
+
+        name: str
+              filename of the stimulus
+
+        position: int or None, default: None
+                  position of the stimulus in the prerand, from 1. If None, any position
+
+        run: int or None, default: None
+             run of the prerands. If None, the latest prerands run
+
+        Returns
+        -------
+
+        prerands: list of tuple
+                  sorted (subset, prerand, position) of every match
+        """
+
+        query = ('SELECT subset, prerand, position FROM prerands JOIN stimuli USING (stimulus) '
+                 'WHERE run = ? AND name = ?')
+        parameters = (self.latest_run('prerands') if run is None else run, name)
+
+        if position is not None:
+            query += ' AND position = ?'
+            parameters += (position,)
+
+        return sorted(self.connection.execute(query, parameters))
+
+    def assignments_of(self, participant: int, run: int or None = None) -> list:
+        """
+        Subset and prerand of every session of a participant
+
+        Parameters
+        ----------
+
+        participant: int
+                     participant number
+
+        run: int or None, default: None
+             run of the assignments. If None, the latest schedule run
+
+        Returns
+        -------
+
+        assignments: list of tuple
+                     (session, subset, prerand) rows, sorted by session
+        """
+
+        run = self.latest_run('schedule') if run is None else run
+        rows = self.connection.execute('SELECT session, subset, prerand FROM assignments WHERE run = ? '
+                                       'AND participant = ? ORDER BY session', (run, participant))
+
+        return list(rows)
+
+    def participants_with(self, subset: int, prerand: int or None = None, run: int or None = None) -> list:
+        """
+        Participants that were assigned a subset, or a given prerand of it
+
+        Parameters
+        ----------
+
+        subset: int
+                subset number
+
+        prerand: int or None, default: None
+                 prerand number. If None, any prerand
+
+        run: int or None, default: None
+             run of the assignments. If None, the latest schedule run
+
+        Returns
+        -------
+
+        participants: list of tuple
+                      sorted (participant, session) of every match
+        """
+
+        query = 'SELECT participant, session FROM assignments WHERE run = ? AND subset = ?'
+        parameters = (self.latest_run('schedule') if run is None else run, subset)
+
+        if prerand is not None:
+            query += ' AND prerand = ?'
+            parameters += (prerand,)
+
+        return sorted(self.connection.execute(query, parameters))
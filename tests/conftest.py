@@ -84,3 +84,38 @@ def setup_exprerands_from_expstim(setup_expstim_cat):
     yield test_obj
 
     shutil.rmtree(test_obj.out_dir)
+
+
+def _make_stim_dir(stim_dir, files=12, content=False):
+    """Fill a new stim_dir with '[category]_[number].txt' files, files per category or a list with the number of
+    files of each category. With content, every file holds a few KiB to hash, different for each file
+    """
+    stim_dir.mkdir(parents=True)
+
+    for category, category_files in zip(categories, files if isinstance(files, list) else [files] * len(categories)):
+        for i in range(category_files):
+            stim_file = stim_dir / (category + '_%02d.txt' % i)
+
+            if content:
+                stim_file.write_bytes(bytes([i]) * 4096 + category.encode())
+            else:
+                stim_file.touch()
+
+    return str(stim_dir)
+
+
+@pytest.fixture
+def setup_stim_dir(tmp_path, request):
+    """Setup a stim dir in a fresh tmp_path, so that the 'parent' out_dirs do not collide between tests.
+
+    The defaults can be changed for a whole test module with a stim_dir_options dict, and for a single test by
+    parametrizing this fixture indirectly with such a dict. 'files' and 'content' are passed to _make_stim_dir, and
+    'banks', a list of names, gives a list with one stim dir per bank instead, each one in its own folder
+    """
+    options = dict(getattr(request.module, 'stim_dir_options', {}), **getattr(request, 'param', {}))
+    banks = options.pop('banks', None)
+
+    if banks is None:
+        return _make_stim_dir(tmp_path / 'stim', **options)
+
+    return [_make_stim_dir(tmp_path / bank / 'stim', **options) for bank in banks]
@@ -5,13 +5,18 @@ Author: Juan Jesus Torre Tresols
 Mail: juanjesustorre@gmail.com
 """
 
+import json
 import os
 import pytest
+import random
+import shutil
+import subprocess
+import sys
 
 import numpy as np
 import pandas as pd
 
-from stim_randomizer.core import ExPrerands
+from stim_randomizer.core import ExpSets, ExPrerands
 
 categories = ['animal', 'human', 'nature']
 
@@ -52,6 +57,17 @@ def test_subset_parser(setup_exprerands_from_subsets):
     assert len(parsed_sets) == len(os.listdir(esets.subsets_path))
 
 
+def test_subset_parser_orders_subsets_by_number(tmp_path):
+    for number in range(1, 12):
+        (tmp_path / ('subset_%d.tsv' % number)).write_text('stim_%d\n' % number)
+
+    (tmp_path / 'subset_3.tsv.part').write_text('stim_half\n')
+
+    parsed_sets = ExPrerands._subset_parser(str(tmp_path))
+
+    assert parsed_sets == [['stim_%d' % number] for number in range(1, 12)]
+
+
 @pytest.mark.label_mapper
 def test_pseudo_label_mapper(setup_exprerands_from_subsets):
     esets = setup_exprerands_from_subsets
@@ -103,18 +119,6 @@ def test_within_category_random_map(setup_exprerands_from_subsets):
     assert len(np.unique(test_map)) == len(test_map)
 
 
-def test_file_indexer(setup_exprerands_from_subsets):
-    esets = setup_exprerands_from_subsets
-
-    # Test
-    file_list = [file for file in sorted(os.listdir(esets.root_path))
-                 if 'subsets' not in file and 'prerands' not in file]
-
-    test_index = esets._file_indexer(categories, file_list)
-
-    assert len(test_index) == len(file_list)
-
-
 @pytest.mark.smoke
 @pytest.mark.parametrize('method', ['pseudo_con', 'pure_con', 'unconstrained'])
 def test_create_prerandomizations_from_subsets(method, setup_exprerands_from_subsets):
@@ -154,9 +158,494 @@ def test_create_prerandomizations_from_expstim(method, setup_exprerands_from_exp
     for file in prerands:
         path = os.path.join(esets.out_dir, file)
 
-        if method == 'unconstrained':
-            prerand_df = pd.read_table(path)
-        else:
-            prerand_df = pd.read_table(path, header=None)
+        prerand_df = pd.read_table(path, header=None)
 
         assert len(prerand_df) == len(file_list)
+
+
+def _read_prerands(out_dir):
+    prerands = {}
+
+    for file in sorted(os.listdir(out_dir)):
+        if file.endswith('.tsv'):
+            with open(os.path.join(out_dir, file)) as prerand_file:
+                prerands[file] = prerand_file.read()
+
+    return prerands
+
+
+@pytest.mark.parametrize('method', ['pseudo_con', 'pure_con', 'unconstrained'])
+def test_create_prerands_is_reproducible_with_seed(method, setup_stim_dir):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+
+    esets.create_prerands(5, categories, method, seed=3)
+    first = _read_prerands(esets.out_dir)
+
+    esets.create_prerands(5, categories, method, seed=3)
+
+    assert _read_prerands(esets.out_dir) == first
+
+
+def test_create_prerands_resumes_from_manifest(setup_stim_dir):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+
+    esets.create_prerands(10, categories, 'pure_con', chunk_size=3)
+    uninterrupted = _read_prerands(esets.out_dir)
+
+    # Simulate a run that died after the first two chunks
+    manifest_path = os.path.join(esets.out_dir, esets.manifest_name)
+
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    manifest['completed'] = manifest['completed'][:2]
+
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    for prerand in range(7, 11):
+        os.remove(os.path.join(esets.out_dir, 'prerand_%d.tsv' % prerand))
+
+    esets.create_prerands(10, categories, 'pure_con', chunk_size=3)
+
+    assert _read_prerands(esets.out_dir) == uninterrupted
+
+    for prerand, order in enumerate(esets.results[0].to_names()):
+        assert '\n'.join(order) + '\n' == uninterrupted['prerand_%d.tsv' % (prerand + 1)]
+
+    with open(manifest_path) as manifest_file:
+        assert len(json.load(manifest_file)['completed']) == 4
+
+
+def test_finished_unseeded_runs_draw_new_prerands(setup_stim_dir):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+
+    esets.create_prerands(4, categories, 'pure_con', chunk_size=2)
+    first = _read_prerands(esets.out_dir)
+
+    esets.create_prerands(4, categories, 'pure_con', chunk_size=2)
+
+    assert _read_prerands(esets.out_dir) != first
+
+
+def test_create_prerands_does_not_resume_other_subsets(setup_stim_dir):
+    subsets = ExpSets(setup_stim_dir, 'parent')
+    random.seed(0)
+    subsets.create_subsets(3, categories)
+
+    esets = ExPrerands(setup_stim_dir, subsets.out_dir, 'parent')
+    esets.create_prerands(6, categories, 'pure_con', seed=3, chunk_size=2)
+
+    # Simulate a run that died after the first two chunks, then create the subsets again
+    manifest_path = os.path.join(esets.out_dir, esets.manifest_name)
+
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    manifest['completed'] = manifest['completed'][:2]
+
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    random.seed(1)
+    subsets.create_subsets(3, categories)
+    esets.create_prerands(6, categories, 'pure_con', seed=3, chunk_size=2)
+
+    for subset_num, subset in enumerate(esets._stim_lists()):
+        for prerand in range(6):
+            assert sorted(esets._read_prerand(esets._prerand_path(subset_num, prerand))) == sorted(subset)
+
+
+def test_create_prerands_remakes_changed_chunks(setup_stim_dir):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+    esets.create_prerands(6, categories, 'pseudo_con', seed=3, chunk_size=2)
+    uninterrupted = _read_prerands(esets.out_dir)
+
+    with open(os.path.join(esets.out_dir, 'prerand_3.tsv'), 'w') as prerand_file:
+        prerand_file.write('animal_00.txt\n' * 36)
+
+    os.remove(os.path.join(esets.out_dir, 'prerand_6.tsv'))
+    esets.create_prerands(6, categories, 'pseudo_con', seed=3, chunk_size=2)
+
+    assert _read_prerands(esets.out_dir) == uninterrupted
+
+
+def test_create_prerands_keeps_results_in_memory(setup_exprerands_from_subsets):
+    esets = setup_exprerands_from_subsets
+
+    esets.create_prerands(3, categories, 'pseudo_con', seed=0)
+
+    assert len(esets.results) == len(os.listdir(esets.subsets_path))
+
+    for subset_num, result in enumerate(esets.results):
+        assert len(result) == 3
+
+        path = os.path.join(esets.out_dir, 'set_%dprerand_2.tsv' % (subset_num + 1))
+        prerand_df = pd.read_table(path, header=None)
+
+        assert list(result.to_names(1)) == list(prerand_df[0])
+
+
+@pytest.mark.label_mapper
+@pytest.mark.parametrize('counterbalance', [False, True])
+def test_blocked_label_matrix(setup_exprerands_from_subsets, counterbalance):
+    esets = setup_exprerands_from_subsets
+    rng = np.random.default_rng(0)
+
+    label_matrix = esets._blocked_label_matrix(4, 12, 8, 3, rng, counterbalance=counterbalance)
+    blocks = label_matrix[:, ::3]
+
+    assert label_matrix.shape == (8, 48)
+    assert (label_matrix.reshape(8, 16, 3) == blocks[:, :, None]).all()
+    assert (np.diff(blocks, axis=1) != 0).all()
+
+    for row in label_matrix:
+        assert list(np.bincount(row)) == [12] * 4
+
+    if counterbalance:
+        for position in range(blocks.shape[1]):
+            assert sorted(blocks[:4, position]) == [0, 1, 2, 3]
+
+
+@pytest.mark.rises
+def test_blocked_label_matrix_raises_when_blocks_do_not_fit(setup_exprerands_from_subsets):
+    esets = setup_exprerands_from_subsets
+
+    with pytest.raises(ValueError):
+        esets._blocked_label_matrix(3, 10, 2, 4, np.random.default_rng(0))
+
+
+def test_within_category_random_matrix(setup_exprerands_from_subsets):
+    esets = setup_exprerands_from_subsets
+    rng = np.random.default_rng(0)
+
+    label_matrix = np.array([esets._pseudo_label_mapper(3, 5, rng) for _ in range(4)])
+    test_map = esets._within_category_random_matrix(label_matrix, rng)
+
+    for labels, row in zip(label_matrix, test_map):
+        assert sorted(row) == list(range(15))
+        assert (row // 5 == labels).all()
+
+
+@pytest.mark.smoke
+def test_create_blocked_prerands(setup_stim_dir):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+
+    esets.create_prerands(6, categories, 'blocked', seed=1, chunk_size=4, block_length=4, counterbalance=True)
+
+    orders = esets.results[0].to_names()
+
+    assert orders.shape == (6, 36)
+
+    for order in orders:
+        block_categories = [[stim.split('_')[0] for stim in block] for block in order.reshape(9, 4)]
+
+        assert all(len(set(block)) == 1 for block in block_categories)
+        assert all(previous[0] != current[0] for previous, current in zip(block_categories, block_categories[1:]))
+        assert len(set(order)) == 36
+
+    first_blocks = [order[0].split('_')[0] for order in orders[:3]]
+
+    assert sorted(first_blocks) == categories
+
+
+@pytest.mark.label_mapper
+def test_lagged_within_category_map(setup_exprerands_from_subsets):
+    esets = setup_exprerands_from_subsets
+    rng = np.random.default_rng(0)
+
+    files = ['%s_%02d' % (category, i) for category in categories for i in range(10)]
+    label_map = esets._label_mapper(categories, files, 'repeated', rng, repeats=3)
+    test_map = esets._lagged_within_category_map(label_map, 3, 12, rng)
+
+    assert len(test_map) == 90
+    assert all(np.diff(label_map) != 0)
+    assert list(np.bincount(test_map)) == [3] * 30
+    assert (test_map // 10 == label_map).all()
+
+    for stim in range(30):
+        assert all(np.diff(np.flatnonzero(test_map == stim)) > 12)
+
+
+@pytest.mark.rises
+def test_lagged_within_category_map_raises_when_lag_is_too_long(setup_exprerands_from_subsets):
+    esets = setup_exprerands_from_subsets
+    rng = np.random.default_rng(0)
+
+    files = ['%s_%02d' % (category, i) for category in categories for i in range(3)]
+    label_map = esets._label_mapper(categories, files, 'repeated', rng, repeats=2)
+
+    with pytest.raises(ValueError):
+        esets._lagged_within_category_map(label_map, 2, 12, rng)
+
+
+@pytest.mark.smoke
+def test_create_repeated_prerands(setup_stim_dir):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+
+    esets.create_prerands(3, categories, 'repeated', seed=2, repeats=2, min_lag=10)
+
+    for order in esets.results[0].to_names():
+        assert len(order) == 72
+        assert all(list(order).count(stim) == 2 for stim in set(order))
+        assert all(previous.split('_')[0] != current.split('_')[0] for previous, current in zip(order, order[1:]))
+
+
+@pytest.mark.label_mapper
+@pytest.mark.parametrize('counts', [[7, 3, 5], [5, 4], [1, 1, 1, 8, 4]])
+def test_constrained_label_sampler_with_unequal_categories(setup_exprerands_from_subsets, counts):
+    esets = setup_exprerands_from_subsets
+    rng = np.random.default_rng(0)
+
+    for _ in range(20):
+        test_map = esets._constrained_label_sampler(counts, rng)
+
+        assert all(np.diff(test_map) != 0)
+        assert list(np.bincount(test_map)) == counts
+
+
+@pytest.mark.rises
+def test_constrained_label_sampler_raises_when_infeasible(setup_exprerands_from_subsets):
+    esets = setup_exprerands_from_subsets
+
+    with pytest.raises(ValueError):
+        esets._constrained_label_sampler([6, 2, 2], np.random.default_rng(0))
+
+
+def test_within_category_random_map_with_unequal_categories(setup_exprerands_from_subsets):
+    esets = setup_exprerands_from_subsets
+    rng = np.random.default_rng(0)
+
+    test_labels = esets._constrained_label_sampler([4, 2, 3], rng)
+    test_map = esets._within_category_random_map(test_labels, rng)
+
+    assert sorted(test_map) == list(range(9))
+    assert (np.searchsorted([4, 6], test_map, side='right') == test_labels).all()
+
+
+@pytest.mark.parametrize('method', ['pseudo_con', 'pure_con', 'unconstrained'])
+def test_written_prerands_decode_the_results(setup_stim_dir, method):
+    for i in range(12, 15):
+        open(os.path.join(setup_stim_dir, 'animal_%02d.txt' % i), 'w').close()
+
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+    esets.create_prerands(4, categories, method, seed=0, chunk_size=3)
+    written = _read_prerands(esets.out_dir)
+
+    for prerand, order in enumerate(esets.results[0].to_names()):
+        assert sorted(order) == sorted(os.listdir(setup_stim_dir))
+        assert '\n'.join(order) + '\n' == written['prerand_%d.tsv' % (prerand + 1)]
+
+
+@pytest.mark.smoke
+@pytest.mark.parametrize('method', ['pseudo_con', 'pure_con', 'repeated'])
+def test_create_prerands_with_unequal_categories(setup_stim_dir, method):
+    for i in range(12, 20):
+        open(os.path.join(setup_stim_dir, 'animal_%02d.txt' % i), 'w').close()
+
+    for i in range(4):
+        os.remove(os.path.join(setup_stim_dir, 'human_%02d.txt' % i))
+
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+    esets.create_prerands(5, categories, method, seed=0, repeats=2, min_lag=3)
+
+    for order in esets.results[0].to_names():
+        stim_categories = [stim.split('_')[0] for stim in order]
+
+        assert len(order) == 40 * (2 if method == 'repeated' else 1)
+        assert len(set(order)) == 40
+        assert all(previous != current for previous, current in zip(stim_categories, stim_categories[1:]))
+
+
+def test_create_repeated_prerands_without_categories(setup_plain_dir):
+    esets = ExPrerands(sorted(os.listdir(setup_plain_dir)), None, 'parent')
+    esets.create_prerands(3, None, 'repeated', seed=0, repeats=3, min_lag=10)
+
+    for order in esets.results[0].to_names():
+        stim, counts = np.unique(order, return_counts=True)
+        trials = {name: [trial for trial, current in enumerate(order) if current == name] for name in stim}
+
+        assert len(stim) == 100 and (counts == 3).all()
+        assert all(np.diff(trials[name]).min() > 10 for name in stim)
+
+
+def _position_spread(orders, bins):
+    """Largest difference between the number of times a stim falls in its most and least frequent position bin"""
+    trials = orders.shape[1]
+    stim = np.unique(orders)
+    counts = np.zeros((len(stim), bins), dtype=int)
+    np.add.at(counts, (np.searchsorted(stim, orders), np.arange(trials) * bins // trials), 1)
+
+    return (counts.max(axis=1) - counts.min(axis=1)).max()
+
+
+@pytest.mark.parametrize('method', ['pseudo_con', 'pure_con', 'unconstrained'])
+def test_create_prerands_balances_positions(setup_stim_dir, method):
+    plain = ExPrerands(setup_stim_dir, None, 'parent')
+    plain.create_prerands(60, categories, method, seed=0)
+
+    balanced = ExPrerands(setup_stim_dir, None, 'child')
+    balanced.create_prerands(60, categories, method, seed=0, balance_positions=True, position_bins=4)
+
+    orders = balanced.results[0].to_names()
+
+    assert _position_spread(orders, 4) * 2 <= _position_spread(plain.results[0].to_names(), 4)
+
+    for order in orders:
+        stim_categories = [stim.split('_')[0] for stim in order]
+
+        assert sorted(order) == sorted(os.listdir(setup_stim_dir))[:36]
+
+        if method != 'unconstrained':
+            assert all(previous != current for previous, current in zip(stim_categories, stim_categories[1:]))
+
+
+def test_balanced_positions_do_not_depend_on_chunks(setup_stim_dir):
+    whole = ExPrerands(setup_stim_dir, None, 'parent')
+    whole.create_prerands(20, categories, 'pseudo_con', seed=1, balance_positions=True)
+
+    chunked = ExPrerands(setup_stim_dir, None, 'child')
+    chunked.create_prerands(20, categories, 'pseudo_con', seed=1, chunk_size=20, balance_positions=True)
+
+    assert (whole.results[0].indices == chunked.results[0].indices).all()
+
+
+def test_position_balanced_matrix_uses_every_rank_equally(setup_exprerands_from_subsets):
+    esets = setup_exprerands_from_subsets
+    rng = np.random.default_rng(0)
+    stim_labels = np.repeat(np.arange(3), 4)
+
+    label_matrix = np.array([esets._constrained_label_sampler([4, 4, 4], rng) for _ in range(8)])
+    positions = esets._within_category_random_matrix(label_matrix, rng)
+    balanced = esets._position_balanced_matrix(positions, stim_labels, 0, [0])
+
+    assert (stim_labels[balanced] == label_matrix).all()
+
+    # Rank of each stim among the trials of its category, in each prerand
+    ranks = np.argsort(np.argsort(np.where(stim_labels[balanced] == 0, np.arange(12), 99), axis=1), axis=1)
+    first_category = np.take_along_axis(ranks, np.argsort(balanced, axis=1), axis=1)[:, :4]
+
+    for stim in range(4):
+        assert sorted(first_category[:4, stim]) == sorted(first_category[4:, stim]) == [0, 1, 2, 3]
+
+
+@pytest.mark.rises
+def test_balance_positions_raises_for_repeated(setup_stim_dir):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+
+    with pytest.raises(ValueError):
+        esets.create_prerands(2, categories, 'repeated', balance_positions=True)
+
+
+@pytest.mark.parametrize('no_repeat', [True, False])
+def test_create_prerands_balances_transitions(setup_stim_dir, no_repeat):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+    esets.create_prerands(10, categories, 'transition_balanced', seed=0, no_repeat=no_repeat)
+
+    pair_count = 12 // (2 if no_repeat else 3)
+
+    for order in esets.results[0].to_names():
+        stim_categories = [categories.index(stim.split('_')[0]) for stim in order]
+        transitions = np.zeros((3, 3), dtype=int)
+        np.add.at(transitions, (stim_categories[:-1], stim_categories[1:]), 1)
+
+        # Every pair occurs equally often, except the one that closes the circuit back to the first trial
+        expected = np.full((3, 3), pair_count) - (np.eye(3, dtype=int) * pair_count if no_repeat else 0)
+        expected[stim_categories[-1], stim_categories[0]] -= 1
+
+        assert len(set(order)) == 36
+        assert (transitions == expected).all()
+
+
+@pytest.mark.rises
+def test_transition_label_matrix_raises_for_uneven_pairs(setup_exprerands_from_subsets):
+    esets = setup_exprerands_from_subsets
+
+    with pytest.raises(ValueError):
+        esets._transition_label_matrix(3, 5, 2, np.random.default_rng(0))
+
+
+_SHARD_SCRIPT = """
+import sys
+from stim_randomizer.core import ExPrerands
+
+ExPrerands(sys.argv[1], None, 'parent').create_prerands(10, {0}, 'blocked', seed=5, chunk_size=3, block_length=4,
+                                                        counterbalance=True, shard_index=int(sys.argv[2]),
+                                                        num_shards=3)
+""".format(categories)
+
+
+def test_merged_shards_match_a_single_run(setup_stim_dir, tmp_path):
+    single = ExPrerands(setup_stim_dir, None, 'parent')
+    single.create_prerands(10, categories, 'blocked', seed=5, chunk_size=3, block_length=4, counterbalance=True)
+
+    # Each shard runs in its own process, on its own copy of the stim, as on separate machines
+    machines = [str(tmp_path / 'machine_{0}'.format(shard) / 'stim') for shard in range(3)]
+    processes = []
+
+    for shard, machine in enumerate(machines):
+        shutil.copytree(setup_stim_dir, machine)
+        processes.append(subprocess.Popen([sys.executable, '-c', _SHARD_SCRIPT, machine, str(shard)]))
+
+    assert all(process.wait() == 0 for process in processes)
+
+    shard_files = [set(_read_prerands(os.path.join(machine, '../prerands'))) for machine in machines]
+
+    assert sum(len(files) for files in shard_files) == 10
+    assert set().union(*shard_files) == set(_read_prerands(single.out_dir))
+
+    merged_dir = tmp_path / 'merged' / 'stim'
+    shutil.copytree(setup_stim_dir, str(merged_dir))
+    merged = ExPrerands(str(merged_dir), None, 'parent')
+    merged.merge_shards([os.path.join(machine, '../prerands') for machine in machines])
+
+    assert _read_prerands(merged.out_dir) == _read_prerands(single.out_dir)
+    assert (merged.results[0].indices == single.results[0].indices).all()
+
+    with open(os.path.join(merged.out_dir, merged.manifest_name)) as merged_file, \
+            open(os.path.join(single.out_dir, single.manifest_name)) as single_file:
+        assert json.load(merged_file) == json.load(single_file)
+
+
+def test_shards_share_an_out_dir(setup_stim_dir):
+    subsets = ExpSets(setup_stim_dir, 'parent')
+    subsets.create_subsets(3, categories)
+    esets = ExPrerands(setup_stim_dir, subsets.out_dir, 'parent')
+    esets.create_prerands(5, categories, 'pseudo_con', seed=2, chunk_size=2)
+    single = _read_prerands(esets.out_dir)
+    shard_rows = 0
+
+    for path in single:
+        os.remove(os.path.join(esets.out_dir, path))
+
+    # More shards than the 9 chunks, so that one of them has nothing to make
+    for shard in range(10):
+        esets.create_prerands(5, categories, 'pseudo_con', seed=2, chunk_size=2, shard_index=shard, num_shards=10)
+        shard_rows += sum(len(result) for result in esets.results)
+
+    esets.merge_shards([esets.out_dir])
+
+    assert shard_rows == 5 * len(esets.results)
+    assert _read_prerands(esets.out_dir) == single
+
+
+@pytest.mark.rises
+@pytest.mark.parametrize('options', [{'shard_index': 2, 'num_shards': 2},
+                                     {'shard_index': 0, 'num_shards': 2, 'chunk_size': None},
+                                     {'shard_index': 0, 'num_shards': 2, 'seed': None},
+                                     {'shard_index': 0, 'num_shards': 2, 'balance_positions': True}])
+def test_create_prerands_raises_for_bad_shards(setup_stim_dir, options):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+    options = dict({'seed': 1, 'chunk_size': 2}, **options)
+
+    with pytest.raises(ValueError):
+        esets.create_prerands(4, categories, 'pseudo_con', **options)
+
+
+@pytest.mark.rises
+def test_merge_shards_raises_for_missing_shards(setup_stim_dir):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+    esets.create_prerands(6, categories, 'pseudo_con', seed=1, chunk_size=2, shard_index=0, num_shards=2)
+
+    with pytest.raises(ValueError):
+        esets.merge_shards([esets.out_dir])
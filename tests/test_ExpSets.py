@@ -13,6 +13,7 @@ import pandas as pd
 from stim_randomizer.core import ExpSets
 
 categories = ['animal', 'human', 'nature']
+stim_dir_options = {'files': [23, 31, 17]}
 
 
 def test_object_is_constructed_correctly(setup_expsets_cat):
@@ -92,3 +93,54 @@ def test_subsets_have_correct_amount_of_files(setup_expsets_cat):
         for category in categories:
 
             assert len(subset_df[subset_df[0].str.contains(category)]) == expected_stim_per_set / len(categories)
+
+
+@pytest.fixture
+def setup_metadata_dir(setup_stim_dir, tmp_path):
+    """Setup a stim dir with unevenly sized categories, and a metadata table with a duration for every file"""
+    rows = ['filename,duration']
+
+    for filename in sorted(os.listdir(setup_stim_dir)):
+        i = int(filename[-6:-4])
+        rows.append('{0},{1}'.format(filename, (i * 7) % 13 / 10))
+
+    metadata_path = tmp_path / 'metadata.csv'
+    metadata_path.write_text('\n'.join(rows))
+
+    return setup_stim_dir, str(metadata_path)
+
+
+def test_create_stratified_subsets_balances_uneven_strata(setup_metadata_dir):
+    stim_dir, metadata_path = setup_metadata_dir
+    esets = ExpSets(stim_dir, 'parent')
+    metadata = pd.read_csv(metadata_path)
+
+    esets.create_stratified_subsets(4, metadata_path, ['category', 'duration'], bins={'duration': 3}, seed=0)
+
+    subsets = [pd.read_table(os.path.join(esets.out_dir, subset), header=None)[0]
+               for subset in sorted(os.listdir(esets.out_dir))]
+    sizes = [len(subset) for subset in subsets]
+
+    assert len(subsets) == 4
+    assert sum(sizes) == len(metadata)
+    assert max(sizes) - min(sizes) <= 1
+
+    duration_bin = pd.qcut(metadata['duration'], 3, labels=False, duplicates='drop')
+    strata = metadata['filename'].str.split('_').str[0] + duration_bin.astype(str)
+
+    for stratum in strata.unique():
+        stratum_files = set(metadata['filename'][strata == stratum])
+        counts = [len(stratum_files.intersection(subset)) for subset in subsets]
+
+        assert max(counts) - min(counts) <= 1
+
+
+@pytest.mark.rises
+def test_create_stratified_subsets_raises_when_metadata_is_missing(setup_metadata_dir):
+    stim_dir, metadata_path = setup_metadata_dir
+    esets = ExpSets(stim_dir, 'parent')
+    metadata = pd.read_csv(metadata_path)[5:]
+
+    with pytest.raises(ValueError):
+        esets.create_stratified_subsets(4, {'filename': metadata['filename'], 'duration': metadata['duration']},
+                                        ['category'])
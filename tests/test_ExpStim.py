@@ -5,12 +5,17 @@ Author: Juan Jesus Torre Tresols
 Mail: juanjesustorre@gmail.com
 """
 
+import os
 import pdb
 import pytest
 
 from stim_randomizer.core import ExpStim, ExpSets, ExPrerands
+from stim_randomizer.hashing import hash_files
+from stim_randomizer.metadata import StimMetadata
+from stim_randomizer.results import SessionSchedule
 
 categories = ['animal', 'human', 'nature']
+stim_dir_options = {'files': 6, 'content': True}
 
 
 def test_instance_with_categories_assigns_categories_correctly(setup_expstim_cat):
@@ -66,7 +71,8 @@ def test_request_subsets_creates_subsets(setup_expstim_cat, mocker):
 
     experiment.request_subsets(10, sorted(categories))
 
-    mock_subset.return_value.create_subsets.assert_called_with(10, sorted(categories))
+    mock_subset.return_value.create_subsets.assert_called_with(10, sorted(categories), progress=None,
+                                                                cancel=None)
     mock_subset.return_value.create_subsets.assert_called_once()
 
 
@@ -89,6 +95,178 @@ def test_request_subsets_creates_subsets(setup_expstim_cat, mocker, method):
 
     experiment.request_prerands(5, method)
 
-    mock_prerands.return_value.create_prerands.assert_called_with(5, experiment.categories, method)
+    mock_prerands.return_value.create_prerands.assert_called_with(5, experiment.categories, method, seed=None,
+                                                                  chunk_size=None)
     mock_prerands.return_value.create_prerands.assert_called_once()
 
+
+
+@pytest.fixture
+def setup_metadata_dir(setup_stim_dir, tmp_path):
+    """Setup a stim dir with a metadata sidecar table next to it, with its rows in a different order"""
+    rows = ['filename,loudness,valence']
+
+    for category in categories:
+        for i in range(6):
+            rows.insert(1, '{0}_{1:02d}.txt,{2},{3}'.format(category, i, i / 10, 'pos' if i % 2 else 'neg'))
+
+    metadata_path = tmp_path / 'metadata.csv'
+    metadata_path.write_text('\n'.join(rows))
+
+    return setup_stim_dir, str(metadata_path)
+
+
+@pytest.mark.metadata
+def test_metadata_is_joined_on_filenames(setup_metadata_dir):
+    stim_dir, metadata_path = setup_metadata_dir
+    es = ExpStim(stim_dir, metadata=metadata_path)
+
+    assert es.metadata.filenames[0] == 'animal_00.txt'
+    assert es.metadata['loudness'][1] == 0.1
+    assert sorted(es.metadata.filter(valence='pos', loudness=[0.1, 0.5])) == \
+        ['animal_01.txt', 'animal_05.txt', 'human_01.txt', 'human_05.txt', 'nature_01.txt', 'nature_05.txt']
+    assert sorted(es.metadata.groups('valence')) == ['neg', 'pos']
+    assert len(es.metadata.groups('valence')['neg']) == 9
+
+
+@pytest.mark.metadata
+def test_metadata_cache_is_refreshed_when_the_table_changes(setup_metadata_dir):
+    stim_dir, metadata_path = setup_metadata_dir
+    ExpStim(stim_dir, metadata=metadata_path)
+
+    assert os.path.exists(metadata_path + StimMetadata.cache_suffix)
+
+    with open(metadata_path) as metadata_file:
+        table = metadata_file.read().replace('pos', 'positive')
+
+    with open(metadata_path, 'w') as metadata_file:
+        metadata_file.write(table + '\n')
+
+    es = ExpStim(stim_dir, metadata=metadata_path)
+
+    assert 'positive' in es.metadata['valence']
+
+
+@pytest.mark.metadata
+def test_request_subsets_with_strata_uses_metadata(setup_metadata_dir):
+    stim_dir, metadata_path = setup_metadata_dir
+    es = ExpStim(stim_dir, metadata=metadata_path)
+
+    es.request_subsets(3, strata=['category', 'valence'])
+
+    assert len(os.listdir(es.subsets.out_dir)) == 3
+
+
+@pytest.mark.hashes
+def test_hashes_are_written_next_to_filenames(setup_stim_dir):
+    es = ExpStim(setup_stim_dir)
+    hashes = es.compute_hashes(workers=2)
+
+    assert len(set(hashes.values())) == len(hashes) == 18
+
+    es.request_subsets(2)
+    es.request_prerands(2, seed=0)
+
+    for out_dir in [es.subsets.out_dir, es.prerands.out_dir]:
+        for file in os.listdir(out_dir):
+            with open(os.path.join(out_dir, file)) as out_file:
+                for line in out_file:
+                    stim, digest = line.rstrip('\n').split('\t')
+                    assert hashes[stim] == digest
+
+
+@pytest.mark.hashes
+def test_verify_reports_only_changed_files(setup_stim_dir, tmp_path):
+    cache_path = str(tmp_path / 'hashes.json')
+    ExpStim(setup_stim_dir).compute_hashes(cache_path=cache_path)
+
+    es = ExpStim(setup_stim_dir)
+    es.compute_hashes(cache_path=cache_path)
+
+    assert es.verify() == []
+
+    with open(os.path.join(setup_stim_dir, 'human_03.txt'), 'ab') as stim_file:
+        stim_file.write(b'replaced')
+
+    os.remove(os.path.join(setup_stim_dir, 'nature_00.txt'))
+
+    assert es.verify() == ['human_03.txt', 'nature_00.txt']
+
+
+@pytest.mark.hashes
+def test_hash_cache_skips_unchanged_files(setup_stim_dir):
+    cache = {}
+    files = sorted(os.listdir(setup_stim_dir))
+
+    assert len(hash_files(setup_stim_dir, files, cache)) == len(files)
+    assert hash_files(setup_stim_dir, files, cache) == []
+
+
+@pytest.mark.sessions
+@pytest.mark.parametrize('method', ['unconstrained', 'pseudo_con', 'pure_con'])
+def test_plan_sessions_never_reuses_stim(setup_stim_dir, tmp_path, method):
+    es = ExpStim(setup_stim_dir)
+    out_path = str(tmp_path / 'sessions.npz')
+
+    schedule = es.plan_sessions(5, 3, method, seed=0, out_path=out_path)
+
+    assert schedule.indices.shape == (5, 3, 6)
+
+    for participant in range(5):
+        seen = schedule.to_names(participant).ravel()
+
+        assert len(set(seen)) == 18
+        assert sorted(schedule.subsets[participant]) == [0, 1, 2]
+
+        if method != 'unconstrained':
+            for session in schedule.to_names(participant):
+                stim_categories = [stim.split('_')[0] for stim in session]
+                assert all(previous != current for previous, current in zip(stim_categories, stim_categories[1:]))
+
+    for session in range(3):
+        assert sorted(schedule.subsets[:3, session]) == [0, 1, 2]
+
+    stored = SessionSchedule.load(out_path)
+
+    assert (stored.indices == schedule.indices).all()
+    assert list(stored.to_names(4, 2)) == list(schedule.to_names(4, 2))
+
+
+def test_plan_sessions_is_reproducible_with_seed(setup_stim_dir):
+    es = ExpStim(setup_stim_dir)
+
+    first = es.plan_sessions(4, 2, seed=0)
+    second = es.plan_sessions(4, 2, seed=0)
+
+    assert (first.indices == second.indices).all() and (first.subsets == second.subsets).all()
+    assert (first.indices != es.plan_sessions(4, 2, seed=1).indices).any()
+    assert es.subsets is None
+    assert sorted(os.listdir(os.path.dirname(setup_stim_dir))) == ['stim']
+
+
+@pytest.mark.prerands
+def test_request_prerands_uses_subsets_in_memory(setup_stim_dir, mocker):
+    es = ExpStim(setup_stim_dir)
+    es.request_subsets(3)
+
+    parser = mocker.patch.object(ExPrerands, '_subset_parser')
+    es.request_prerands(2, seed=0)
+
+    parser.assert_not_called()
+    assert sorted(os.listdir(es.prerands.out_dir)) == ['set_%dprerand_%d.tsv' % (subset, prerand)
+                                                       for subset in range(1, 4) for prerand in range(1, 3)]
+
+    for subset, result in enumerate(es.prerands.results):
+        with open(os.path.join(es.subsets.out_dir, 'subset_%d.tsv' % (subset + 1))) as subset_file:
+            assert sorted(result.to_names(1)) == sorted(subset_file.read().split())
+
+
+@pytest.mark.prerands
+def test_request_without_writing_keeps_results_in_memory(setup_stim_dir):
+    es = ExpStim(setup_stim_dir)
+    es.request_subsets(2, write=False)
+    es.request_prerands(4, seed=0, chunk_size=2, write=False)
+
+    assert es.subsets.out_dir is None and es.prerands.out_dir is None
+    assert sorted(os.listdir(os.path.dirname(setup_stim_dir))) == ['stim']
+    assert [result.indices.shape for result in es.prerands.results] == [(4, 9), (4, 9)]
@@ -0,0 +1,70 @@
+"""
+Tests for the batch processing of stimulus banks inside batch.py
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+"""
+
+import os
+import pytest
+
+from stim_randomizer.batch import bank_seed, run_batch
+
+stim_dir_options = {'files': 6, 'banks': ['bank_a', 'bank_b', 'bank_c']}
+
+
+def _read_bank_prerands(path):
+    prerands_dir = os.path.join(os.path.dirname(path), 'prerands')
+
+    contents = {}
+
+    for name in sorted(os.listdir(prerands_dir)):
+        with open(os.path.join(prerands_dir, name)) as prerand_file:
+            contents[name] = prerand_file.read()
+
+    return contents
+
+
+def test_bank_seed_depends_on_batch_seed_and_position():
+    assert bank_seed(1, 0) == bank_seed(1, 0)
+    assert len({bank_seed(1, 0), bank_seed(1, 1), bank_seed(2, 0)}) == 3
+
+
+@pytest.mark.smoke
+def test_run_batch_is_reproducible(setup_stim_dir):
+    banks = [(path, {'subsets': {'set_number': 2}, 'prerands': {'prerand_number': 2}}) for path in setup_stim_dir]
+
+    first = run_batch(banks, workers=2, seed=7)
+    first_prerands = [_read_bank_prerands(path) for path in setup_stim_dir]
+
+    second = run_batch(banks, workers=3, seed=7)
+
+    assert first['ok'] == second['ok'] == 3
+    assert [result['seed'] for result in first['banks']] == [bank_seed(7, i) for i in range(3)]
+    assert [_read_bank_prerands(path) for path in setup_stim_dir] == first_prerands
+
+
+def test_run_batch_isolates_failing_banks(setup_stim_dir, tmp_path):
+    banks = [{'path': setup_stim_dir[0], 'prerands': {'prerand_number': 2}},
+             {'path': str(tmp_path / 'missing'), 'prerands': {'prerand_number': 2}},
+             {'path': setup_stim_dir[1], 'prerands': {'prerand_number': 2, 'method': 'no_method'}},
+             {'path': setup_stim_dir[2], 'prerands': {'prerand_number': 2}, 'seed': 3}]
+
+    report = run_batch(banks, workers=2, seed=0)
+
+    assert [result['status'] for result in report['banks']] == ['ok', 'failed', 'failed', 'ok']
+    assert report['ok'] == 2 and report['failed'] == 2
+    assert report['banks'][3]['seed'] == 3
+    assert report['elapsed'] >= 0 and report['wall_time'] > 0
+    assert len(os.listdir(os.path.join(os.path.dirname(setup_stim_dir[0]), 'prerands'))) == 2
+
+
+def test_run_batch_forwards_the_subsets_table(setup_stim_dir):
+    banks = [{'path': setup_stim_dir[0], 'subsets': {'set_number': 2, 'write': False}},
+             {'path': setup_stim_dir[1], 'subsets': {'set_number': 2, 'no_argument': 1}}]
+
+    report = run_batch(banks, workers=2)
+
+    assert [result['status'] for result in report['banks']] == ['ok', 'failed']
+    assert 'no_argument' in report['banks'][1]['error']
+    assert not os.path.exists(os.path.join(os.path.dirname(setup_stim_dir[0]), 'subsets'))
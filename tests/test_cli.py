@@ -0,0 +1,86 @@
+"""
+Tests for the stim-randomizer command line entry point inside cli.py
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+"""
+
+import json
+import os
+import pytest
+
+from stim_randomizer.cli import load_job, main
+
+stim_dir_options = {'banks': ['bank_a', 'bank_b']}
+
+
+@pytest.fixture
+def setup_banks(setup_stim_dir, tmp_path):
+    """Setup two stim banks, with their paths relative to tmp_path, where the job files go"""
+    return tmp_path, [os.path.relpath(bank, str(tmp_path)) for bank in setup_stim_dir]
+
+
+def test_load_job_resolves_paths_relative_to_job_file(setup_banks):
+    tmp_path, banks = setup_banks
+    job_path = tmp_path / 'job.json'
+    job_path.write_text(json.dumps({'banks': [{'path': bank} for bank in banks]}))
+
+    job = load_job(str(job_path))
+
+    assert [bank['path'] for bank in job['banks']] == [str(tmp_path / bank) for bank in banks]
+
+
+@pytest.mark.rises
+def test_load_job_raises_without_banks(tmp_path):
+    job_path = tmp_path / 'job.json'
+    job_path.write_text(json.dumps({'banks': []}))
+
+    with pytest.raises(ValueError):
+        load_job(str(job_path))
+
+
+@pytest.mark.smoke
+@pytest.mark.parametrize('job_format', ['json', 'toml'])
+def test_main_processes_every_bank(setup_banks, job_format):
+    tmp_path, banks = setup_banks
+
+    if job_format == 'json':
+        job = {'workers': 2,
+               'banks': [{'path': bank,
+                          'subsets': {'set_number': 2},
+                          'prerands': {'prerand_number': 3, 'method': 'pure_con', 'seed': 1}} for bank in banks]}
+        job_path = tmp_path / 'job.json'
+        job_path.write_text(json.dumps(job))
+    else:
+        pytest.importorskip('tomllib')
+        lines = []
+
+        for bank in banks:
+            lines += ['[[banks]]', 'path = "{0}"'.format(bank),
+                      '[banks.subsets]', 'set_number = 2',
+                      '[banks.prerands]', 'prerand_number = 3', 'method = "pure_con"', 'seed = 1']
+
+        job_path = tmp_path / 'job.toml'
+        job_path.write_text('\n'.join(lines))
+
+    assert main([str(job_path)]) == 0
+
+    for bank in banks:
+        prerands_dir = tmp_path / os.path.dirname(bank) / 'prerands'
+        assert len(os.listdir(prerands_dir)) == 2 * 3
+
+
+def test_main_isolates_failing_banks(setup_banks, capsys):
+    tmp_path, banks = setup_banks
+    job = {'banks': [{'path': 'missing_bank'},
+                     {'path': banks[0], 'prerands': {'prerand_number': 2}}]}
+    job_path = tmp_path / 'job.json'
+    job_path.write_text(json.dumps(job))
+
+    assert main([str(job_path)]) == 1
+
+    output = capsys.readouterr().out.splitlines()
+
+    assert output[0].startswith('failed')
+    assert output[1].startswith('ok')
+    assert len(os.listdir(tmp_path / 'bank_a' / 'prerands')) == 2
@@ -0,0 +1,93 @@
+"""
+Tests for the design efficiency scoring inside efficiency.py, and ExPrerands.optimize_efficiency
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+"""
+
+import os
+import numpy as np
+import pytest
+
+from stim_randomizer.core import ExPrerands
+from stim_randomizer.efficiency import canonical_hrf, design_efficiency, trial_onsets
+
+categories = ['animal', 'human', 'nature']
+
+
+def test_canonical_hrf_peaks_after_five_seconds():
+    hrf = canonical_hrf(0.1)
+
+    assert 4.5 < np.argmax(hrf) * 0.1 < 5.5
+    assert hrf.min() < 0
+    assert np.isclose(hrf.sum(), 1)
+
+
+def test_design_efficiency_matches_direct_computation():
+    rng = np.random.default_rng(0)
+    label_matrix = rng.integers(3, size=(4, 20))
+    onsets = trial_onsets([2.0, 3.0, 4.0], 4, 20, rng)
+    contrasts = np.array([[1, -1, 0], [0, 1, -1]])
+    tr, oversampling = 2.0, 4
+
+    efficiency = design_efficiency(label_matrix, onsets, 3, tr, contrasts, oversampling)
+
+    hrf = canonical_hrf(tr / oversampling)
+    bins = np.rint(onsets / (tr / oversampling)).astype(int)
+
+    for order in range(4):
+        scans = int(np.ceil((bins[order].max() + len(hrf)) / oversampling))
+        sticks = np.zeros((scans * oversampling, 3))
+        sticks[bins[order], label_matrix[order]] = 1
+        regressors = np.array([np.convolve(stick, hrf)[:scans * oversampling:oversampling] for stick in sticks.T])
+        design = np.column_stack([regressors.T, np.ones(scans)])
+        full_contrasts = np.column_stack([contrasts, np.zeros(2)])
+
+        expected = 1 / np.trace(full_contrasts @ np.linalg.inv(design.T @ design) @ full_contrasts.T)
+
+        assert np.isclose(efficiency[order], expected)
+
+
+def test_trial_onsets_are_jittered_from_the_soa_list():
+    onsets = trial_onsets([3.0, 5.0], 10, 30, np.random.default_rng(0))
+
+    assert onsets.shape == (10, 30)
+    assert (onsets[:, 0] == 0).all()
+    assert set(np.diff(onsets).ravel()) == {3.0, 5.0}
+    assert (trial_onsets(4.0, 2, 5, None) == np.arange(0, 20, 4.0)).all()
+
+
+@pytest.mark.smoke
+def test_optimize_efficiency_keeps_the_best_candidates(setup_stim_dir):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+    designs = esets.optimize_efficiency(4, categories, tr=2.0, soa=[2.0, 3.0, 4.0], candidates=60, batch_size=25,
+                                        seed=0)
+
+    efficiency = designs[0]['efficiency']
+    orders = esets.results[0].to_names()
+
+    assert len(os.listdir(esets.out_dir)) == 4
+    assert (np.diff(efficiency) <= 0).all()
+    assert designs[0]['onsets'].shape == (4, 36)
+
+    for order in orders:
+        stim_categories = [stim.split('_')[0] for stim in order]
+
+        assert len(set(order)) == 36
+        assert all(previous != current for previous, current in zip(stim_categories, stim_categories[1:]))
+
+    # Kept orders score as reported, and better than a fresh batch of candidates on average
+    label_matrix = ExPrerands._category_labels(categories, orders.ravel()).reshape(orders.shape)
+    rng = np.random.default_rng(1)
+    others = np.array([ExPrerands._constrained_label_sampler([12] * 3, rng) for _ in range(20)])
+
+    assert np.allclose(design_efficiency(label_matrix, designs[0]['onsets'], 3, 2.0), efficiency)
+    assert efficiency.min() > design_efficiency(others, trial_onsets([2.0, 3.0, 4.0], 20, 36, rng), 3, 2.0).mean()
+
+
+@pytest.mark.rises
+def test_optimize_efficiency_needs_categories(setup_stim_dir):
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+
+    with pytest.raises(ValueError):
+        esets.optimize_efficiency(2, None, tr=2.0, soa=4.0)
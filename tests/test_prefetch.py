@@ -0,0 +1,64 @@
+"""
+Tests for the StimPrefetcher class inside prefetch.py
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+"""
+
+import pytest
+
+from stim_randomizer.prefetch import StimPrefetcher
+
+
+@pytest.fixture
+def setup_order(tmp_path):
+    """Setup a stim dir with files of 1 KiB each, and a prerand file with their order"""
+    stim_dir = tmp_path / 'stim'
+    stim_dir.mkdir()
+
+    order = ['stim_%02d.wav' % i for i in range(10)][::-1]
+
+    for i, filename in enumerate(order):
+        (stim_dir / filename).write_bytes(bytes([i]) * 1024)
+
+    prerand_path = tmp_path / 'prerand_1.tsv'
+    prerand_path.write_text('\n'.join(order) + '\n')
+
+    return str(stim_dir), str(prerand_path), order
+
+
+def test_prefetcher_returns_file_contents_in_order(setup_order):
+    stim_dir, prerand_path, order = setup_order
+
+    with StimPrefetcher(prerand_path, stim_dir, depth=3) as prefetcher:
+        contents = list(prefetcher)
+
+    assert prefetcher.order == order
+    assert contents == [bytes([i]) * 1024 for i in range(10)]
+
+
+def test_prefetcher_loads_upcoming_stim_ahead(setup_order):
+    stim_dir, _, order = setup_order
+
+    with StimPrefetcher(order, stim_dir, depth=3) as prefetcher:
+        prefetcher.get()
+        # Let the background threads finish before asking for the next trials
+        prefetcher.close()
+        prefetcher.get()
+        prefetcher.get()
+
+        stats = prefetcher.stats()
+
+    assert stats['misses'] == 1
+    assert stats['hits'] == 2
+    assert stats['hits'] + stats['waits'] + stats['misses'] == 3
+
+
+def test_prefetcher_cache_respects_memory_cap(setup_order):
+    stim_dir, _, order = setup_order
+
+    with StimPrefetcher(order, stim_dir, depth=5, max_bytes=2048) as prefetcher:
+        for position in range(len(order)):
+            prefetcher.get(position)
+
+        assert prefetcher.stats()['cached_bytes'] <= 2048
@@ -0,0 +1,132 @@
+"""
+Tests for the progress reports and cancellation inside progress.py, and their use by ExpSets and ExPrerands
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+"""
+
+import os
+import random
+import threading
+import pytest
+
+from stim_randomizer.core import ExpSets, ExPrerands
+from stim_randomizer.progress import GenerationCancelled, ProgressTracker
+
+categories = ['animal', 'human', 'nature']
+
+
+def _read_dir(out_dir):
+    contents = {}
+
+    for file in sorted(os.listdir(out_dir)):
+        with open(os.path.join(out_dir, file)) as out_file:
+            contents[file] = out_file.read()
+
+    return contents
+
+
+def test_tracker_reports_rate_and_eta():
+    reports = []
+    tracker = ProgressTracker(10, reports.append)
+
+    tracker.advance(4, resumed=True)
+    tracker.advance(2)
+
+    assert [report['done'] for report in reports] == [4, 6]
+    assert reports[0]['rate'] is None and reports[0]['eta'] is None
+    assert reports[1]['rate'] > 0
+    assert reports[1]['eta'] == pytest.approx(4 / reports[1]['rate'])
+
+
+@pytest.mark.rises
+def test_tracker_raises_once_cancelled():
+    cancel = threading.Event()
+    tracker = ProgressTracker(10, cancel=cancel)
+    tracker.check()
+
+    cancel.set()
+
+    with pytest.raises(GenerationCancelled):
+        tracker.check()
+
+
+def test_cancelled_prerands_resume_to_the_same_result(setup_stim_dir, tmp_path):
+    cancel = threading.Event()
+    reports = []
+
+    def stop_after_two_chunks(report):
+        reports.append(report)
+
+        if report['done'] == 4:
+            cancel.set()
+
+    esets = ExPrerands(setup_stim_dir, None, 'parent')
+
+    with pytest.raises(GenerationCancelled):
+        esets.create_prerands(9, categories, 'pseudo_con', seed=0, chunk_size=2, progress=stop_after_two_chunks,
+                              cancel=cancel)
+
+    assert [report['done'] for report in reports] == [2, 4]
+    assert sorted(file for file in os.listdir(esets.out_dir) if file.endswith('.tsv')) == \
+        ['prerand_%d.tsv' % prerand for prerand in range(1, 5)]
+    assert not any(file.endswith('.part') for file in os.listdir(esets.out_dir))
+
+    reports.clear()
+    esets.create_prerands(9, categories, 'pseudo_con', seed=0, chunk_size=2, progress=reports.append)
+
+    uninterrupted = ExPrerands(setup_stim_dir, None, 'child')
+    uninterrupted.create_prerands(9, categories, 'pseudo_con', seed=0, chunk_size=2)
+
+    assert [report['done'] for report in reports] == [2, 4, 6, 8, 9]
+    assert reports[-1]['eta'] == 0
+    assert (esets.results[0].indices == uninterrupted.results[0].indices).all()
+
+
+def test_cancelled_subsets_keep_the_previous_run(setup_stim_dir):
+    cancel = threading.Event()
+
+    def stop_after_first_subset(report):
+        cancel.set()
+
+    esets = ExpSets(setup_stim_dir, 'parent')
+    random.seed(0)
+    esets.create_subsets(3, categories)
+    previous, previous_result = _read_dir(esets.out_dir), esets.result
+
+    random.seed(1)
+
+    with pytest.raises(GenerationCancelled):
+        esets.create_subsets(3, categories, progress=stop_after_first_subset, cancel=cancel)
+
+    assert _read_dir(esets.out_dir) == previous
+    assert esets.result is previous_result
+
+
+def test_subsets_report_progress_without_out_dir():
+    reports = []
+    names = ['%s_%02d.txt' % (category, i) for category in categories for i in range(6)]
+
+    esets = ExpSets(names, 'parent')
+    esets.create_subsets(3, categories, progress=reports.append)
+
+    assert [report['done'] for report in reports] == [1, 2, 3]
+
+
+def test_cancelled_prerands_without_chunks_keep_the_previous_run(setup_stim_dir):
+    cancel = threading.Event()
+
+    def stop_after_first_subset(report):
+        cancel.set()
+
+    subsets = ExpSets(setup_stim_dir, 'parent')
+    subsets.create_subsets(3, categories)
+
+    esets = ExPrerands(setup_stim_dir, subsets.out_dir, 'parent')
+    esets.create_prerands(2, categories, 'pseudo_con', seed=0)
+    previous = _read_dir(esets.out_dir)
+
+    with pytest.raises(GenerationCancelled):
+        esets.create_prerands(2, categories, 'pseudo_con', seed=1, progress=stop_after_first_subset, cancel=cancel)
+
+    assert _read_dir(esets.out_dir) == previous
@@ -0,0 +1,52 @@
+"""
+Tests for the result containers inside results.py
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+"""
+
+import numpy as np
+import pytest
+
+from stim_randomizer.results import PrerandResult, SubsetResult
+
+names = np.array(['animal_1', 'animal_2', 'human_1', 'human_2', 'nature_1'])
+
+
+def test_subset_result_access_and_slicing():
+    result = SubsetResult.from_lists(names, [['human_1', 'animal_2'], ['nature_1'], ['animal_1', 'human_2']])
+
+    assert len(result) == 3
+    assert list(result.sizes()) == [2, 1, 2]
+    assert list(result[0]) == [2, 1]
+    assert list(result.to_names(-1)) == ['animal_1', 'human_2']
+
+    tail = result[1:]
+
+    assert len(tail) == 2
+    assert list(tail.to_names(0)) == ['nature_1']
+    assert list(result[::2].to_names(1)) == ['animal_1', 'human_2']
+
+
+def test_subset_result_has_slots():
+    result = SubsetResult.from_lists(names, [list(names)])
+
+    with pytest.raises(AttributeError):
+        result.extra = None
+
+
+def test_prerand_result_decodes_with_shared_names():
+    indices = np.array([[0, 2, 4], [4, 0, 2]])
+    result = PrerandResult(names, indices)
+
+    assert result.indices.dtype == np.int32
+    assert result.nbytes == 6 * 4
+    assert list(result.to_names(1)) == ['nature_1', 'animal_1', 'human_1']
+    assert result.to_names().shape == (2, 3)
+    assert result[1:].names is result.names
+
+
+@pytest.mark.rises
+def test_prerand_result_raises_with_flat_indices():
+    with pytest.raises(ValueError):
+        PrerandResult(names, np.arange(3))
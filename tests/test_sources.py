@@ -0,0 +1,124 @@
+"""
+Tests for the stimulus sources inside sources.py
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+"""
+
+import os
+import tarfile
+import zipfile
+import pytest
+
+from stim_randomizer.core import ExpStim
+from stim_randomizer.prefetch import StimPrefetcher
+from stim_randomizer.sources import ArchiveSource, DirectorySource, MemorySource, StimSource, as_source
+
+categories = ['animal', 'human', 'nature']
+stim_names = [category + '_%02d.wav' % i for category in categories for i in range(8)]
+
+
+@pytest.fixture(params=['zip', 'tar.gz'])
+def setup_archive(tmp_path, request):
+    """Setup a zip or tar archive with the stim inside a 'stim' folder, plus a file outside it"""
+    archive_path = str(tmp_path / ('bank.' + request.param))
+
+    if request.param == 'zip':
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('README.txt', b'not a stim')
+
+            for i, name in enumerate(stim_names):
+                archive.writestr('stim/' + name, bytes([i]) * 16)
+
+    else:
+        source_dir = tmp_path / 'source' / 'stim'
+        source_dir.mkdir(parents=True)
+
+        for i, name in enumerate(stim_names):
+            (source_dir / name).write_bytes(bytes([i]) * 16)
+
+        with tarfile.open(archive_path, 'w:gz') as archive:
+            archive.add(str(source_dir), arcname='stim')
+
+    return archive_path
+
+
+def test_as_source_picks_the_source_type(setup_archive, tmp_path):
+    assert isinstance(as_source(str(tmp_path)), DirectorySource)
+    assert isinstance(as_source(setup_archive), ArchiveSource)
+    assert isinstance(as_source(stim_names), MemorySource)
+
+    source = MemorySource(stim_names)
+
+    assert as_source(source) is source
+
+
+@pytest.mark.rises
+def test_incomplete_source_cannot_be_created():
+    class NamesOnly(StimSource):
+        def names(self):
+            return list(stim_names)
+
+    with pytest.raises(TypeError):
+        NamesOnly()
+
+
+def test_archive_source_lists_and_reads_members(setup_archive):
+    source = ArchiveSource(setup_archive, member_dir='stim')
+
+    assert source.names() == sorted(stim_names)
+    assert source.read(stim_names[3]) == bytes([3]) * 16
+    assert ArchiveSource(setup_archive).names() == (['README.txt'] if setup_archive.endswith('zip') else [])
+
+    source.close()
+
+
+@pytest.mark.rises
+def test_archive_source_has_no_child_dir(setup_archive):
+    with pytest.raises(ValueError):
+        ExpStim(ArchiveSource(setup_archive, 'stim')).request_subsets(2, 'child')
+
+
+def test_archive_bank_writes_next_to_the_archive(setup_archive, tmp_path):
+    experiment = ExpStim(ArchiveSource(setup_archive, 'stim'))
+    experiment.request_subsets(2)
+    experiment.request_prerands(3, seed=0)
+
+    assert sorted(experiment.categories) == categories
+    assert sorted(os.listdir(tmp_path / 'subsets')) == ['subset_1.tsv', 'subset_2.tsv']
+    assert len(os.listdir(tmp_path / 'prerands')) == 2 * 3
+
+    with StimPrefetcher(experiment.prerands.results[0].to_names(0), experiment.source) as prefetcher:
+        assert prefetcher.get(0) == experiment.source.read(experiment.prerands.results[0].to_names(0)[0])
+
+
+def test_memory_source_plans_without_touching_the_filesystem(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    experiment = ExpStim(stim_names)
+
+    experiment.request_subsets(2)
+    experiment.request_prerands(4, seed=0, chunk_size=3)
+
+    assert experiment.subsets.out_dir is None and experiment.prerands.out_dir is None
+    assert [len(result) for result in experiment.prerands.results] == [4, 4]
+
+    for subset, result in enumerate(experiment.prerands.results):
+        assert sorted(result.to_names(0)) == sorted(experiment.subsets.result.to_names(subset))
+
+    schedule = experiment.plan_sessions(3, 2, seed=0)
+
+    assert os.listdir(str(tmp_path)) == []
+    assert schedule.indices.shape == (3, 2, 12)
+
+
+def test_memory_source_matches_directory_source(tmp_path):
+    for name in stim_names:
+        (tmp_path / name).touch()
+
+    in_memory = ExpStim(stim_names)
+    in_memory.request_prerands(5, seed=3, chunk_size=2)
+
+    on_disk = ExpStim(str(tmp_path))
+    on_disk.request_prerands(5, seed=3, chunk_size=2)
+
+    assert (in_memory.prerands.results[0].to_names() == on_disk.prerands.results[0].to_names()).all()
@@ -0,0 +1,143 @@
+"""
+Tests for the ResultStore class inside store.py
+
+Author: Juan Jesus Torre Tresols
+Mail: juanjesustorre@gmail.com
+"""
+
+import os
+import pytest
+
+import numpy as np
+
+from stim_randomizer.core import ExpStim
+from stim_randomizer.results import SessionSchedule, SubsetResult
+from stim_randomizer.store import ResultStore
+
+stim_dir_options = {'files': 8}
+
+
+@pytest.fixture
+def setup_stored_experiment(setup_stim_dir, tmp_path):
+    """Setup a stim dir and an ExpStim that saves its results in a store"""
+    experiment = ExpStim(setup_stim_dir, store=str(tmp_path / 'results.sqlite'))
+
+    yield experiment
+
+    experiment.store.close()
+
+
+def test_store_keeps_subsets_and_prerands(setup_stored_experiment):
+    experiment = setup_stored_experiment
+    store = experiment.store
+
+    experiment.request_subsets(2)
+    experiment.request_prerands(3, seed=0, chunk_size=2)
+
+    for subset in range(2):
+        assert store.subset(subset + 1) == list(experiment.subsets.result.to_names(subset))
+
+        for prerand in range(3):
+            path = os.path.join(experiment.prerands.out_dir, 'set_%dprerand_%d.tsv' % (subset + 1, prerand + 1))
+
+            with open(path) as prerand_file:
+                assert store.prerand(subset + 1, prerand + 1) == prerand_file.read().split()
+
+
+def test_store_finds_prerands_by_stimulus_and_position(setup_stored_experiment):
+    experiment = setup_stored_experiment
+    experiment.request_prerands(4, seed=1)
+
+    first_stim = experiment.prerands.results[0].to_names()[:, 0]
+
+    for prerand, stim in enumerate(first_stim):
+        assert (1, prerand + 1, 1) in experiment.store.prerands_with(stim, position=1)
+
+    assert len(experiment.store.prerands_with('animal_00.txt')) == 4
+
+
+def test_store_replaces_the_rows_of_a_run(tmp_path):
+    names = np.array(['a', 'b', 'c', 'd'])
+
+    with ResultStore(str(tmp_path / 'results.sqlite')) as store:
+        run = store.start_run('prerands', {'seed': 1})
+        store.write_prerands(run, 1, 1, names, [[0, 1, 2, 3], [3, 2, 1, 0]])
+        store.write_prerands(run, 1, 1, names, [[1, 0]])
+
+        assert store.prerand(1, 1) == ['b', 'a']
+        assert store.prerand(1, 2) == ['d', 'c', 'b', 'a']
+
+        run = store.start_run('subsets', {'seed': 1})
+        store.write_subsets(run, SubsetResult.from_lists(names, [['a', 'b'], ['c', 'd']]))
+        store.write_subsets(run, SubsetResult.from_lists(names, [['d']]))
+
+        assert store.subset(1) == ['d']
+        assert store.subset(2) == []
+
+
+def test_store_keeps_runs_apart(setup_stored_experiment):
+    experiment = setup_stored_experiment
+    store = experiment.store
+
+    experiment.request_subsets(2)
+    experiment.request_prerands(3, seed=0)
+    subset_run = store.latest_run('prerands')
+    from_subsets = store.prerand(1, 1)
+
+    plain = ExpStim(experiment.path, store=store)
+    plain.request_prerands(2, seed=0)
+
+    assert store.latest_run('prerands') != subset_run
+    assert store.prerand(1, 1) == list(plain.prerands.results[0].to_names(0))
+    assert store.prerand(1, 3) == []
+    assert store.prerand(1, 1, run=subset_run) == from_subsets
+
+    # Made again with the same parameters, the first run is replaced and becomes the latest one
+    experiment.request_prerands(3, seed=0)
+
+    assert store.latest_run('prerands') == subset_run
+
+
+def test_store_keeps_session_assignments(setup_stored_experiment):
+    experiment = setup_stored_experiment
+    schedule = experiment.plan_sessions(4, 2, seed=0)
+    store = experiment.store
+
+    assert store.assignments_of(3) == [(1, schedule.subsets[2, 0] + 1, None), (2, schedule.subsets[2, 1] + 1, None)]
+    assert sorted(participant for participant, _ in store.participants_with(1)) == [1, 2, 3, 4]
+
+    store.write_assignments(store.latest_run('schedule'), [(9, 1, 2, 3)])
+
+    assert store.participants_with(2, prerand=3) == [(9, 1)]
+
+
+def test_store_reopens_existing_database(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+
+    with ResultStore(path) as store:
+        store.write_assignments(store.start_run('schedule', {'seed': 1}), [(1, 1, 1, 1)])
+
+    with ResultStore(path) as store:
+        assert store.assignments_of(1) == [(1, 1, 1)]
+
+
+def test_store_replaces_a_schedule_of_the_same_run(tmp_path):
+    names = np.array(['a', 'b', 'c', 'd'])
+    larger = SessionSchedule(names, np.arange(24).reshape(3, 2, 4) % 4, np.array([[0, 1], [1, 0], [0, 1]]))
+    smaller = SessionSchedule(names, np.array([[[3, 2]]]), np.array([[1]]))
+
+    with ResultStore(str(tmp_path / 'results.sqlite')) as store:
+        run = store.start_run('schedule', {'seed': 1})
+        store.write_schedule(run, larger)
+        store.write_schedule(run, smaller)
+
+        assert store.assignments_of(1) == [(1, 2, None)]
+        assert store.assignments_of(3) == []
+        assert store.participants_with(1) == []
+
+        # Another schedule gets its own rows, and becomes the one the queries read
+        other = store.start_run('schedule', {'seed': 2})
+        store.write_schedule(other, larger)
+
+        assert len(store.assignments_of(3)) == 2
+        assert store.assignments_of(1, run=run) == [(1, 2, None)]